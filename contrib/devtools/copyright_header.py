@@ -8,6 +8,9 @@ import fnmatch
 import sys
 import subprocess
 import datetime
+import hashlib
+import json
+import multiprocessing
 import os
 
 ################################################################################
@@ -60,6 +63,24 @@ def get_filenames_to_examine():
     return sorted([filename for filename in filenames if
                    applies_to_file(filename)])
 
+GIT_LS_STAGE_CMD = 'git ls-files -s'
+GIT_MODIFIED_CMD = 'git diff-files --name-only'
+
+def get_unmodified_blob_ids():
+    """Map the files whose working tree contents match the index to their
+    blob ids."""
+    out = subprocess.check_output(GIT_LS_STAGE_CMD.split(' '))
+    blobs = {}
+    for line in out.decode("utf-8").split('\n'):
+        if line == '':
+            continue
+        metadata, filename = line.split('\t', 1)
+        blobs[filename] = metadata.split(' ')[1]
+    out = subprocess.check_output(GIT_MODIFIED_CMD.split(' '))
+    for filename in out.decode("utf-8").split('\n'):
+        blobs.pop(filename, None)
+    return blobs
+
 ################################################################################
 # define and compile regexes for the patterns we are looking for
 ################################################################################
@@ -124,6 +145,19 @@ for holder_name in EXPECTED_HOLDER_NAMES:
 # search file contents for copyright message of particular category
 ################################################################################
 
+# Each of the styles above starts with 'Copyright', so a file only needs to be
+# matched against them where that word occurs. The year part is followed by a
+# space in all of them, which fixes where the holder name starts.
+COPYRIGHT_WORD_COMPILED = re.compile('Copyright')
+STYLE_PREFIX_COMPILED = [
+    ('dominant_style', re.compile('%s %s ' % (COPYRIGHT_WITH_C, YEAR_RANGE))),
+    ('year_list_style', re.compile('%s %s ' % (COPYRIGHT_WITH_C, YEAR_LIST))),
+    ('without_c_style', re.compile('%s %s ' % (COPYRIGHT_WITHOUT_C,
+                                              ANY_YEAR_STYLE))),
+]
+HOLDER_NAME_COMPILED = [(holder_name, re.compile(holder_name)) for
+                        holder_name in EXPECTED_HOLDER_NAMES]
+
 def get_count_of_copyrights_of_any_style_any_holder(contents):
     return len(ANY_COPYRIGHT_COMPILED.findall(contents))
 
@@ -151,27 +185,116 @@ def gather_file_info(filename):
     info['filename'] = filename
     c = read_file(filename)
     info['contents'] = c
+    info.update(classify_copyrights(c))
+    return info
 
-    info['all_copyrights'] = get_count_of_copyrights_of_any_style_any_holder(c)
+def classify_copyrights(contents):
+    """Equivalent to running every style regex for every holder over
+    contents, in a single pass over the 'Copyright' occurrences."""
+    info = {}
+    info['all_copyrights'] = (
+        get_count_of_copyrights_of_any_style_any_holder(contents))
+    for style, _ in STYLE_PREFIX_COMPILED:
+        info[style] = dict.fromkeys(EXPECTED_HOLDER_NAMES, False)
+    for word in COPYRIGHT_WORD_COMPILED.finditer(contents):
+        for style, prefix_compiled in STYLE_PREFIX_COMPILED:
+            prefix = prefix_compiled.match(contents, word.start())
+            if prefix is None:
+                continue
+            for holder_name, holder_compiled in HOLDER_NAME_COMPILED:
+                if holder_compiled.match(contents, prefix.end()):
+                    info[style][holder_name] = True
 
     info['classified_copyrights'] = 0
-    info['dominant_style'] = {}
-    info['year_list_style'] = {}
-    info['without_c_style'] = {}
     for holder_name in EXPECTED_HOLDER_NAMES:
-        has_dominant_style = (
-            file_has_dominant_style_copyright_for_holder(c, holder_name))
-        has_year_list_style = (
-            file_has_year_list_style_copyright_for_holder(c, holder_name))
-        has_without_c_style = (
-            file_has_without_c_style_copyright_for_holder(c, holder_name))
-        info['dominant_style'][holder_name] = has_dominant_style
-        info['year_list_style'][holder_name] = has_year_list_style
-        info['without_c_style'][holder_name] = has_without_c_style
-        if has_dominant_style or has_year_list_style or has_without_c_style:
+        if (info['dominant_style'][holder_name] or
+                info['year_list_style'][holder_name] or
+                info['without_c_style'][holder_name]):
             info['classified_copyrights'] = info['classified_copyrights'] + 1
     return info
 
+def classify_file(filename):
+    return classify_copyrights(read_file(filename))
+
+################################################################################
+# gather the info of many files, in parallel and cached by blob id
+################################################################################
+
+CACHE_FILENAME = 'copyright_header.cache'
+# The cached results are only valid for the same patterns
+CACHE_VERSION = hashlib.sha256(json.dumps(
+    [ANY_COPYRIGHT_STYLE_OR_YEAR_STYLE] +
+    [p.pattern for _, p in STYLE_PREFIX_COMPILED] +
+    EXPECTED_HOLDER_NAMES).encode("utf-8")).hexdigest()
+
+def get_cache_filename():
+    out = subprocess.check_output(['git', 'rev-parse', '--git-dir'])
+    return os.path.join(out.decode("utf-8").rstrip('\n'), CACHE_FILENAME)
+
+def read_cache(cache_filename):
+    try:
+        with open(cache_filename, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache['blobs']
+
+def pack_info(info):
+    """Keep only the holder names found, to keep the cache small."""
+    packed = {'all_copyrights': info['all_copyrights'],
+              'classified_copyrights': info['classified_copyrights']}
+    for style, _ in STYLE_PREFIX_COMPILED:
+        packed[style] = [h for h in EXPECTED_HOLDER_NAMES if info[style][h]]
+    return packed
+
+def unpack_info(packed):
+    info = {'all_copyrights': packed['all_copyrights'],
+            'classified_copyrights': packed['classified_copyrights']}
+    for style, _ in STYLE_PREFIX_COMPILED:
+        info[style] = dict.fromkeys(EXPECTED_HOLDER_NAMES, False)
+        info[style].update(dict.fromkeys(packed[style], True))
+    return info
+
+def write_cache(cache_filename, blobs):
+    tmp_filename = cache_filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'blobs': blobs}, f)
+    os.replace(tmp_filename, cache_filename)
+
+def gather_file_infos(filenames):
+    """Return the copyright info of filenames, without their contents."""
+    cache_filename = get_cache_filename()
+    cache = read_cache(cache_filename)
+    blob_ids = get_unmodified_blob_ids()
+    results = {}
+    to_read = []
+    for filename in filenames:
+        blob_id = blob_ids.get(filename)
+        if blob_id in cache:
+            results[filename] = unpack_info(cache[blob_id])
+        else:
+            to_read.append(filename)
+    if to_read:
+        pool = multiprocessing.Pool()
+        try:
+            for filename, info in zip(to_read, pool.imap(classify_file,
+                                                         to_read, 16)):
+                results[filename] = info
+        finally:
+            pool.close()
+            pool.join()
+        # Keep the cache to the blobs of the files examined this time
+        write_cache(cache_filename, {blob_ids[f]: pack_info(results[f]) for f
+                                     in filenames if f in blob_ids})
+    file_infos = []
+    for filename in filenames:
+        info = results[filename]
+        info['filename'] = filename
+        file_infos.append(info)
+    return file_infos
+
 ################################################################################
 # report execution
 ################################################################################
@@ -261,7 +384,7 @@ def exec_report(base_directory, verbose):
     original_cwd = os.getcwd()
     os.chdir(base_directory)
     filenames = get_filenames_to_examine()
-    file_infos = [gather_file_info(f) for f in filenames]
+    file_infos = gather_file_infos(filenames)
     print_report(file_infos, verbose)
     os.chdir(original_cwd)
 
@@ -318,6 +441,25 @@ def get_git_change_years(filename):
 def get_most_recent_git_change_year(filename):
     return max(get_git_change_years(filename))
 
+GIT_LOG_NAMES_CMD = "git -c core.quotepath=off log --name-only --pretty=format:%x00%ai"
+
+def get_git_change_years_index():
+    """Map every file in the history to the years of the commits that
+    changed it, with a single 'git log'. Merge commits are never included:
+    without -m, 'git log --name-only' lists no files for them, even for a merge
+    that changed a file itself (eg resolving a conflict), which the 'git log'
+    of that single file would show."""
+    out = subprocess.check_output(GIT_LOG_NAMES_CMD.split(' '))
+    index = {}
+    year = None
+    for line in out.decode("utf-8").split('\n'):
+        if line.startswith('\0'):
+            # timestamp is in ISO 8601 format. e.g. "2016-09-05 14:25:32 -0600"
+            year = line[1:].split('-')[0]
+        elif line != '':
+            index.setdefault(line, set()).add(year)
+    return index
+
 ################################################################################
 # read and write to file
 ################################################################################
@@ -380,13 +522,17 @@ def create_updated_copyright_line(line, last_git_change_year):
             year_range_to_str(start_year, last_git_change_year) + ' ' +
             ' '.join(space_split[1:]))
 
-def update_updatable_copyright(filename):
+def update_updatable_copyright(filename, change_years_index):
     file_lines = read_file_lines(filename)
     index, line = get_updatable_copyright_line(file_lines)
     if not line:
         print_file_action_message(filename, "No updatable copyright.")
         return
-    last_git_change_year = get_most_recent_git_change_year(filename)
+    change_years = change_years_index.get(filename)
+    if change_years:
+        last_git_change_year = max(change_years)
+    else:
+        last_git_change_year = str(datetime.date.today().year)
     new_line = create_updated_copyright_line(line, last_git_change_year)
     if line == new_line:
         print_file_action_message(filename, "Copyright up-to-date.")
@@ -399,8 +545,9 @@ def update_updatable_copyright(filename):
 def exec_update_header_year(base_directory):
     original_cwd = os.getcwd()
     os.chdir(base_directory)
+    change_years_index = get_git_change_years_index()
     for filename in get_filenames_to_examine():
-        update_updatable_copyright(filename)
+        update_updatable_copyright(filename, change_years_index)
     os.chdir(original_cwd)
 
 ################################################################################
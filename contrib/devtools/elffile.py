@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Minimal ELF reader for security-check.py and symbol-check.py.
+
+Reads the ELF header, the program and section headers, the dynamic section
+and the dynamic symbol table with their symbol versions, directly from a
+memory-mapped file, instead of running and parsing `readelf` for every
+check. Handles 32 and 64 bit, little and big endian files.
+'''
+from __future__ import division, print_function
+import mmap
+import struct
+
+ET_DYN = 3
+
+PT_GNU_STACK = 0x6474e551
+PT_GNU_RELRO = 0x6474e552
+PF_X = 1
+PF_W = 2
+PF_R = 4
+
+SHT_DYNAMIC = 6
+SHT_DYNSYM = 11
+SHT_GNU_verdef = 0x6ffffffd
+SHT_GNU_verneed = 0x6ffffffe
+SHT_GNU_versym = 0x6fffffff
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_BIND_NOW = 24
+DT_FLAGS = 30
+DF_BIND_NOW = 0x8
+
+SHN_UNDEF = 0
+VERSYM_HIDDEN = 0x8000
+
+class ProgramHeader(object):
+    __slots__ = ('type', 'flags', 'offset', 'filesz')
+
+    def __init__(self, type, flags, offset, filesz):
+        self.type = type
+        self.flags = flags
+        self.offset = offset
+        self.filesz = filesz
+
+class Section(object):
+    __slots__ = ('name', 'type', 'offset', 'size', 'link', 'info', 'entsize')
+
+    def __init__(self, name, type, offset, size, link, info, entsize):
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.size = size
+        self.link = link
+        self.info = info
+        self.entsize = entsize
+
+class Symbol(object):
+    __slots__ = ('name', 'version', 'is_import')
+
+    def __init__(self, name, version, is_import):
+        self.name = name
+        self.version = version
+        self.is_import = is_import
+
+class ELFFile(object):
+    '''
+    An ELF executable or shared library, parsed once on construction.
+
+    Attributes:
+        elf_type: e_type from the ELF header (ET_DYN for PIE executables)
+        program_headers: list of ProgramHeader
+        sections: list of Section
+        dynamic: list of (tag, value) entries of the dynamic section
+        needed: list of the NEEDED library names, as bytes
+        dyn_symbols: list of Symbol from the dynamic symbol table, without
+            the unnamed ones. Versions are bytes, or b'' for none.
+    '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # empty file
+                raise IOError('%s: not an ELF file' % filename)
+        try:
+            self._parse()
+        except (struct.error, IndexError):
+            raise IOError('%s: truncated or malformed ELF file' % filename)
+        finally:
+            self.data.close()
+            del self.data
+
+    def _unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+    def _cstring(self, offset):
+        end = self.data.find(b'\0', offset)
+        if end < 0:
+            raise IndexError('unterminated string')
+        return self.data[offset:end]
+
+    def _parse(self):
+        data = self.data
+        if data[0:4] != b'\x7fELF':
+            raise IOError('not an ELF file')
+        elf_class = ord(data[4:5])
+        elf_data = ord(data[5:6])
+        if elf_class not in (1, 2) or elf_data not in (1, 2):
+            raise IOError('unknown ELF class or data encoding')
+        self.is_64 = elf_class == 2
+        self.endian = '<' if elf_data == 1 else '>'
+        addr = 'Q' if self.is_64 else 'I'
+
+        (self.elf_type, self.machine) = self._unpack('HH', 16)
+        (phoff, shoff) = self._unpack(addr + addr, 32 if self.is_64 else 28)
+        if self.is_64:
+            (phentsize, phnum, shentsize, shnum, shstrndx) = self._unpack('HHHHH', 54)
+        else:
+            (phentsize, phnum, shentsize, shnum, shstrndx) = self._unpack('HHHHH', 42)
+
+        self.program_headers = []
+        for i in range(phnum):
+            pos = phoff + i * phentsize
+            if self.is_64:
+                (p_type, p_flags, p_offset) = self._unpack('IIQ', pos)
+                (p_filesz,) = self._unpack('Q', pos + 32)
+            else:
+                (p_type, p_offset) = self._unpack('II', pos)
+                (p_filesz, _, p_flags) = self._unpack('III', pos + 16)
+            self.program_headers.append(ProgramHeader(p_type, p_flags, p_offset, p_filesz))
+
+        raw_sections = []
+        for i in range(shnum):
+            pos = shoff + i * shentsize
+            if self.is_64:
+                (sh_name, sh_type, _, _, sh_offset, sh_size, sh_link, sh_info, _, sh_entsize) = self._unpack('IIQQQQIIQQ', pos)
+            else:
+                (sh_name, sh_type, _, _, sh_offset, sh_size, sh_link, sh_info, _, sh_entsize) = self._unpack('IIIIIIIIII', pos)
+            raw_sections.append((sh_name, sh_type, sh_offset, sh_size, sh_link, sh_info, sh_entsize))
+        self.sections = []
+        for (sh_name, sh_type, sh_offset, sh_size, sh_link, sh_info, sh_entsize) in raw_sections:
+            if shstrndx < len(raw_sections):
+                name = self._cstring(raw_sections[shstrndx][2] + sh_name)
+            else:
+                name = b''
+            self.sections.append(Section(name, sh_type, sh_offset, sh_size, sh_link, sh_info, sh_entsize))
+
+        self._parse_dynamic()
+        self._parse_dyn_symbols()
+
+    def _sections_of_type(self, sh_type):
+        return [s for s in self.sections if s.type == sh_type]
+
+    def _parse_dynamic(self):
+        self.dynamic = []
+        self.needed = []
+        for section in self._sections_of_type(SHT_DYNAMIC):
+            fmt = 'qQ' if self.is_64 else 'iI'
+            entsize = struct.calcsize(fmt)
+            for pos in range(section.offset, section.offset + section.size, entsize):
+                (tag, value) = self._unpack(fmt, pos)
+                if tag == DT_NULL:
+                    break
+                self.dynamic.append((tag, value))
+                if tag == DT_NEEDED:
+                    self.needed.append(self._cstring(self.sections[section.link].offset + value))
+
+    def _version_names(self):
+        '''Map version indices to names, from the version definitions and needs.'''
+        names = {}
+        for section in self._sections_of_type(SHT_GNU_verdef):
+            strtab = self.sections[section.link].offset
+            pos = section.offset
+            for _ in range(section.info):
+                (vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next) = self._unpack('HHHHIII', pos)
+                if vd_cnt:
+                    (vda_name,) = self._unpack('I', pos + vd_aux)
+                    names[vd_ndx] = self._cstring(strtab + vda_name)
+                if not vd_next:
+                    break
+                pos += vd_next
+        for section in self._sections_of_type(SHT_GNU_verneed):
+            strtab = self.sections[section.link].offset
+            pos = section.offset
+            for _ in range(section.info):
+                (vn_version, vn_cnt, vn_file, vn_aux, vn_next) = self._unpack('HHIII', pos)
+                aux = pos + vn_aux
+                for _ in range(vn_cnt):
+                    (vna_hash, vna_flags, vna_other, vna_name, vna_next) = self._unpack('IHHII', aux)
+                    names[vna_other] = self._cstring(strtab + vna_name)
+                    if not vna_next:
+                        break
+                    aux += vna_next
+                if not vn_next:
+                    break
+                pos += vn_next
+        return names
+
+    def _parse_dyn_symbols(self):
+        self.dyn_symbols = []
+        dynsyms = self._sections_of_type(SHT_DYNSYM)
+        if not dynsyms:
+            return
+        dynsym = dynsyms[0]
+        versym = self._sections_of_type(SHT_GNU_versym)
+        version_names = self._version_names() if versym else {}
+        strtab = self.sections[dynsym.link].offset
+        if self.is_64:
+            # st_name, st_info, st_other, st_shndx, st_value, st_size
+            fmt = 'IBBHQQ'
+        else:
+            # st_name, st_value, st_size, st_info, st_other, st_shndx
+            fmt = 'IIIBBH'
+        entsize = dynsym.entsize or struct.calcsize(fmt)
+        for i in range(dynsym.size // entsize):
+            fields = self._unpack(fmt, dynsym.offset + i * entsize)
+            st_name = fields[0]
+            st_shndx = fields[3] if self.is_64 else fields[5]
+            if not st_name:
+                continue
+            name = self._cstring(strtab + st_name)
+            version = b''
+            if versym:
+                (index,) = self._unpack('H', versym[0].offset + i * 2)
+                # 0 and 1 are the local and global scope, not versions
+                version = version_names.get(index & ~VERSYM_HIDDEN, b'') if (index & ~VERSYM_HIDDEN) > 1 else b''
+            self.dyn_symbols.append(Symbol(name, version, st_shndx == SHN_UNDEF))
+
+    @property
+    def bind_now(self):
+        '''Whether all relocations are processed at load time (-z now).'''
+        for (tag, value) in self.dynamic:
+            if tag == DT_BIND_NOW or (tag == DT_FLAGS and value & DF_BIND_NOW):
+                return True
+        return False
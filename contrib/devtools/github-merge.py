@@ -19,6 +19,7 @@ import os
 from sys import stdin,stdout,stderr
 import argparse
 import hashlib
+import multiprocessing
 import subprocess
 import json,codecs
 try:
@@ -78,25 +79,13 @@ def get_symlink_files():
             ret.append(f.decode('utf-8').split("\t")[1])
     return ret
 
-def tree_sha512sum(commit='HEAD'):
-    # request metadata for entire tree, recursively
-    files = []
-    blob_by_name = {}
-    for line in subprocess.check_output([GIT, 'ls-tree', '--full-tree', '-r', commit]).splitlines():
-        name_sep = line.index(b'\t')
-        metadata = line[:name_sep].split() # perms, 'blob', blobid
-        assert(metadata[1] == b'blob')
-        name = line[name_sep+1:]
-        files.append(name)
-        blob_by_name[name] = metadata[2]
-
-    files.sort()
+def sha512_blobs(blobs):
+    '''Return a list of (blobid, sha512 hex digest) of the given blobs.'''
     # open connection to git-cat-file in batch mode to request data for all blobs
     # this is much faster than launching it per file
     p = subprocess.Popen([GIT, 'cat-file', '--batch'], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    overall = hashlib.sha512()
-    for f in files:
-        blob = blob_by_name[f]
+    digests = []
+    for blob in blobs:
         # request blob
         p.stdin.write(blob + b'\n')
         p.stdin.flush()
@@ -115,16 +104,46 @@ def tree_sha512sum(commit='HEAD'):
             else:
                 raise IOError('Premature EOF reading git cat-file output')
             ptr += bs
-        dig = intern.hexdigest()
+        digests.append((blob, intern.hexdigest()))
         assert(p.stdout.read(1) == b'\n') # ignore LF that follows blob data
+    p.stdin.close()
+    if p.wait():
+        raise IOError('Non-zero return value executing git cat-file')
+    return digests
+
+def tree_sha512sum(commit='HEAD'):
+    # request metadata for entire tree, recursively
+    files = []
+    blob_by_name = {}
+    for line in subprocess.check_output([GIT, 'ls-tree', '--full-tree', '-r', commit]).splitlines():
+        name_sep = line.index(b'\t')
+        metadata = line[:name_sep].split() # perms, 'blob', blobid
+        assert(metadata[1] == b'blob')
+        name = line[name_sep+1:]
+        files.append(name)
+        blob_by_name[name] = metadata[2]
+
+    files.sort()
+    # Hash every distinct blob once, in parallel when there are many
+    blobs = sorted(set(blob_by_name.values()))
+    jobs = min(multiprocessing.cpu_count(), len(blobs) // 64 + 1)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            digests = dict(d for chunk in pool.map(sha512_blobs, [blobs[i::jobs] for i in range(jobs)]) for d in chunk)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        digests = dict(sha512_blobs(blobs))
+
+    overall = hashlib.sha512()
+    for f in files:
         # update overall hash with file hash
-        overall.update(dig.encode("utf-8"))
+        overall.update(digests[blob_by_name[f]].encode("utf-8"))
         overall.update("  ".encode("utf-8"))
         overall.update(f)
         overall.update("\n".encode("utf-8"))
-    p.stdin.close()
-    if p.wait():
-        raise IOError('Non-zero return value executing git cat-file')
     return overall.hexdigest()
 
 def print_merge_details(pull, title, branch, base_branch, head_branch):
@@ -5,13 +5,28 @@
 '''
 Run this script every time you change one of the png files. Using pngcrush, it will optimize the png files, remove various color profiles, remove ancillary chunks (alla) and text chunks (text).
 #pngcrush -brute -ow -rem gAMA -rem cHRM -rem iCCP -rem sRGB -rem alla -rem text
+
+The hashes of the optimized files are kept in a manifest in the git directory,
+and files that are unchanged since they were optimized are skipped. The other
+files are crushed in parallel. Set PNGCRUSH to use another pngcrush binary.
 '''
+from __future__ import division,print_function
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
-import sys
 import subprocess
-import hashlib
+import sys
+import time
 from PIL import Image
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, not %s' % value)
+    return n
+
 def file_hash(filename):
     '''Return hash of raw file contents'''
     with open(filename, 'rb') as f:
@@ -24,55 +39,133 @@ def content_hash(filename):
     data = i.tobytes()
     return hashlib.sha256(data).hexdigest()
 
-pngcrush = 'pngcrush'
-git = 'git'
+pngcrush = os.getenv('PNGCRUSH', 'pngcrush')
+git = os.getenv('GIT', 'git')
 folders = ["src/qt/res/movies", "src/qt/res/icons", "share/pixmaps"]
-basePath = subprocess.check_output([git, 'rev-parse', '--show-toplevel']).rstrip('\n')
-totalSaveBytes = 0
-noHashChange = True
-
-outputArray = []
-for folder in folders:
-    absFolder=os.path.join(basePath, folder)
-    for file in os.listdir(absFolder):
-        extension = os.path.splitext(file)[1]
-        if extension.lower() == '.png':
-            print("optimizing "+file+"..."),
-            file_path = os.path.join(absFolder, file)
-            fileMetaMap = {'file' : file, 'osize': os.path.getsize(file_path), 'sha256Old' : file_hash(file_path)}
-            fileMetaMap['contentHashPre'] = content_hash(file_path)
-        
-            pngCrushOutput = ""
-            try:
-                pngCrushOutput = subprocess.check_output(
-                        [pngcrush, "-brute", "-ow", "-rem", "gAMA", "-rem", "cHRM", "-rem", "iCCP", "-rem", "sRGB", "-rem", "alla", "-rem", "text", file_path],
-                        stderr=subprocess.STDOUT).rstrip('\n')
-            except:
-                print "pngcrush is not installed, aborting..."
-                sys.exit(0)
-        
-            #verify
-            if "Not a PNG file" in subprocess.check_output([pngcrush, "-n", "-v", file_path], stderr=subprocess.STDOUT):
-                print "PNG file "+file+" is corrupted after crushing, check out pngcursh version"
-                sys.exit(1)
-            
-            fileMetaMap['sha256New'] = file_hash(file_path)
-            fileMetaMap['contentHashPost'] = content_hash(file_path)
-
-            if fileMetaMap['contentHashPre'] != fileMetaMap['contentHashPost']:
-                print "Image contents of PNG file "+file+" before and after crushing don't match"
-                sys.exit(1)
-
-            fileMetaMap['psize'] = os.path.getsize(file_path)
-            outputArray.append(fileMetaMap)
-            print("done\n"),
-
-print "summary:\n+++++++++++++++++"
-for fileDict in outputArray:
-    oldHash = fileDict['sha256Old']
-    newHash = fileDict['sha256New']
-    totalSaveBytes += fileDict['osize'] - fileDict['psize']
-    noHashChange = noHashChange and (oldHash == newHash)
-    print fileDict['file']+"\n  size diff from: "+str(fileDict['osize'])+" to: "+str(fileDict['psize'])+"\n  old sha256: "+oldHash+"\n  new sha256: "+newHash+"\n"
-    
-print "completed. Checksum stable: "+str(noHashChange)+". Total reduction: "+str(totalSaveBytes)+" bytes"
+MANIFEST = 'optimize-pngs.manifest'
+
+class CrushError(Exception):
+    pass
+
+def crush(file_path):
+    '''Optimize one png file in place and return its metadata.'''
+    start = time.time()
+    fileMetaMap = {'file' : file_path, 'osize': os.path.getsize(file_path), 'sha256Old' : file_hash(file_path)}
+    fileMetaMap['contentHashPre'] = content_hash(file_path)
+
+    # Write to a file of our own rather than using -ow, whose temporary file
+    # is shared by the pngcrush processes running in the same directory
+    crushed_path = file_path + '.crushed'
+    try:
+        subprocess.check_output(
+                [pngcrush, "-brute", "-rem", "gAMA", "-rem", "cHRM", "-rem", "iCCP", "-rem", "sRGB", "-rem", "alla", "-rem", "text", file_path, crushed_path],
+                stderr=subprocess.STDOUT)
+    except OSError:
+        raise CrushError("pngcrush is not installed, aborting...")
+    except subprocess.CalledProcessError as e:
+        if os.path.exists(crushed_path):
+            os.remove(crushed_path)
+        raise CrushError("pngcrush failed on "+file_path+": "+e.output.decode('utf-8', 'replace').rstrip('\n'))
+
+    #verify
+    if b"Not a PNG file" in subprocess.check_output([pngcrush, "-n", "-v", crushed_path], stderr=subprocess.STDOUT):
+        os.remove(crushed_path)
+        raise CrushError("PNG file "+file_path+" is corrupted after crushing, check out pngcursh version")
+
+    fileMetaMap['contentHashPost'] = content_hash(crushed_path)
+    if fileMetaMap['contentHashPre'] != fileMetaMap['contentHashPost']:
+        os.remove(crushed_path)
+        raise CrushError("Image contents of PNG file "+file_path+" before and after crushing don't match")
+
+    os.rename(crushed_path, file_path)
+    fileMetaMap['sha256New'] = file_hash(file_path)
+    fileMetaMap['psize'] = os.path.getsize(file_path)
+    fileMetaMap['seconds'] = time.time() - start
+    return fileMetaMap
+
+def crush_or_error(file_path):
+    try:
+        return crush(file_path)
+    except CrushError as e:
+        return str(e)
+
+def load_manifest(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(filename, manifest):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+
+def main():
+    parser = argparse.ArgumentParser(description='Optimize the png files of the repository with pngcrush.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=None, help='number of files to crush in parallel (default: number of CPUs)')
+    parser.add_argument('-f', '--force', action='store_true', help='crush all files, including those already optimized')
+    args = parser.parse_args()
+
+    basePath = subprocess.check_output([git, 'rev-parse', '--show-toplevel']).decode('utf-8').rstrip('\n')
+    gitDir = subprocess.check_output([git, 'rev-parse', '--git-dir'], cwd=basePath).decode('utf-8').rstrip('\n')
+    manifestPath = os.path.join(basePath, gitDir, MANIFEST)
+    # sha256 of optimized file -> path relative to the repository
+    oldManifest = {} if args.force else load_manifest(manifestPath)
+    # Only keep the entries of the current files
+    manifest = {}
+
+    todo = []
+    skipped = 0
+    for folder in folders:
+        absFolder=os.path.join(basePath, folder)
+        for file in sorted(os.listdir(absFolder)):
+            extension = os.path.splitext(file)[1]
+            if extension.lower() == '.png':
+                file_path = os.path.join(absFolder, file)
+                sha256 = file_hash(file_path)
+                if sha256 in oldManifest:
+                    manifest[sha256] = oldManifest[sha256]
+                    skipped += 1
+                else:
+                    todo.append(file_path)
+
+    print("optimizing %d files, %d already optimized..." % (len(todo), skipped))
+    start = time.time()
+    outputArray = []
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for result in pool.imap(crush_or_error, todo):
+            if not isinstance(result, dict):
+                print(result)
+                pool.terminate()
+                # only a missing pngcrush is not an error
+                sys.exit(0 if result.startswith("pngcrush is not installed") else 1)
+            outputArray.append(result)
+            manifest[result['sha256New']] = os.path.relpath(result['file'], basePath)
+            print("optimized "+os.path.relpath(result['file'], basePath))
+    finally:
+        pool.close()
+        pool.join()
+        # Remember what was done, also when stopping halfway
+        if manifest != oldManifest:
+            save_manifest(manifestPath, manifest)
+    elapsed = time.time() - start
+
+    totalSaveBytes = 0
+    noHashChange = True
+    print("summary:\n+++++++++++++++++")
+    for fileDict in outputArray:
+        oldHash = fileDict['sha256Old']
+        newHash = fileDict['sha256New']
+        totalSaveBytes += fileDict['osize'] - fileDict['psize']
+        noHashChange = noHashChange and (oldHash == newHash)
+        print(os.path.relpath(fileDict['file'], basePath)+"\n  size diff from: "+str(fileDict['osize'])+" to: "+str(fileDict['psize'])+
+              " (saved "+str(fileDict['osize'] - fileDict['psize'])+" bytes in %.2fs)" % fileDict['seconds']+
+              "\n  old sha256: "+oldHash+"\n  new sha256: "+newHash+"\n")
+
+    print("completed in %.2fs. Files crushed: %d, skipped: %d. Checksum stable: %s. Total reduction: %d bytes" %
+          (elapsed, len(outputArray), skipped, noHashChange, totalSaveBytes))
+
+if __name__ == '__main__':
+    main()
@@ -6,113 +6,64 @@
 Perform basic ELF security checks on a series of executables.
 Exit status will be 0 if successful, and the program will be silent.
 Otherwise the exit status will be 1 and it will log which executables failed which checks.
-Needs `readelf` (for ELF) and `objdump` (for PE).
+ELF files are parsed in Python (see elffile.py), PE files need `objdump`.
+Each executable is read once, and executables are checked in parallel.
 '''
 from __future__ import division,print_function,unicode_literals
+import multiprocessing
 import subprocess
 import sys
 import os
 
-READELF_CMD = os.getenv('READELF', '/usr/bin/readelf')
+from elffile import ELFFile, ET_DYN, PF_W, PF_X, PT_GNU_RELRO, PT_GNU_STACK
+
 OBJDUMP_CMD = os.getenv('OBJDUMP', '/usr/bin/objdump')
 NONFATAL = {'HIGH_ENTROPY_VA'} # checks which are non-fatal for now but only generate a warning
 
-def check_ELF_PIE(executable):
+def check_ELF_PIE(elf):
     '''
     Check for position independent executable (PIE), allowing for address space randomization.
     '''
-    p = subprocess.Popen([READELF_CMD, '-h', '-W', executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Error opening file')
+    return elf.elf_type == ET_DYN
 
-    ok = False
-    for line in stdout.split(b'\n'):
-        line = line.split()
-        if len(line)>=2 and line[0] == b'Type:' and line[1] == b'DYN':
-            ok = True
-    return ok
-
-def get_ELF_program_headers(executable):
-    '''Return type and flags for ELF program headers'''
-    p = subprocess.Popen([READELF_CMD, '-l', '-W', executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Error opening file')
-    in_headers = False
-    count = 0
-    headers = []
-    for line in stdout.split(b'\n'):
-        if line.startswith(b'Program Headers:'):
-            in_headers = True
-        if line == b'':
-            in_headers = False
-        if in_headers:
-            if count == 1: # header line
-                ofs_typ = line.find(b'Type')
-                ofs_offset = line.find(b'Offset')
-                ofs_flags = line.find(b'Flg')
-                ofs_align = line.find(b'Align')
-                if ofs_typ == -1 or ofs_offset == -1 or ofs_flags == -1 or ofs_align  == -1:
-                    raise ValueError('Cannot parse elfread -lW output')
-            elif count > 1:
-                typ = line[ofs_typ:ofs_offset].rstrip()
-                flags = line[ofs_flags:ofs_align].rstrip()
-                headers.append((typ, flags))
-            count += 1
-    return headers
-
-def check_ELF_NX(executable):
+def check_ELF_NX(elf):
     '''
     Check that no sections are writable and executable (including the stack)
     '''
     have_wx = False
     have_gnu_stack = False
-    for (typ, flags) in get_ELF_program_headers(executable):
-        if typ == b'GNU_STACK':
+    for header in elf.program_headers:
+        if header.type == PT_GNU_STACK:
             have_gnu_stack = True
-        if b'W' in flags and b'E' in flags: # section is both writable and executable
+        if header.flags & PF_W and header.flags & PF_X: # section is both writable and executable
             have_wx = True
     return have_gnu_stack and not have_wx
 
-def check_ELF_RELRO(executable):
+def check_ELF_RELRO(elf):
     '''
     Check for read-only relocations.
     GNU_RELRO program header must exist
     Dynamic section must have BIND_NOW flag
     '''
     have_gnu_relro = False
-    for (typ, flags) in get_ELF_program_headers(executable):
+    for header in elf.program_headers:
         # Note: not checking flags == 'R': here as linkers set the permission differently
         # This does not affect security: the permission flags of the GNU_RELRO program header are ignored, the PT_LOAD header determines the effective permissions.
         # However, the dynamic linker need to write to this area so these are RW.
         # Glibc itself takes care of mprotecting this area R after relocations are finished.
         # See also http://permalink.gmane.org/gmane.comp.gnu.binutils/71347
-        if typ == b'GNU_RELRO':
+        if header.type == PT_GNU_RELRO:
             have_gnu_relro = True
 
-    have_bindnow = False
-    p = subprocess.Popen([READELF_CMD, '-d', '-W', executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Error opening file')
-    for line in stdout.split(b'\n'):
-        tokens = line.split()
-        if len(tokens)>1 and tokens[1] == b'(BIND_NOW)' or (len(tokens)>2 and tokens[1] == b'(FLAGS)' and b'BIND_NOW' in tokens[2]):
-            have_bindnow = True
-    return have_gnu_relro and have_bindnow
+    return have_gnu_relro and elf.bind_now
 
-def check_ELF_Canary(executable):
+def check_ELF_Canary(elf):
     '''
     Check for use of stack canary
     '''
-    p = subprocess.Popen([READELF_CMD, '--dyn-syms', '-W', executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Error opening file')
     ok = False
-    for line in stdout.split(b'\n'):
-        if b'__stack_chk_fail' in line:
+    for symbol in elf.dyn_symbols:
+        if b'__stack_chk_fail' in symbol.name:
             ok = True
     return ok
 
@@ -122,7 +73,7 @@ def get_PE_dll_characteristics(executable):
     Returns a tuple (arch,bits) where arch is 'i386:x86-64' or 'i386'
     and bits is the DllCharacteristics value.
     '''
-    p = subprocess.Popen([OBJDUMP_CMD, '-x',  executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    p = subprocess.Popen([OBJDUMP_CMD, '-x',  executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, universal_newlines=True)
     (stdout, stderr) = p.communicate()
     if p.returncode:
         raise IOError('Error opening file')
@@ -140,17 +91,17 @@ IMAGE_DLL_CHARACTERISTICS_HIGH_ENTROPY_VA = 0x0020
 IMAGE_DLL_CHARACTERISTICS_DYNAMIC_BASE    = 0x0040
 IMAGE_DLL_CHARACTERISTICS_NX_COMPAT       = 0x0100
 
-def check_PE_DYNAMIC_BASE(executable):
+def check_PE_DYNAMIC_BASE(pe):
     '''PIE: DllCharacteristics bit 0x40 signifies dynamicbase (ASLR)'''
-    (arch,bits) = get_PE_dll_characteristics(executable)
+    (arch,bits) = pe
     reqbits = IMAGE_DLL_CHARACTERISTICS_DYNAMIC_BASE
     return (bits & reqbits) == reqbits
 
 # On 64 bit, must support high-entropy 64-bit address space layout randomization in addition to DYNAMIC_BASE
 # to have secure ASLR.
-def check_PE_HIGH_ENTROPY_VA(executable):
+def check_PE_HIGH_ENTROPY_VA(pe):
     '''PIE: DllCharacteristics bit 0x20 signifies high-entropy ASLR'''
-    (arch,bits) = get_PE_dll_characteristics(executable)
+    (arch,bits) = pe
     if arch == 'i386:x86-64': 
         reqbits = IMAGE_DLL_CHARACTERISTICS_HIGH_ENTROPY_VA
     else: # Unnecessary on 32-bit
@@ -158,11 +109,17 @@ def check_PE_HIGH_ENTROPY_VA(executable):
         reqbits = 0
     return (bits & reqbits) == reqbits
 
-def check_PE_NX(executable):
+def check_PE_NX(pe):
     '''NX: DllCharacteristics bit 0x100 signifies nxcompat (DEP)'''
-    (arch,bits) = get_PE_dll_characteristics(executable)
+    (arch,bits) = pe
     return (bits & IMAGE_DLL_CHARACTERISTICS_NX_COMPAT) == IMAGE_DLL_CHARACTERISTICS_NX_COMPAT
 
+# Parse an executable once for all its checks
+PARSERS = {
+'ELF': ELFFile,
+'PE': get_PE_dll_characteristics
+}
+
 CHECKS = {
 'ELF': [
     ('PIE', check_ELF_PIE),
@@ -178,7 +135,7 @@ CHECKS = {
 }
 
 def identify_executable(executable):
-    with open(filename, 'rb') as f:
+    with open(executable, 'rb') as f:
         magic = f.read(4)
     if magic.startswith(b'MZ'):
         return 'PE'
@@ -186,31 +143,51 @@ def identify_executable(executable):
         return 'ELF'
     return None
 
+def check_executable(filename):
+    '''
+    Run all checks on an executable.
+    Returns the exit status and the lines to print for it.
+    '''
+    try:
+        etype = identify_executable(filename)
+        if etype is None:
+            return (1, ['%s: unknown format' % filename])
+
+        parsed = PARSERS[etype](filename)
+        failed = []
+        warning = []
+        for (name, func) in CHECKS[etype]:
+            if not func(parsed):
+                if name in NONFATAL:
+                    warning.append(name)
+                else:
+                    failed.append(name)
+        retval = 0
+        output = []
+        if failed:
+            output.append('%s: failed %s' % (filename, ' '.join(failed)))
+            retval = 1
+        if warning:
+            output.append('%s: warning %s' % (filename, ' '.join(warning)))
+        return (retval, output)
+    except IOError:
+        return (1, ['%s: cannot open' % filename])
+
 if __name__ == '__main__':
     retval = 0
-    for filename in sys.argv[1:]:
-        try:
-            etype = identify_executable(filename)
-            if etype is None:
-                print('%s: unknown format' % filename)
-                retval = 1
-                continue
-
-            failed = []
-            warning = []
-            for (name, func) in CHECKS[etype]:
-                if not func(filename):
-                    if name in NONFATAL:
-                        warning.append(name)
-                    else:
-                        failed.append(name)
-            if failed:
-                print('%s: failed %s' % (filename, ' '.join(failed)))
-                retval = 1
-            if warning:
-                print('%s: warning %s' % (filename, ' '.join(warning)))
-        except IOError:
-            print('%s: cannot open' % filename)
-            retval = 1
+    filenames = sys.argv[1:]
+    if len(filenames) > 1:
+        pool = multiprocessing.Pool()
+        results = pool.imap(check_executable, filenames)
+    else:
+        pool = None
+        results = map(check_executable, filenames)
+    # Results come back in the order of the arguments
+    for (status, output) in results:
+        for line in output:
+            print(line)
+        retval |= status
+    if pool:
+        pool.close()
+        pool.join()
     exit(retval)
-
@@ -10,13 +10,18 @@ still compatible with the minimum supported Linux distribution versions.
 Example usage:
 
     find ../gitian-builder/build -type f -executable | xargs python contrib/devtools/symbol-check.py
+
+The executables are parsed in Python (see elffile.py), once each, and in
+parallel. `c++filt` is only run to demangle the names of reported symbols.
 '''
 from __future__ import division, print_function, unicode_literals
+import multiprocessing
 import subprocess
-import re
 import sys
 import os
 
+from elffile import ELFFile
+
 # Debian 6.0.9 (Squeeze) has:
 #
 # - g++ version 4.4.5 (https://packages.debian.org/search?suite=default&section=all&arch=any&searchon=names&keywords=g%2B%2B)
@@ -49,7 +54,6 @@ MAX_VERSIONS = {
 IGNORE_EXPORTS = {
 b'_edata', b'_end', b'_init', b'__bss_start', b'_fini', b'_IO_stdin_used'
 }
-READELF_CMD = os.getenv('READELF', '/usr/bin/readelf')
 CPPFILT_CMD = os.getenv('CPPFILT', '/usr/bin/c++filt')
 # Allowed NEEDED libraries
 ALLOWED_LIBRARIES = {
@@ -90,75 +94,77 @@ class CPPFilt(object):
         self.proc.stdout.close()
         self.proc.wait()
 
-def read_symbols(executable, imports=True):
+def read_symbols(elf, imports=True):
     '''
-    Parse an ELF executable and return a list of (symbol,version) tuples
-    for dynamic, imported symbols.
+    Return a list of (symbol,version) tuples for the dynamic, imported
+    (or exported) symbols of a parsed ELF executable.
     '''
-    p = subprocess.Popen([READELF_CMD, '--dyn-syms', '-W', executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Could not read symbols for %s: %s' % (executable, stderr.strip()))
-    syms = []
-    for line in stdout.split(b'\n'):
-        line = line.split()
-        if len(line)>7 and re.match(b'[0-9]+:$', line[0]):
-            (sym, _, version) = line[7].partition(b'@')
-            is_import = line[6] == b'UND'
-            if version.startswith(b'@'):
-                version = version[1:]
-            if is_import == imports:
-                syms.append((sym, version))
-    return syms
+    return [(sym.name, sym.version) for sym in elf.dyn_symbols if sym.is_import == imports]
 
 def check_version(max_versions, version):
     if b'_' in version:
         (lib, _, ver) = version.rpartition(b'_')
     else:
         lib = version
-        ver = '0'
+        ver = b'0'
     ver = tuple([int(x) for x in ver.split(b'.')])
     if not lib in max_versions:
         return False
     return ver <= max_versions[lib]
 
-def read_libraries(filename):
-    p = subprocess.Popen([READELF_CMD, '-d', '-W', filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode:
-        raise IOError('Error opening file')
-    libraries = []
-    for line in stdout.split(b'\n'):
-        tokens = line.split()
-        if len(tokens)>2 and tokens[1] == b'(NEEDED)':
-            match = re.match(b'^Shared library: \[(.*)\]$', b' '.join(tokens[2:]))
-            if match:
-                libraries.append(match.group(1))
-            else:
-                raise ValueError('Unparseable (NEEDED) specification')
-    return libraries
+def check_executable(filename):
+    '''
+    Check the symbols and libraries of an executable.
+    Returns the exit status and a list of (format, filename, symbol, version)
+    problems, with symbol names still mangled.
+    '''
+    elf = ELFFile(filename)
+    retval = 0
+    problems = []
+    # Check imported symbols
+    for sym,version in read_symbols(elf, True):
+        if version and not check_version(MAX_VERSIONS, version):
+            problems.append(('%s: symbol %s from unsupported version %s', sym, version))
+            retval = 1
+    # Check exported symbols
+    for sym,version in read_symbols(elf, False):
+        if sym in IGNORE_EXPORTS:
+            continue
+        problems.append(('%s: export of symbol %s not allowed', sym, None))
+        retval = 1
+    # Check dependency libraries
+    for library_name in elf.needed:
+        if library_name not in ALLOWED_LIBRARIES:
+            problems.append(('%s: NEEDED library %s is not allowed', None, library_name))
+            retval = 1
+    return (retval, problems)
 
 if __name__ == '__main__':
-    cppfilt = CPPFilt()
+    cppfilt = None
     retval = 0
-    for filename in sys.argv[1:]:
-        # Check imported symbols
-        for sym,version in read_symbols(filename, True):
-            if version and not check_version(MAX_VERSIONS, version):
-                print('%s: symbol %s from unsupported version %s' % (filename, cppfilt(sym).decode('utf-8'), version.decode('utf-8')))
-                retval = 1
-        # Check exported symbols
-        for sym,version in read_symbols(filename, False):
-            if sym in IGNORE_EXPORTS:
-                continue
-            print('%s: export of symbol %s not allowed' % (filename, cppfilt(sym).decode('utf-8')))
-            retval = 1
-        # Check dependency libraries
-        for library_name in read_libraries(filename):
-            if library_name not in ALLOWED_LIBRARIES:
-                print('%s: NEEDED library %s is not allowed' % (filename, library_name.decode('utf-8')))
-                retval = 1
+    filenames = sys.argv[1:]
+    if len(filenames) > 1:
+        pool = multiprocessing.Pool()
+        results = pool.imap(check_executable, filenames)
+    else:
+        pool = None
+        results = map(check_executable, filenames)
+    # Results come back in the order of the arguments
+    for filename, (status, problems) in zip(filenames, results):
+        for (fmt, sym, detail) in problems:
+            args = [filename]
+            if sym is not None:
+                if cppfilt is None:
+                    cppfilt = CPPFilt()
+                args.append(cppfilt(sym).decode('utf-8'))
+            if detail is not None:
+                args.append(detail.decode('utf-8'))
+            print(fmt % tuple(args))
+        retval |= status
+    if pool:
+        pool.close()
+        pool.join()
+    if cppfilt:
+        cppfilt.close()
 
     exit(retval)
-
-
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+'''
+Test script for optimize-pngs.py
+
+Runs it on a temporary git repository with a stub pngcrush, which rewrites
+images with PIL, so pngcrush doesn't need to be installed.
+'''
+from __future__ import division,print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from PIL import Image, PngImagePlugin
+
+OPTIMIZE_PNGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'optimize-pngs.py')
+FOLDERS = ["src/qt/res/movies", "src/qt/res/icons", "share/pixmaps"]
+
+STUB_PNGCRUSH = '''#!%s
+import sys
+from PIL import Image
+args = sys.argv[1:]
+if args[0] == '-n':
+    # verification run
+    with open(args[-1], 'rb') as f:
+        if f.read(8) != b'\\x89PNG\\r\\n\\x1a\\n':
+            print('Not a PNG file')
+    sys.exit(0)
+(infile, outfile) = args[-2:]
+if %r in infile:
+    # corrupt the output
+    with open(outfile, 'wb') as f:
+        f.write(b'garbage')
+    sys.exit(0)
+# saving without the text chunks makes the file smaller
+Image.open(infile).save(outfile, format='PNG', optimize=True)
+'''
+
+def write_png(filename, color, text):
+    info = PngImagePlugin.PngInfo()
+    info.add_text('Comment', text)
+    Image.new('RGBA', (32, 32), color).save(filename, pnginfo=info)
+
+class TestOptimizePngs(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='optimize-pngs-test')
+        subprocess.check_call(['git', 'init', '-q', self.dir])
+        for (i, folder) in enumerate(FOLDERS):
+            os.makedirs(os.path.join(self.dir, folder))
+            for j in range(3):
+                write_png(os.path.join(self.dir, folder, 'image%d.png' % j), (i * 80, j * 80, 0, 255), 'x' * 1000)
+        self.pngcrush = os.path.join(self.dir, 'pngcrush')
+        self.write_stub('corrupt-me')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_stub(self, corrupt):
+        with open(self.pngcrush, 'w') as f:
+            f.write(STUB_PNGCRUSH % (sys.executable, corrupt))
+        os.chmod(self.pngcrush, 0o755)
+
+    def optimize(self, *args):
+        env = dict(os.environ, PNGCRUSH=self.pngcrush)
+        p = subprocess.Popen([sys.executable, OPTIMIZE_PNGS] + list(args), cwd=self.dir, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        (stdout, _) = p.communicate()
+        return (p.returncode, stdout)
+
+    def test_incremental(self):
+        (rc, out) = self.optimize()
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Files crushed: 9, skipped: 0', out)
+        self.assertIn('Checksum stable: False', out)
+        # everything is optimized now
+        (rc, out) = self.optimize()
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Files crushed: 0, skipped: 9', out)
+        # a changed file is optimized again
+        write_png(os.path.join(self.dir, FOLDERS[1], 'image1.png'), (1, 2, 3, 255), 'changed')
+        (rc, out) = self.optimize()
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Files crushed: 1, skipped: 8', out)
+        self.assertIn('optimized %s/image1.png' % FOLDERS[1], out)
+        (rc, out) = self.optimize('--force')
+        self.assertEqual(rc, 0, out)
+        self.assertIn('Files crushed: 9, skipped: 0', out)
+        self.assertIn('Checksum stable: True', out)
+
+    def test_corrupted(self):
+        bad = os.path.join(self.dir, FOLDERS[2], 'image2.png')
+        with open(bad, 'rb') as f:
+            before = f.read()
+        self.write_stub('image2.png')
+        (rc, out) = self.optimize('-j', '1')
+        self.assertEqual(rc, 1, out)
+        self.assertIn('is corrupted after crushing', out)
+        # the original file is left alone
+        with open(bad, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        self.assertFalse(os.path.exists(bad + '.crushed'))
+
+    def test_no_pngcrush(self):
+        self.pngcrush = os.path.join(self.dir, 'does-not-exist')
+        (rc, out) = self.optimize()
+        self.assertEqual(rc, 0, out)
+        self.assertIn('pngcrush is not installed', out)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,15 +12,24 @@ It will do the following automatically:
   - remove invalid control characters
   - remove location tags (makes diffs less noisy)
 
+The translation files are post-processed in parallel. A file that was fetched
+with the same contents as on the previous run is not processed again: its
+result is taken from a cache in the git directory.
+
 TODO:
 - auto-add new translations to the build system according to the translation process
 '''
 from __future__ import division, print_function
+import argparse
+import hashlib
+import json
+import multiprocessing
 import subprocess
 import re
 import sys
 import os
 import io
+import time
 import xml.etree.ElementTree as ET
 
 # Name of transifex tool
@@ -31,6 +40,14 @@ SOURCE_LANG = 'bitcoin_en.ts'
 LOCALE_DIR = 'src/qt/locale'
 # Minimum number of messages for translation to be considered at all
 MIN_NUM_MESSAGES = 10
+# Post-processing results of previous runs, in the git directory
+CACHE_DIR = 'update-translations'
+
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, not %s' % value)
+    return n
 
 def check_at_repository_root():
     if not os.path.exists('.git'):
@@ -80,8 +97,14 @@ def sanitize_string(s):
     '''Sanitize string for printing'''
     return s.replace('\n',' ')
 
+# The same source messages are checked in every translation file
+_source_format_specifiers = {}
+
 def check_format_specifiers(source, translation, errors, numerus):
-    source_f = split_format_specifiers(find_format_specifiers(source))
+    source_f = _source_format_specifiers.get(source)
+    if source_f is None:
+        source_f = split_format_specifiers(find_format_specifiers(source))
+        _source_format_specifiers[source] = source_f
     # assert that no source messages contain both Qt and strprintf format specifiers
     # if this fails, go change the source as this is hacky and confusing!
     assert(not(source_f[0] and source_f[1]))
@@ -123,86 +146,220 @@ def escape_cdata(text):
     text = text.replace('"', '&quot;')
     return text
 
-def postprocess_translations(reduce_diff_hacks=False):
+def postprocess_file(filename, filepath, reduce_diff_hacks):
+    '''
+    Post-process filepath+'.orig' into filepath.
+    Returns the messages to print, whether there were errors, and the
+    resulting file contents, or None if the file was removed.
+    '''
+    if reduce_diff_hacks:
+        enable_reduce_diff_hacks()
+
+    output = []
+    have_errors = False
+    # pre-fixups to cope with transifex output
+    parser = ET.XMLParser(encoding='utf-8') # need to override encoding because 'utf8' is not understood only 'utf-8'
+    with open(filepath + '.orig', 'rb') as f:
+        data = f.read()
+    # remove control characters; this must be done over the entire file otherwise the XML parser will fail
+    data = remove_invalid_characters(data)
+    tree = ET.parse(io.BytesIO(data), parser=parser)
+
+    # iterate over all messages in file
+    root = tree.getroot()
+    for context in root.findall('context'):
+        for message in context.findall('message'):
+            numerus = message.get('numerus') == 'yes'
+            source = message.find('source').text
+            translation_node = message.find('translation')
+            # pick all numerusforms
+            if numerus:
+                translations = [i.text for i in translation_node.findall('numerusform')]
+            else:
+                translations = [translation_node.text]
+
+            for translation in translations:
+                if translation is None:
+                    continue
+                errors = []
+                valid = check_format_specifiers(source, translation, errors, numerus)
+
+                for error in errors:
+                    output.append('%s: %s' % (filename, error))
+
+                if not valid: # set type to unfinished and clear string if invalid
+                    translation_node.clear()
+                    translation_node.set('type', 'unfinished')
+                    have_errors = True
+
+            # Remove location tags
+            for location in message.findall('location'):
+                message.remove(location)
+
+            # Remove entire message if it is an unfinished translation
+            if translation_node.get('type') == 'unfinished':
+                context.remove(message)
+
+    # check if document is (virtually) empty, and remove it if so
+    num_messages = 0
+    for context in root.findall('context'):
+        for message in context.findall('message'):
+            num_messages += 1
+    if num_messages < MIN_NUM_MESSAGES:
+        output.append('Removing %s, as it contains only %i messages' % (filepath, num_messages))
+        return (output, have_errors, None)
+
+    # write fixed-up tree
+    # if diff reduction requested, replace some XML to 'sanitize' to qt formatting
+    out = io.BytesIO()
+    tree.write(out, encoding='utf-8')
+    out = out.getvalue()
+    if reduce_diff_hacks:
+        out = out.replace(b' />', b'/>')
+    with open(filepath, 'wb') as f:
+        f.write(out)
+    return (output, have_errors, out)
+
+def postprocess_job(job):
+    (filename, filepath, reduce_diff_hacks) = job
+    start = time.time()
+    (output, have_errors, out) = postprocess_file(filename, filepath, reduce_diff_hacks)
+    return (output, have_errors, out, time.time() - start)
+
+def enable_reduce_diff_hacks():
+    global _orig_escape_cdata
+    if _orig_escape_cdata is not None:
+        return
+    _orig_escape_cdata = ET._escape_cdata
+    ET._escape_cdata = escape_cdata
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def script_hash():
+    '''Hash of this script, so that cached results are dropped when the post-processing changes'''
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return file_hash(f.read())
+
+class ResultCache(object):
+    '''
+    Results of post-processing, by translation file, for inputs that were
+    seen before. The manifest maps each file to the hash of its input and
+    the messages printed for it; the outputs are stored by their hash.
+    '''
+    def __init__(self, directory, options):
+        self.directory = directory
+        self.options = options
+        try:
+            with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            self.manifest = {}
+        if self.manifest.get('options') != options:
+            self.manifest = {'options': options, 'files': {}}
+
+    def get(self, filename, input_hash):
+        entry = self.manifest['files'].get(filename)
+        if entry is None or entry['input'] != input_hash:
+            return None
+        out = None
+        if entry['output'] is not None:
+            try:
+                with open(os.path.join(self.directory, entry['output']), 'rb') as f:
+                    out = f.read()
+            except IOError:
+                return None
+            if file_hash(out) != entry['output']:
+                return None
+        return (entry['messages'], entry['have_errors'], out)
+
+    def put(self, filename, input_hash, messages, have_errors, out):
+        output_hash = None
+        if out is not None:
+            output_hash = file_hash(out)
+            with open(os.path.join(self.directory, output_hash), 'wb') as f:
+                f.write(out)
+        self.manifest['files'][filename] = {'input': input_hash, 'output': output_hash,
+                                            'messages': messages, 'have_errors': have_errors}
+
+    def save(self):
+        # Remove the outputs that are no longer referenced
+        used = set(entry['output'] for entry in self.manifest['files'].values())
+        for name in os.listdir(self.directory):
+            if len(name) == 64 and name not in used:
+                os.remove(os.path.join(self.directory, name))
+        with open(os.path.join(self.directory, 'manifest.json.tmp'), 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(os.path.join(self.directory, 'manifest.json.tmp'), os.path.join(self.directory, 'manifest.json'))
+
+def postprocess_translations(reduce_diff_hacks=False, jobs=None, use_cache=True, timing=False):
     print('Checking and postprocessing...')
+    start = time.time()
 
     if reduce_diff_hacks:
-        global _orig_escape_cdata
-        _orig_escape_cdata = ET._escape_cdata
-        ET._escape_cdata = escape_cdata
+        enable_reduce_diff_hacks()
 
     for (filename,filepath) in all_ts_files():
         os.rename(filepath, filepath+'.orig')
 
+    cache = None
+    if use_cache:
+        cache_dir = os.path.join(subprocess.check_output(['git', 'rev-parse', '--git-dir']).decode('utf-8').rstrip('\n'), CACHE_DIR)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cache = ResultCache(cache_dir, {'reduce_diff_hacks': reduce_diff_hacks, 'min_num_messages': MIN_NUM_MESSAGES, 'script': script_hash()})
+
+    results = {}
+    jobs_todo = []
+    input_hashes = {}
+    for (filename,filepath) in sorted(all_ts_files('.orig')):
+        if cache:
+            with open(filepath + '.orig', 'rb') as f:
+                input_hashes[filename] = file_hash(f.read())
+            cached = cache.get(filename, input_hashes[filename])
+            if cached is not None:
+                (messages, have_errors, out) = cached
+                if out is not None:
+                    with open(filepath, 'wb') as f:
+                        f.write(out)
+                results[filename] = (messages, have_errors, None)
+                continue
+        jobs_todo.append((filename, filepath, reduce_diff_hacks))
+
+    # Each file is handled independently, in a pool of processes
+    if jobs_todo:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for (filename, _, _), (messages, have_errors, out, seconds) in zip(jobs_todo, pool.imap(postprocess_job, jobs_todo)):
+                results[filename] = (messages, have_errors, seconds)
+                if cache:
+                    cache.put(filename, input_hashes[filename], messages, have_errors, out)
+        finally:
+            pool.close()
+            pool.join()
+    if cache:
+        cache.save()
+
     have_errors = False
-    for (filename,filepath) in all_ts_files('.orig'):
-        # pre-fixups to cope with transifex output
-        parser = ET.XMLParser(encoding='utf-8') # need to override encoding because 'utf8' is not understood only 'utf-8'
-        with open(filepath + '.orig', 'rb') as f:
-            data = f.read()
-        # remove control characters; this must be done over the entire file otherwise the XML parser will fail
-        data = remove_invalid_characters(data)
-        tree = ET.parse(io.BytesIO(data), parser=parser)
-
-        # iterate over all messages in file
-        root = tree.getroot()
-        for context in root.findall('context'):
-            for message in context.findall('message'):
-                numerus = message.get('numerus') == 'yes'
-                source = message.find('source').text
-                translation_node = message.find('translation')
-                # pick all numerusforms
-                if numerus:
-                    translations = [i.text for i in translation_node.findall('numerusform')]
-                else:
-                    translations = [translation_node.text]
-
-                for translation in translations:
-                    if translation is None:
-                        continue
-                    errors = []
-                    valid = check_format_specifiers(source, translation, errors, numerus)
-
-                    for error in errors:
-                        print('%s: %s' % (filename, error))
-
-                    if not valid: # set type to unfinished and clear string if invalid
-                        translation_node.clear()
-                        translation_node.set('type', 'unfinished')
-                        have_errors = True
-
-                # Remove location tags
-                for location in message.findall('location'):
-                    message.remove(location)
-
-                # Remove entire message if it is an unfinished translation
-                if translation_node.get('type') == 'unfinished':
-                    context.remove(message)
-
-        # check if document is (virtually) empty, and remove it if so
-        num_messages = 0
-        for context in root.findall('context'):
-            for message in context.findall('message'):
-                num_messages += 1
-        if num_messages < MIN_NUM_MESSAGES:
-            print('Removing %s, as it contains only %i messages' % (filepath, num_messages))
-            continue
+    for filename in sorted(results):
+        (messages, file_have_errors, seconds) = results[filename]
+        for message in messages:
+            print(message)
+        have_errors = have_errors or file_have_errors
 
-        # write fixed-up tree
-        # if diff reduction requested, replace some XML to 'sanitize' to qt formatting
-        if reduce_diff_hacks:
-            out = io.BytesIO()
-            tree.write(out, encoding='utf-8')
-            out = out.getvalue()
-            out = out.replace(b' />', b'/>')
-            with open(filepath, 'wb') as f:
-                f.write(out)
-        else:
-            tree.write(filepath, encoding='utf-8')
+    if timing:
+        processed = [(seconds, filename) for (filename, (_, _, seconds)) in results.items() if seconds is not None]
+        print('Processed %i files (%i unchanged) in %.2fs' % (len(processed), len(results) - len(processed), time.time() - start))
+        for (seconds, filename) in sorted(processed, reverse=True)[:10]:
+            print('  %6.3fs %s' % (seconds, filename))
     return have_errors
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch and post-process the translations from transifex.')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=None, help='number of files to post-process in parallel (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='post-process all files, even those fetched unchanged')
+    parser.add_argument('--timing', action='store_true', help='report how long post-processing took')
+    args = parser.parse_args()
     check_at_repository_root()
     fetch_all_translations()
-    postprocess_translations()
-
+    postprocess_translations(jobs=args.jobs, use_cache=not args.force, timing=args.timing)
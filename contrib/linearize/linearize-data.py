@@ -15,6 +15,9 @@ import os.path
 import sys
 import hashlib
 import datetime
+import json
+import mmap
+import multiprocessing
 import time
 from collections import namedtuple
 from binascii import hexlify, unhexlify
@@ -69,9 +72,11 @@ def calc_hash_str(blk_hdr):
 def get_blk_dt(blk_hdr):
 	members = struct.unpack("<I", blk_hdr[68:68+4])
 	nTime = members[0]
+	return (get_blk_month(nTime), nTime)
+
+def get_blk_month(nTime):
 	dt = datetime.datetime.fromtimestamp(nTime)
-	dt_ym = datetime.datetime(dt.year, dt.month, 1)
-	return (dt_ym, nTime)
+	return datetime.datetime(dt.year, dt.month, 1)
 
 # When getting the list of block hashes, undo any byte reversals.
 def get_block_hashes(settings):
@@ -94,16 +99,101 @@ def mkblockmap(blkindex):
 		blkmap[hash] = height
 	return blkmap
 
-# Block header and extent on disk
-BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'inhdr', 'blkhdr', 'size'])
+# Extent of a block on disk: the 8 byte magic and length header, followed by
+# the block itself. Blocks are copied to the output as a whole extent.
+BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'size', 'nTime'])
+
+def scan_block_file(args):
+	"""Index the blocks in one blkNNNNN.dat file.
+
+	Runs in a worker process. Returns (fn, [(hash_str, offset, size, nTime)],
+	error), where error is None or a message describing why the scan of the
+	file stopped early."""
+	(fn, fname, netmagic) = args
+	blocks = []
+	with open(fname, "rb") as f:
+		fsize = os.fstat(f.fileno()).st_size
+		if fsize == 0:
+			return (fn, blocks, None)
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			pos = 0
+			while pos + 8 + 80 <= fsize:
+				inMagic = data[pos:pos+4]
+				if inMagic == b"\0\0\0\0":
+					# Preallocated, unused space at the end of the file
+					break
+				if inMagic != netmagic:
+					return (fn, blocks, "Invalid magic: " + hexlify(inMagic).decode('utf-8'))
+				inLen = struct.unpack("<I", data[pos+4:pos+8])[0]
+				if pos + 8 + inLen > fsize:
+					return (fn, blocks, "Truncated block at offset %i" % pos)
+				blk_hdr = data[pos+8:pos+8+80]
+				nTime = struct.unpack("<I", blk_hdr[68:68+4])[0]
+				blocks.append((calc_hash_str(blk_hdr), pos, 8 + inLen, nTime))
+				pos += 8 + inLen
+		finally:
+			data.close()
+	return (fn, blocks, None)
+
+def copy_extent(inF, outF, offset, size):
+	"""Copy size bytes at offset in inF to the current position of outF.
+
+	Uses copy_file_range() or sendfile() to copy inside the kernel where
+	available, and falls back to read() and write() otherwise."""
+	in_fd = inF.fileno()
+	out_fd = outF.fileno()
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while size > 0:
+				copied = os.copy_file_range(in_fd, out_fd, size, offset)
+				if copied == 0:
+					break
+				offset += copied
+				size -= copied
+			if size == 0:
+				return
+		except OSError:
+			# eg copying between filesystems on older kernels
+			pass
+	if hasattr(os, 'sendfile'):
+		try:
+			while size > 0:
+				copied = os.sendfile(out_fd, in_fd, offset, size)
+				if copied == 0:
+					break
+				offset += copied
+				size -= copied
+			if size == 0:
+				return
+		except OSError:
+			# Not all platforms can sendfile() to a regular file
+			pass
+	inF.seek(offset)
+	while size > 0:
+		buf = inF.read(min(size, 1024 * 1024))
+		if not buf:
+			raise IOError("Unexpected end of file %s" % inF.name)
+		outF.write(buf)
+		size -= len(buf)
+
+def write_json_atomic(fname, obj):
+	tmpname = fname + '.tmp'
+	with open(tmpname, "w") as f:
+		json.dump(obj, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmpname, fname)
 
 class BlockDataCopier:
-	def __init__(self, settings, blkindex, blkmap):
+	def __init__(self, settings, blkindex, blkmap, resume=False, append=False):
 		self.settings = settings
 		self.blkindex = blkindex
 		self.blkmap = blkmap
+		self.resume = resume
+		self.append = append
 
-		self.inFn = 0
+		self.inFn = -1
 		self.inF = None
 		self.outFn = 0
 		self.outsz = 0
@@ -124,34 +214,31 @@ class BlockDataCopier:
 			self.setFileTime = True
 		if settings['split_timestamp'] != 0:
 			self.timestampSplit = True
-		# Extents and cache for out-of-order blocks
+		# Extents of the blocks to copy, by height
 		self.blockExtents = {}
-		self.outOfOrderData = {}
-		self.outOfOrderSize = 0 # running total size for items in outOfOrderData
+		# Scan results by input file, reused on resume for unchanged files
+		self.scanIndex = {}
+		self.lastBlockSize = 0
+
+	def closeOutput(self):
+		self.outF.close()
+		if self.setFileTime:
+			os.utime(self.outFname, (int(time.time()), self.highTS))
+		self.outF = None
+		self.outFname = None
+		self.outFn = self.outFn + 1
+		self.outsz = 0
 
-	def writeBlock(self, inhdr, blk_hdr, rawblock):
-		blockSizeOnDisk = len(inhdr) + len(blk_hdr) + len(rawblock)
-		if not self.fileOutput and ((self.outsz + blockSizeOnDisk) > self.maxOutSz):
-			self.outF.close()
-			if self.setFileTime:
-				os.utime(self.outFname, (int(time.time()), self.highTS))
-			self.outF = None
-			self.outFname = None
-			self.outFn = self.outFn + 1
-			self.outsz = 0
-
-		(blkDate, blkTS) = get_blk_dt(blk_hdr)
+	def writeBlock(self, extent):
+		if not self.fileOutput and ((self.outsz + extent.size) > self.maxOutSz):
+			self.closeOutput()
+
+		blkDate = get_blk_month(extent.nTime)
 		if self.timestampSplit and (blkDate > self.lastDate):
-			print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.hash_str)
+			print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.blkindex[self.blkCountOut])
 			self.lastDate = blkDate
 			if self.outF:
-				self.outF.close()
-				if self.setFileTime:
-					os.utime(self.outFname, (int(time.time()), self.highTS))
-				self.outF = None
-				self.outFname = None
-				self.outFn = self.outFn + 1
-				self.outsz = 0
+				self.closeOutput()
 
 		if not self.outF:
 			if self.fileOutput:
@@ -159,110 +246,264 @@ class BlockDataCopier:
 			else:
 				self.outFname = os.path.join(self.settings['output'], "blk%05d.dat" % self.outFn)
 			print("Output file " + self.outFname)
-			self.outF = open(self.outFname, "wb")
+			# Unbuffered, so that the file position stays in sync with
+			# copies done by the kernel on the file descriptor
+			self.outF = open(self.outFname, "wb", buffering=0)
 
-		self.outF.write(inhdr)
-		self.outF.write(blk_hdr)
-		self.outF.write(rawblock)
-		self.outsz = self.outsz + len(inhdr) + len(blk_hdr) + len(rawblock)
+		if self.inFn != extent.fn:
+			if self.inF:
+				self.inF.close()
+			self.inF = open(self.inFileName(extent.fn), "rb")
+			self.inFn = extent.fn
+		copy_extent(self.inF, self.outF, extent.offset, extent.size)
+		self.outsz = self.outsz + extent.size
+		self.lastBlockSize = extent.size
 
 		self.blkCountOut = self.blkCountOut + 1
-		if blkTS > self.highTS:
-			self.highTS = blkTS
+		if extent.nTime > self.highTS:
+			self.highTS = extent.nTime
 
 		if (self.blkCountOut % 1000) == 0:
 			print('%i blocks scanned, %i blocks written (of %i, %.1f%% complete)' % 
 					(self.blkCountIn, self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex)))
+		if (self.blkCountOut % self.settings['checkpoint_interval']) == 0:
+			self.saveCheckpoint()
+
+	def saveCheckpoint(self):
+		"""Record how far the output got, so that a later --resume can continue from there."""
+		if self.outF:
+			self.outF.flush()
+			os.fsync(self.outF.fileno())
+		state = {
+			'blkCountOut': self.blkCountOut,
+			'lastHash': self.blkindex[self.blkCountOut - 1] if self.blkCountOut else None,
+			'lastBlockSize': self.lastBlockSize,
+			'outFn': self.outFn,
+			'outFname': self.outFname,
+			'outsz': self.outsz,
+			'highTS': self.highTS,
+			'lastDate': [self.lastDate.year, self.lastDate.month],
+		}
+		write_json_atomic(self.settings['checkpoint_file'], state)
+
+	def loadCheckpoint(self):
+		"""Restore the writer state from the checkpoint and reopen the last output file.
+
+		The tail of the output file is checked against the checkpoint, and
+		anything written after the checkpoint is truncated."""
+		try:
+			with open(self.settings['checkpoint_file'], "r") as f:
+				state = json.load(f)
+		except IOError:
+			if self.append:
+				print("No checkpoint found")
+				return False
+			print("No checkpoint found, starting from the beginning")
+			return True
+		blkCountOut = state['blkCountOut']
+		if blkCountOut == 0:
+			return True
+		if blkCountOut > len(self.blkindex) or self.blkindex[blkCountOut - 1] != state['lastHash']:
+			print("Checkpoint at height %i does not match the hash list" % (blkCountOut - 1))
+			return False
+		outFname = state['outFname']
+		outsz = state['outsz']
+		if not os.path.exists(outFname):
+			print("Output file %s is missing" % outFname)
+			return False
+		if outsz > 0:
+			with open(outFname, "rb") as f:
+				f.seek(outsz - state['lastBlockSize'])
+				inhdr = f.read(8)
+				blk_hdr = f.read(80)
+			if (len(blk_hdr) < 80 or inhdr[:4] != self.settings['netmagic'] or
+					struct.unpack("<I", inhdr[4:])[0] + 8 != state['lastBlockSize'] or
+					calc_hash_str(blk_hdr) != state['lastHash']):
+				print("Output file %s does not end with block %s" % (outFname, state['lastHash']))
+				return False
+		self.blkCountOut = blkCountOut
+		self.lastBlockSize = state['lastBlockSize']
+		self.outFn = state['outFn']
+		self.outFname = outFname
+		self.outsz = outsz
+		self.highTS = state['highTS']
+		self.lastDate = datetime.datetime(state['lastDate'][0], state['lastDate'][1], 1)
+		self.outF = open(outFname, "r+b", buffering=0)
+		self.outF.truncate(outsz)
+		self.outF.seek(outsz)
+		print("Resuming at height %i in %s" % (blkCountOut, outFname))
+		return True
+
+	def outputFileNames(self):
+		if self.fileOutput:
+			if os.path.exists(self.settings['output_file']):
+				yield self.settings['output_file']
+			return
+		outFn = 0
+		while True:
+			outFname = os.path.join(self.settings['output'], "blk%05d.dat" % outFn)
+			if not os.path.exists(outFname):
+				return
+			yield outFname
+			outFn += 1
+
+	def rollbackOutput(self):
+		"""Find where the existing output stops matching the hash list.
+
+		The output files are indexed like input files. Everything after the
+		last block that matches the hash list (a stale branch, or a partial
+		write) is truncated or removed, and the writer continues after it."""
+		outFnames = list(self.outputFileNames())
+		print("Checking %i existing output files against the hash list" % len(outFnames))
+		jobs = [(fn, fname, self.settings['netmagic']) for (fn, fname) in enumerate(outFnames)]
+		height = 0
+		last = None
+		pool = multiprocessing.Pool(self.settings['scan_workers'])
+		try:
+			for (fn, blocks, error) in pool.imap(scan_block_file, jobs):
+				for (hash_str, offset, size, nTime) in blocks:
+					if height >= len(self.blkindex) or self.blkindex[height] != hash_str:
+						break
+					height += 1
+					last = (fn, offset + size, size)
+					self.highTS = max(self.highTS, nTime)
+				else:
+					if error is None:
+						continue
+				break
+		finally:
+			pool.terminate()
+			pool.join()
+
+		keepFiles = 0 if last is None else last[0] + 1
+		for outFname in outFnames[keepFiles:]:
+			print("Removing " + outFname)
+			os.remove(outFname)
+		if last is None:
+			print("No existing output matches the hash list, starting from the beginning")
+			return True
+		(outFn, outsz, lastBlockSize) = last
+		self.blkCountOut = height
+		self.lastBlockSize = lastBlockSize
+		self.outFn = outFn
+		self.outFname = outFnames[outFn]
+		self.outsz = outsz
+		if self.timestampSplit:
+			self.lastDate = get_blk_month(self.highTS)
+		self.outF = open(self.outFname, "r+b", buffering=0)
+		self.outF.truncate(outsz)
+		self.outF.seek(outsz)
+		print("Appending at height %i in %s" % (height, self.outFname))
+		return True
+
+	def loadScanIndex(self):
+		try:
+			with open(self.settings['checkpoint_file'] + '.index', "r") as f:
+				index = json.load(f)
+		except IOError:
+			return
+		if index['netmagic'] == hexlify(self.settings['netmagic']).decode('utf-8'):
+			self.scanIndex = dict((int(fn), entry) for fn, entry in index['files'].items())
+
+	def saveScanIndex(self):
+		index = {
+			'netmagic': hexlify(self.settings['netmagic']).decode('utf-8'),
+			'files': dict((str(fn), entry) for fn, entry in self.scanIndex.items()),
+		}
+		write_json_atomic(self.settings['checkpoint_file'] + '.index', index)
 
 	def inFileName(self, fn):
 		return os.path.join(self.settings['input'], "blk%05d.dat" % fn)
 
-	def fetchBlock(self, extent):
-		'''Fetch block contents from disk given extents'''
-		with open(self.inFileName(extent.fn), "rb") as f:
-			f.seek(extent.offset)
-			return f.read(extent.size)
-
-	def copyOneBlock(self):
-		'''Find the next block to be written in the input, and copy it to the output.'''
-		extent = self.blockExtents.pop(self.blkCountOut)
-		if self.blkCountOut in self.outOfOrderData:
-			# If the data is cached, use it from memory and remove from the cache
-			rawblock = self.outOfOrderData.pop(self.blkCountOut)
-			self.outOfOrderSize -= len(rawblock)
-		else: # Otherwise look up data on disk
-			rawblock = self.fetchBlock(extent)
-
-		self.writeBlock(extent.inhdr, extent.blkhdr, rawblock)
-
-	def run(self):
+	def inFileNames(self):
+		fn = 0
+		while os.path.isfile(self.inFileName(fn)):
+			yield fn
+			fn += 1
+
+	def scan(self):
+		"""Phase one: index all input files in parallel, one worker per file.
+
+		Fills blockExtents with the extent of every block in the hash list.
+		Files whose size and modification time match the saved scan index
+		are not scanned again."""
+		fns = list(self.inFileNames())
+		stats = dict((fn, os.stat(self.inFileName(fn))) for fn in fns)
+		def is_cached(fn):
+			entry = self.scanIndex.get(fn)
+			return entry is not None and entry['size'] == stats[fn].st_size and entry['mtime'] == stats[fn].st_mtime
+		jobs = [(fn, self.inFileName(fn), self.settings['netmagic']) for fn in fns if not is_cached(fn)]
+		pool = multiprocessing.Pool(self.settings['scan_workers'])
+		try:
+			scanned = pool.imap(scan_block_file, jobs)
+			for fn in fns:
+				if is_cached(fn):
+					blocks = self.scanIndex[fn]['blocks']
+					error = None
+					print("Input file %s: %i blocks (unchanged)" % (self.inFileName(fn), len(blocks)))
+				else:
+					(fn, blocks, error) = next(scanned)
+					print("Input file %s: %i blocks" % (self.inFileName(fn), len(blocks)))
+					if error is None:
+						self.scanIndex[fn] = {'size': stats[fn].st_size, 'mtime': stats[fn].st_mtime, 'blocks': blocks}
+				for (hash_str, offset, size, nTime) in blocks:
+					blkHeight = self.blkmap.get(hash_str)
+					if blkHeight is None:
+						# Because blocks can be written to files out-of-order as of 0.10, the script
+						# may encounter blocks it doesn't know about. Treat as debug output.
+						if self.settings['debug_output'] == 'true':
+							print("Skipping unknown block " + hash_str)
+						continue
+					if blkHeight not in self.blockExtents:
+						self.blockExtents[blkHeight] = BlockExtent(fn, offset, size, nTime)
+						self.blkCountIn += 1
+				if error is not None:
+					print(error)
+					break
+		finally:
+			pool.terminate()
+			pool.join()
+		self.saveScanIndex()
+
+	def copy(self):
+		"""Phase two: write the blocks out in height order."""
 		while self.blkCountOut < len(self.blkindex):
-			if not self.inF:
-				fname = self.inFileName(self.inFn)
-				print("Input file " + fname)
-				try:
-					self.inF = open(fname, "rb")
-				except IOError:
-					print("Premature end of block data")
-					return
-
-			inhdr = self.inF.read(8)
-			if (not inhdr or (inhdr[0] == "\0")):
-				self.inF.close()
-				self.inF = None
-				self.inFn = self.inFn + 1
-				continue
+			extent = self.blockExtents.get(self.blkCountOut)
+			if extent is None:
+				print("Premature end of block data")
+				break
+			self.writeBlock(extent)
+		self.saveCheckpoint()
+		if self.outF:
+			self.outF.close()
+		if self.inF:
+			self.inF.close()
 
-			inMagic = inhdr[:4]
-			if (inMagic != self.settings['netmagic']):
-				print("Invalid magic: " + hexlify(inMagic).decode('utf-8'))
+	def run(self):
+		if self.resume or self.append:
+			resumed = self.loadCheckpoint()
+			if not resumed and self.append:
+				resumed = self.rollbackOutput()
+			if not resumed:
 				return
-			inLenLE = inhdr[4:]
-			su = struct.unpack("<I", inLenLE)
-			inLen = su[0] - 80 # length without header
-			blk_hdr = self.inF.read(80)
-			inExtent = BlockExtent(self.inFn, self.inF.tell(), inhdr, blk_hdr, inLen)
-
-			self.hash_str = calc_hash_str(blk_hdr)
-			if not self.hash_str in blkmap:
-				# Because blocks can be written to files out-of-order as of 0.10, the script
-				# may encounter blocks it doesn't know about. Treat as debug output.
-				if settings['debug_output'] == 'true':
-					print("Skipping unknown block " + self.hash_str)
-				self.inF.seek(inLen, os.SEEK_CUR)
-				continue
-
-			blkHeight = self.blkmap[self.hash_str]
-			self.blkCountIn += 1
-
-			if self.blkCountOut == blkHeight:
-				# If in-order block, just copy
-				rawblock = self.inF.read(inLen)
-				self.writeBlock(inhdr, blk_hdr, rawblock)
-
-				# See if we can catch up to prior out-of-order blocks
-				while self.blkCountOut in self.blockExtents:
-					self.copyOneBlock()
-
-			else: # If out-of-order, skip over block data for now
-				self.blockExtents[blkHeight] = inExtent
-				if self.outOfOrderSize < self.settings['out_of_order_cache_sz']:
-					# If there is space in the cache, read the data
-					# Reading the data in file sequence instead of seeking and fetching it later is preferred,
-					# but we don't want to fill up memory
-					self.outOfOrderData[blkHeight] = self.inF.read(inLen)
-					self.outOfOrderSize += inLen
-				else: # If no space in cache, seek forward
-					self.inF.seek(inLen, os.SEEK_CUR)
-
+			self.loadScanIndex()
+		self.scan()
+		self.copy()
 		print("Done (%i blocks written)" % (self.blkCountOut))
 
 if __name__ == '__main__':
-	if len(sys.argv) != 2:
-		print("Usage: linearize-data.py CONFIG-FILE")
+	args = sys.argv[1:]
+	resume = '--resume' in args
+	if resume:
+		args.remove('--resume')
+	append = '--append' in args
+	if append:
+		args.remove('--append')
+	if len(args) != 1:
+		print("Usage: linearize-data.py [--resume | --append] CONFIG-FILE")
 		sys.exit(1)
 
-	f = open(sys.argv[1])
+	f = open(args[0])
 	for line in f:
 		# skip comment lines
 		m = re.search('^\s*#', line)
@@ -296,21 +537,35 @@ if __name__ == '__main__':
 		settings['split_timestamp'] = 0
 	if 'max_out_sz' not in settings:
 		settings['max_out_sz'] = 1000 * 1000 * 1000
-	if 'out_of_order_cache_sz' not in settings:
-		settings['out_of_order_cache_sz'] = 100 * 1000 * 1000
+	if 'scan_workers' not in settings:
+		settings['scan_workers'] = multiprocessing.cpu_count()
 	if 'debug_output' not in settings:
 		settings['debug_output'] = 'false'
+	if 'checkpoint_interval' not in settings:
+		settings['checkpoint_interval'] = 1000
 
 	settings['max_out_sz'] = int(settings['max_out_sz'])
 	settings['split_timestamp'] = int(settings['split_timestamp'])
 	settings['file_timestamp'] = int(settings['file_timestamp'])
 	settings['netmagic'] = unhexlify(settings['netmagic'].encode('utf-8'))
-	settings['out_of_order_cache_sz'] = int(settings['out_of_order_cache_sz'])
+	settings['scan_workers'] = int(settings['scan_workers'])
 	settings['debug_output'] = settings['debug_output'].lower()
+	settings['checkpoint_interval'] = int(settings['checkpoint_interval'])
+	if settings['checkpoint_interval'] < 1:
+		print("checkpoint_interval must be at least 1")
+		sys.exit(1)
+	if settings['scan_workers'] < 1:
+		print("scan_workers must be at least 1")
+		sys.exit(1)
 
 	if 'output_file' not in settings and 'output' not in settings:
 		print("Missing output file / directory")
 		sys.exit(1)
+	if 'checkpoint_file' not in settings:
+		if 'output' in settings:
+			settings['checkpoint_file'] = os.path.join(settings['output'], 'linearize.checkpoint')
+		else:
+			settings['checkpoint_file'] = settings['output_file'] + '.checkpoint'
 
 	blkindex = get_block_hashes(settings)
 	blkmap = mkblockmap(blkindex)
@@ -319,4 +574,4 @@ if __name__ == '__main__':
 	if not settings['genesis'] in blkmap:
 		print("Genesis block not found in hashlist")
 	else:
-		BlockDataCopier(settings, blkindex, blkmap).run()
+		BlockDataCopier(settings, blkindex, blkmap, resume, append).run()
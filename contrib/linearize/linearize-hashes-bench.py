@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+#
+# linearize-hashes-bench.py:  Benchmark linearize-hashes.py --offline on a
+# synthetic regtest chain.
+#
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Writes --blocks header-only regtest blocks to blkNNNNN.dat files in a
+# temporary directory, with stale forks every --fork-every blocks, blocks
+# stored slightly out of order, and a short branch near the tip that has
+# less blocks but more work than the main chain. Then times
+# linearize-hashes.py --offline on it and checks the resulting hash list.
+#
+
+from __future__ import print_function, division
+import argparse
+from binascii import hexlify
+import hashlib
+import os
+import os.path
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REGTEST_MAGIC = b'\xfa\xbf\xb5\xda'
+REGTEST_BITS = 0x207fffff
+# 256 times the work of a regtest block
+HARD_BITS = 0x1f7fffff
+
+def sha256d(data):
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def make_block(prev, nTime, nBits, nonce):
+	header = struct.pack("<i", 4) + prev + os.urandom(32) + struct.pack("<III", nTime, nBits, nonce)
+	# Header followed by an empty transaction list
+	block = header + b'\x00'
+	return (sha256d(header), REGTEST_MAGIC + struct.pack("<I", len(block)) + block)
+
+def generate_chain(datadir, num_blocks, fork_every, max_file_size, seed):
+	"""Write the block files and return the expected hash list."""
+	random.seed(seed)
+	nTime = 1296688602
+	prev = b'\0' * 32
+	chain = []
+	records = []
+	for height in range(num_blocks):
+		(blkhash, record) = make_block(prev, nTime + height * 600, REGTEST_BITS, height)
+		chain.append(blkhash)
+		records.append(record)
+		if fork_every and height > 0 and height % fork_every == 0:
+			# Stale branch of one to three blocks off the previous block
+			stale_prev = prev
+			for i in range(random.randint(1, 3)):
+				(stale_prev, record) = make_block(stale_prev, nTime + height * 600 + 1, REGTEST_BITS, 1 << 31 | height)
+				records.append(record)
+		prev = blkhash
+
+	# A branch with fewer, harder blocks near the tip takes over
+	fork_height = max(1, num_blocks - 20)
+	prev = chain[fork_height - 1]
+	heavy = []
+	for i in range(10):
+		(prev, record) = make_block(prev, nTime + (fork_height + i) * 600 + 2, HARD_BITS, 1 << 30 | i)
+		heavy.append(prev)
+		records.append(record)
+	chain = chain[:fork_height] + heavy
+
+	# Headers-first download stores blocks slightly out of order
+	for i in range(0, len(records) - 16, 16):
+		window = records[i:i+16]
+		random.shuffle(window)
+		records[i:i+16] = window
+
+	blocksdir = os.path.join(datadir, 'blocks')
+	os.mkdir(blocksdir)
+	fn = 0
+	outF = None
+	for record in records:
+		if outF is None or outF.tell() + len(record) > max_file_size:
+			if outF:
+				outF.close()
+			outF = open(os.path.join(blocksdir, "blk%05d.dat" % fn), "wb")
+			fn += 1
+		outF.write(record)
+	outF.close()
+	return (blocksdir, [hexlify(blkhash[::-1]).decode("utf-8") for blkhash in chain], len(records), fn)
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark linearize-hashes.py --offline on a synthetic regtest chain.')
+	parser.add_argument('--blocks', type=int, default=500000, help='Number of blocks in the main chain (default: %(default)s)')
+	parser.add_argument('--fork-every', type=int, default=100, help='Add a stale branch every this many blocks, 0 for none (default: %(default)s)')
+	parser.add_argument('--file-size', type=int, default=16 * 1024 * 1024, help='Maximum size of a block file (default: %(default)s)')
+	parser.add_argument('--workers', type=int, default=None, help='scan_workers setting (default: number of CPUs)')
+	parser.add_argument('--seed', type=int, default=1, help='Random seed (default: %(default)s)')
+	parser.add_argument('--keep', action='store_true', help='Keep the generated data directory')
+	args = parser.parse_args()
+
+	datadir = tempfile.mkdtemp(prefix='linearize-bench-')
+	try:
+		start = time.time()
+		(blocksdir, expected, num_headers, num_files) = generate_chain(datadir, args.blocks, args.fork_every, args.file_size, args.seed)
+		print("Generated %i headers in %i files in %.1fs" % (num_headers, num_files, time.time() - start))
+
+		cfg = os.path.join(datadir, 'linearize.cfg')
+		with open(cfg, 'w') as f:
+			f.write('netmagic=%s\ninput=%s\n' % (hexlify(REGTEST_MAGIC).decode("utf-8"), blocksdir))
+			if args.workers:
+				f.write('scan_workers=%i\n' % args.workers)
+
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'linearize-hashes.py')
+		start = time.time()
+		output = subprocess.check_output([sys.executable, script, '--offline', cfg])
+		elapsed = time.time() - start
+		maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+		if output.decode('utf-8').split() != expected:
+			print("Hash list does not match the expected chain")
+			sys.exit(1)
+		print("Linearized %i headers in %.2fs (%.0f headers/s), best chain height %i, peak RSS %.1f MiB" %
+		      (num_headers, elapsed, num_headers / elapsed, len(expected) - 1, maxrss / 1024))
+	finally:
+		if args.keep:
+			print("Data directory: " + datadir)
+		else:
+			shutil.rmtree(datadir)
+
+if __name__ == '__main__':
+	main()
@@ -12,12 +12,23 @@ try: # Python 3
     import http.client as httplib
 except ImportError: # Python 2
     import httplib
+try: # Python 3
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+from array import array
+from binascii import hexlify, unhexlify
+import hashlib
 import json
+import mmap
+import multiprocessing
 import re
 import base64
+import struct
 import sys
 import os
 import os.path
+import threading
 
 settings = {}
 
@@ -68,32 +79,333 @@ class BitcoinRPC:
 	def response_is_error(resp_obj):
 		return 'error' in resp_obj and resp_obj['error'] is not None
 
-def get_block_hashes(settings, max_blocks_per_call=10000):
-	rpc = BitcoinRPC(settings['host'], settings['port'],
-			 settings['rpcuser'], settings['rpcpassword'])
+def get_rpc(settings):
+	return BitcoinRPC(settings['host'], settings['port'],
+			  settings['rpcuser'], settings['rpcpassword'])
 
-	height = settings['min_height']
-	while height < settings['max_height']+1:
-		num_blocks = min(settings['max_height']+1-height, max_blocks_per_call)
-		batch = []
-		for x in range(num_blocks):
-			batch.append(rpc.build_request(x, 'getblockhash', [height + x]))
+def rpc_call(rpc, method, params=None):
+	reply = rpc.execute(rpc.build_request(0, method, params))
+	if reply is None:
+		print('Cannot continue. Program will halt.')
+		exit(1)
+	if rpc.response_is_error(reply):
+		print('JSON-RPC: error in', method, ': ', reply['error'], file=sys.stderr)
+		exit(1)
+	return reply['result']
 
-		reply = rpc.execute(batch)
-		if reply is None:
-			print('Cannot continue. Program will halt.')
-			return None
+class RPCFetchError(Exception):
+	pass
+
+def fetch_block_hashes(rpc, settings, height, num_blocks):
+	"""Fetch the hashes of num_blocks blocks starting at height in one batch."""
+	batch = []
+	for x in range(num_blocks):
+		batch.append(rpc.build_request(x, 'getblockhash', [height + x]))
+
+	reply = rpc.execute(batch)
+	if reply is None:
+		raise RPCFetchError('Cannot continue. Program will halt.')
+
+	hashes = []
+	for x,resp_obj in enumerate(reply):
+		if rpc.response_is_error(resp_obj):
+			raise RPCFetchError('JSON-RPC: error at height %i: %s' % (height+x, resp_obj['error']))
+		assert(resp_obj['id'] == x) # assume replies are in-sequence
+		if settings['rev_hash_bytes'] == 'true':
+			resp_obj['result'] = hex_switchEndian(resp_obj['result'])
+		hashes.append(resp_obj['result'])
+	return hashes
+
+def hash_fetch_worker(settings, max_height, jobs, results):
+	"""Fetch batches of hashes over one RPC connection until told to stop."""
+	rpc = get_rpc(settings)
+	while True:
+		height = jobs.get()
+		if height is None:
+			return
+		try:
+			num_blocks = min(max_height+1-height, settings['rpc_batch_size'])
+			results.put((height, fetch_block_hashes(rpc, settings, height, num_blocks), None))
+		except Exception as e:
+			results.put((height, None, e))
+
+def iter_block_hashes(settings, min_height, max_height):
+	"""Yield the hashes of the blocks from min_height to max_height, inclusive.
+
+	Batches of rpc_batch_size calls are fetched over rpc_connections
+	connections at once. Up to two batches per connection are requested
+	ahead of the one that is being output, and batches that arrive early
+	wait in a reorder buffer, so memory use stays bounded however long the
+	chain is."""
+	batch_size = settings['rpc_batch_size']
+	batches = iter(range(min_height, max_height+1, batch_size))
+	jobs = queue.Queue()
+	results = queue.Queue()
+	workers = []
+	for i in range(settings['rpc_connections']):
+		worker = threading.Thread(target=hash_fetch_worker, args=(settings, max_height, jobs, results))
+		worker.daemon = True
+		worker.start()
+		workers.append(worker)
+
+	try:
+		for i in range(2 * settings['rpc_connections']):
+			height = next(batches, None)
+			if height is not None:
+				jobs.put(height)
+
+		pending = {}
+		height = min_height
+		while height < max_height+1:
+			while height not in pending:
+				(batch_height, hashes, error) = results.get()
+				if error is not None:
+					print(error, file=sys.stderr)
+					exit(1)
+				pending[batch_height] = hashes
+			hashes = pending.pop(height)
+			next_batch = next(batches, None)
+			if next_batch is not None:
+				jobs.put(next_batch)
+			for blkhash in hashes:
+				yield blkhash
+			height += len(hashes)
+	finally:
+		# Drop any batches that were not started, eg when the caller stops early
+		try:
+			while True:
+				jobs.get_nowait()
+		except queue.Empty:
+			pass
+		for worker in workers:
+			jobs.put(None)
+
+def get_block_hashes(settings):
+	for blkhash in iter_block_hashes(settings, settings['min_height'], settings['max_height']):
+		print(blkhash)
+
+def append_block_hashes(settings):
+	"""Bring the hash list file up to date with the node.
+
+	The last reorg_check_depth hashes of the existing list are compared with
+	the node's chain. Hashes after a fork point are dropped, and only the new
+	hashes are fetched. The file is appended to unless there was a reorg, in
+	which case it is rewritten."""
+	fname = settings['hashlist']
+	old = []
+	if os.path.exists(fname):
+		with open(fname, 'r') as f:
+			old = [line.rstrip() for line in f if line.strip()]
+	min_height = settings['min_height']
+	top = min_height + len(old) - 1
+
+	rpc = get_rpc(settings)
+	tip = rpc_call(rpc, 'getblockcount')
+	max_height = tip if settings['max_height'] < 0 else min(settings['max_height'], tip)
+
+	# Find the first height at which the old list and the node disagree
+	fork = min_height + len(old)
+	check_low = max(min_height, top - settings['reorg_check_depth'] + 1)
+	check_high = min(top, tip)
+	for height, blkhash in enumerate(iter_block_hashes(settings, check_low, check_high), check_low):
+		if blkhash != old[height - min_height]:
+			fork = height
+			break
+	else:
+		if check_high < top:
+			# The node's chain is shorter than the old list
+			fork = check_high + 1
+	if fork <= check_low and check_low > min_height:
+		print('Hash list diverges from the node at least %i blocks deep (reorg_check_depth), '
+		      'regenerate it without --append' % settings['reorg_check_depth'], file=sys.stderr)
+		exit(1)
+
+	if fork < min_height + len(old):
+		print('Reorg: dropping %i hashes from height %i' % (min_height + len(old) - fork, fork), file=sys.stderr)
+		tmpname = fname + '.tmp'
+		with open(tmpname, 'w') as f:
+			for blkhash in old[:fork - min_height]:
+				f.write(blkhash + '\n')
+			count = write_block_hashes(f, settings, fork, max_height)
+		os.rename(tmpname, fname)
+	else:
+		with open(fname, 'a') as f:
+			count = write_block_hashes(f, settings, fork, max_height)
+	print('Appended %i hashes, hash list ends at height %i' % (count, fork + count - 1),
+	      file=sys.stderr)
+
+def write_block_hashes(f, settings, min_height, max_height):
+	count = 0
+	for blkhash in iter_block_hashes(settings, min_height, max_height):
+		f.write(blkhash + '\n')
+		count += 1
+	f.flush()
+	os.fsync(f.fileno())
+	return count
+
+def calc_hdr_hash(blk_hdr):
+	hash1 = hashlib.sha256()
+	hash1.update(blk_hdr)
+	hash1_o = hash1.digest()
+
+	hash2 = hashlib.sha256()
+	hash2.update(hash1_o)
+	hash2_o = hash2.digest()
+
+	return hash2_o
+
+# Per block, scan_headers() returns the block hash, the previous block hash
+# and nBits, packed into HEADER_RECORD_SIZE bytes.
+HEADER_RECORD_SIZE = 32 + 32 + 4
+
+def scan_headers(args):
+	"""Extract the headers of the blocks in one blkNNNNN.dat file.
+
+	Runs in a worker process. Returns (fn, records, error), where records
+	holds one packed record per block, and error is None or a message
+	describing why the scan of the file stopped early."""
+	(fn, fname, netmagic) = args
+	records = []
+	with open(fname, "rb") as f:
+		fsize = os.fstat(f.fileno()).st_size
+		if fsize == 0:
+			return (fn, b'', None)
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			pos = 0
+			while pos + 8 + 80 <= fsize:
+				inMagic = data[pos:pos+4]
+				if inMagic == b"\0\0\0\0":
+					# Preallocated, unused space at the end of the file
+					break
+				if inMagic != netmagic:
+					return (fn, b''.join(records), "Invalid magic: " + hexlify(inMagic).decode('utf-8'))
+				inLen = struct.unpack("<I", data[pos+4:pos+8])[0]
+				if pos + 8 + inLen > fsize:
+					return (fn, b''.join(records), "Truncated block at offset %i" % pos)
+				blk_hdr = data[pos+8:pos+8+80]
+				records.append(calc_hdr_hash(blk_hdr))
+				records.append(blk_hdr[4:36])
+				records.append(blk_hdr[72:76])
+				pos += 8 + inLen
+		finally:
+			data.close()
+	return (fn, b''.join(records), None)
+
+def bits_to_work(nBits):
+	"""Return the expected number of hashes for a block with target nBits."""
+	size = nBits >> 24
+	word = nBits & 0x007fffff
+	if size <= 3:
+		target = word >> (8 * (3 - size))
+	else:
+		target = word << (8 * (size - 3))
+	if target == 0 or (nBits & 0x00800000) or target >> 256:
+		return 0
+	return (1 << 256) // (target + 1)
+
+class HeaderTree:
+	"""All block headers found in the block files, indexed by position.
+
+	Hashes are kept in one bytearray and the tree links and nBits in arrays,
+	so that a few million headers fit in memory comfortably."""
+	def __init__(self):
+		self.hashes = bytearray()
+		self.prevs = bytearray()
+		self.bits = array('I')
+		self.index = {}
+
+	def __len__(self):
+		return len(self.bits)
+
+	def add(self, records):
+		for pos in range(0, len(records), HEADER_RECORD_SIZE):
+			blkhash = bytes(records[pos:pos+32])
+			if blkhash in self.index:
+				continue
+			self.index[blkhash] = len(self.bits)
+			self.hashes += blkhash
+			self.prevs += records[pos+32:pos+64]
+			self.bits.append(struct.unpack("<I", records[pos+64:pos+68])[0])
+
+	def hash_hex(self, i):
+		return hexlify(bytes(self.hashes[32*i:32*i+32])[::-1]).decode('utf-8')
+
+	def best_chain(self):
+		"""Return the indices of the blocks on the most-work chain, by height.
+
+		Blocks whose ancestors are not all present are ignored. Of chains with
+		equal work, the one whose tip was found first wins."""
+		n = len(self.bits)
+		null_hash = b'\0' * 32
+		parents = array('i', [-1]) * n
+		for i in range(n):
+			prev = bytes(self.prevs[32*i:32*i+32])
+			if prev != null_hash:
+				# Missing parents are marked -2
+				parents[i] = self.index.get(prev, -2)
+		# -1: not computed yet, -2: not connected to a genesis block
+		heights = array('i', [-1]) * n
+		chainwork = [0] * n
+		for i in range(n):
+			path = []
+			j = i
+			while j >= 0 and heights[j] == -1:
+				path.append(j)
+				j = parents[j]
+			if j == -2 or (j >= 0 and heights[j] == -2):
+				for k in path:
+					heights[k] = -2
+				continue
+			(height, work) = (-1, 0) if j == -1 else (heights[j], chainwork[j])
+			for k in reversed(path):
+				height += 1
+				work += bits_to_work(self.bits[k])
+				heights[k] = height
+				chainwork[k] = work
+
+		tip = -1
+		for i in range(n):
+			if heights[i] >= 0 and (tip < 0 or chainwork[i] > chainwork[tip]):
+				tip = i
+		chain = array('i')
+		while tip >= 0:
+			chain.append(tip)
+			tip = parents[tip]
+		chain.reverse()
+		return chain
+
+def get_block_hashes_offline(settings):
+	"""Print the hash list of the most-work chain found in the block files in
+	input, without a node."""
+	fnames = []
+	while True:
+		fname = os.path.join(settings['input'], "blk%05d.dat" % len(fnames))
+		if not os.path.exists(fname):
+			break
+		fnames.append(fname)
+	jobs = [(fn, fname, settings['netmagic']) for (fn, fname) in enumerate(fnames)]
 
-		for x,resp_obj in enumerate(reply):
-			if rpc.response_is_error(resp_obj):
-				print('JSON-RPC: error at height', height+x, ': ', resp_obj['error'], file=sys.stderr)
-				exit(1)
-			assert(resp_obj['id'] == x) # assume replies are in-sequence
-			if settings['rev_hash_bytes'] == 'true':
-				resp_obj['result'] = hex_switchEndian(resp_obj['result'])
-			print(resp_obj['result'])
+	tree = HeaderTree()
+	pool = multiprocessing.Pool(settings['scan_workers'])
+	try:
+		for (fn, records, error) in pool.imap(scan_headers, jobs):
+			tree.add(records)
+			if error is not None:
+				print("%s: %s" % (fnames[fn], error), file=sys.stderr)
+	finally:
+		pool.terminate()
+		pool.join()
 
-		height += num_blocks
+	chain = tree.best_chain()
+	print("Found %i headers in %i files, best chain height %i" % (len(tree), len(fnames), len(chain) - 1),
+	      file=sys.stderr)
+	max_height = len(chain) - 1 if settings['max_height'] < 0 else min(settings['max_height'], len(chain) - 1)
+	for height in range(settings['min_height'], max_height + 1):
+		blkhash = tree.hash_hex(chain[height])
+		if settings['rev_hash_bytes'] == 'true':
+			blkhash = hex_switchEndian(blkhash)
+		print(blkhash)
 
 def get_rpc_cookie():
 	# Open the cookie file
@@ -104,11 +416,18 @@ def get_rpc_cookie():
 		settings['rpcpassword'] = combined_split[1]
 
 if __name__ == '__main__':
-	if len(sys.argv) != 2:
-		print("Usage: linearize-hashes.py CONFIG-FILE")
+	args = sys.argv[1:]
+	append = '--append' in args
+	if append:
+		args.remove('--append')
+	offline = '--offline' in args
+	if offline:
+		args.remove('--offline')
+	if len(args) != 1 or (append and offline):
+		print("Usage: linearize-hashes.py [--append | --offline] CONFIG-FILE")
 		sys.exit(1)
 
-	f = open(sys.argv[1])
+	f = open(args[0])
 	for line in f:
 		# skip comment lines
 		m = re.search('^\s*#', line)
@@ -129,9 +448,24 @@ if __name__ == '__main__':
 	if 'min_height' not in settings:
 		settings['min_height'] = 0
 	if 'max_height' not in settings:
-		settings['max_height'] = 313000
+		# In append and offline mode, follow the tip by default
+		settings['max_height'] = -1 if append or offline else 313000
 	if 'rev_hash_bytes' not in settings:
 		settings['rev_hash_bytes'] = 'false'
+	if 'hashlist' not in settings:
+		settings['hashlist'] = 'hashlist.txt'
+	if 'reorg_check_depth' not in settings:
+		settings['reorg_check_depth'] = 100
+	if 'rpc_connections' not in settings:
+		settings['rpc_connections'] = 4
+	if 'rpc_batch_size' not in settings:
+		settings['rpc_batch_size'] = 2000
+	if 'netmagic' not in settings:
+		settings['netmagic'] = 'f9beb4d9'
+	if 'input' not in settings:
+		settings['input'] = 'input'
+	if 'scan_workers' not in settings:
+		settings['scan_workers'] = multiprocessing.cpu_count()
 
 	use_userpass = True
 	use_datadir = False
@@ -139,19 +473,33 @@ if __name__ == '__main__':
 		use_userpass = False
 	if 'datadir' in settings and not use_userpass:
 		use_datadir = True
-	if not use_userpass and not use_datadir:
-		print("Missing datadir or username and/or password in cfg file", file=stderr)
+	if not use_userpass and not use_datadir and not offline:
+		print("Missing datadir or username and/or password in cfg file", file=sys.stderr)
 		sys.exit(1)
 
 	settings['port'] = int(settings['port'])
 	settings['min_height'] = int(settings['min_height'])
 	settings['max_height'] = int(settings['max_height'])
+	settings['reorg_check_depth'] = int(settings['reorg_check_depth'])
+	settings['rpc_connections'] = int(settings['rpc_connections'])
+	settings['rpc_batch_size'] = int(settings['rpc_batch_size'])
+	settings['scan_workers'] = int(settings['scan_workers'])
+	for name in ('rpc_connections', 'rpc_batch_size', 'scan_workers'):
+		if settings[name] < 1:
+			print("%s must be at least 1" % name, file=sys.stderr)
+			sys.exit(1)
+	settings['netmagic'] = unhexlify(settings['netmagic'].encode('utf-8'))
 
 	# Force hash byte format setting to be lowercase to make comparisons easier.
 	settings['rev_hash_bytes'] = settings['rev_hash_bytes'].lower()
 
 	# Get the rpc user and pass from the cookie if the datadir is set
-	if use_datadir:
+	if use_datadir and not offline:
 		get_rpc_cookie()
 
-	get_block_hashes(settings)
+	if offline:
+		get_block_hashes_offline(settings)
+	elif append:
+		append_block_hashes(settings)
+	else:
+		get_block_hashes(settings)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Benchmark makeseeds.py on a synthetic seeder dump.
+#
+# Writes a dump of --lines random IPv4, IPv6 and onion entries and a matching
+# offline ASN table to a temporary directory, then times makeseeds.py on it
+# with --asn-table, so no network access is needed.
+#
+
+import argparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+AGENTS = ['/Satoshi:0.13.2/', '/Satoshi:0.13.1/', '/Satoshi:0.12.1/', '/Satoshi:0.11.2/', '/Satoshi:0.14.0/', '/btcd:0.12.0/']
+SERVICES = [1, 5, 9, 13, 0x40d, 0]
+ONION_CHARS = 'abcdefghijklmnopqrstuvwxyz234567'
+
+def write_dump(filename, lines, seed):
+    rand = random.Random(seed)
+    with open(filename, 'w') as f:
+        for i in range(lines):
+            r = rand.random()
+            if r < 0.75:
+                addr = '%d.%d.%d.%d:%d' % (rand.randint(1, 223), rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255), rand.choice((8333, 8333, 8333, 8334)))
+            elif r < 0.95:
+                addr = '[2001:%x:%x::%x]:8333' % (rand.getrandbits(16), rand.getrandbits(16), rand.getrandbits(16))
+            else:
+                addr = ''.join(rand.choice(ONION_CHARS) for _ in range(16)) + '.onion:8333'
+            uptime = rand.uniform(0, 100)
+            f.write('%-47s %d %11d %6.2f%% %6.2f%% %6.2f%% %6.2f%% %7.2f%% %6d %08x %5d "%s"\n' % (
+                addr, rand.randint(0, 1), 1490000000 + rand.randint(0, 1000000),
+                uptime, uptime, uptime, uptime, uptime,
+                rand.randint(300000, 460000), rand.choice(SERVICES), 70015, rand.choice(AGENTS)))
+
+def write_asn_table(filename):
+    with open(filename, 'w') as f:
+        for a in range(1, 224):
+            f.write('%d.0.0.0/8 %d\n' % (a, 100 + a))
+            for b in range(0, 256, 16):
+                f.write('%d.%d.0.0/12 %d\n' % (a, b, 1000 + a * 16 + b // 16))
+        f.write('2001::/16 64000\n')
+        for a in range(0, 65536, 64):
+            f.write('2001:%x::/26 %d\n' % (a, 70000 + a // 64))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark makeseeds.py on a synthetic seeder dump.')
+    parser.add_argument('--lines', type=int, default=5000000, help='Number of lines in the dump (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: %(default)s)')
+    parser.add_argument('--makeseeds', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'makeseeds.py'),
+                        help='makeseeds.py to benchmark (default: the one next to this script)')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='makeseeds-bench-')
+    try:
+        dump = os.path.join(tmpdir, 'seeds.txt')
+        table = os.path.join(tmpdir, 'ipasn.dat')
+        start = time.time()
+        write_dump(dump, args.lines, args.seed)
+        write_asn_table(table)
+        print('Generated %i lines (%.1f MiB) in %.1fs' % (args.lines, os.path.getsize(dump) / 1048576.0, time.time() - start))
+
+        start = time.time()
+        with open(dump) as f:
+            output = subprocess.check_output([sys.executable, args.makeseeds, '--asn-table', table], stdin=f)
+        elapsed = time.time() - start
+        maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print('makeseeds.py selected %i seeds in %.2fs (%.0f lines/s), peak RSS %.1f MiB' %
+              (len(output.splitlines()), elapsed, args.lines / elapsed, maxrss / 1024.0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
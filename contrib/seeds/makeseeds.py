@@ -12,6 +12,12 @@ MAX_SEEDS_PER_ASN=2
 
 MIN_BLOCKS = 337600
 
+# Number of concurrent DNS queries when resolving ASNs
+ASN_RESOLVER_THREADS = 16
+
+# How long resolved prefixes stay in the ASN cache, in seconds
+ASN_CACHE_TTL = 7 * 24 * 60 * 60
+
 # These are hosts that have been observed to be behaving strangely (e.g.
 # aggressively connecting to every node).
 SUSPICIOUS_HOSTS = {
@@ -22,23 +28,59 @@ SUSPICIOUS_HOSTS = {
     "54.94.195.96", "54.94.200.247"
 }
 
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import ipaddress
+import json
+import os
 import re
 import sys
-import dns.resolver
-import collections
+import time
+
+try:
+    import dns.resolver
+except ImportError:
+    # Only needed to look up ASNs over DNS, not with --asn-table
+    dns = None
 
 PATTERN_IPV4 = re.compile(r"^((\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})):(\d+)$")
 PATTERN_IPV6 = re.compile(r"^\[([0-9a-z:]+)\]:(\d+)$")
 PATTERN_ONION = re.compile(r"^([abcdefghijklmnopqrstuvwxyz234567]{16}\.onion):(\d+)$")
 PATTERN_AGENT = re.compile(r"^(/Satoshi:0.12.(0|1|99)/|/Satoshi:0.13.(0|1|2|99)/)$")
 
+# A seeder entry that passed the filters. Records sort by availability: 30-day
+# uptime, then last success, then address.
+Seed = collections.namedtuple('Seed', ['uptime', 'lastsuccess', 'ip', 'net', 'sortkey', 'port'])
+
 def parseline(line):
+    '''Parse a line of a seeder dump and apply the per-entry filters.
+
+    Returns a Seed, or None if the line is invalid or the entry is filtered
+    out. The cheap numeric checks come first, so that most rejected lines
+    are never matched against the address patterns.'''
     sline = line.split()
     if len(sline) < 11:
        return None
+    # Skip bad results.
+    if sline[1] == 0:
+        return None
+    # Require at least 50% 30-day uptime.
+    uptime30 = float(sline[7][:-1])
+    if uptime30 <= 50:
+        return None
+    # Enforce minimal number of blocks.
+    if int(sline[8]) < MIN_BLOCKS:
+        return None
+    # Require service bit 1.
+    if (int(sline[9], 16) & 1) != 1:
+        return None
+    # Require a known and recent user agent.
+    if not PATTERN_AGENT.match(sline[11][1:-1]):
+        return None
+
     m = PATTERN_IPV4.match(sline[0])
-    sortkey = None
-    ip = None
     if m is None:
         m = PATTERN_IPV6.match(sline[0])
         if m is None:
@@ -54,7 +96,10 @@ def parseline(line):
             if m.group(1) in ['::']: # Not interested in localhost
                 return None
             ipstr = m.group(1)
-            sortkey = ipstr # XXX parse IPv6 into number, could use name_to_ipv6 from generate-seeds
+            try:
+                sortkey = int(ipaddress.IPv6Address(ipstr))
+            except ValueError:
+                return None
             port = int(m.group(2))
     else:
         # Do IPv4 sanity check
@@ -69,104 +114,219 @@ def parseline(line):
         sortkey = ip
         ipstr = m.group(1)
         port = int(m.group(6))
-    # Skip bad results.
-    if sline[1] == 0:
+    # Skip entries from suspicious hosts.
+    if ipstr in SUSPICIOUS_HOSTS:
         return None
-    # Extract uptime %.
-    uptime30 = float(sline[7][:-1])
     # Extract Unix timestamp of last success.
     lastsuccess = int(sline[2])
-    # Extract protocol version.
-    version = int(sline[10])
-    # Extract user agent.
-    agent = sline[11][1:-1]
-    # Extract service flags.
-    service = int(sline[9], 16)
-    # Extract blocks.
-    blocks = int(sline[8])
-    # Construct result.
-    return {
-        'net': net,
-        'ip': ipstr,
-        'port': port,
-        'ipnum': ip,
-        'uptime': uptime30,
-        'lastsuccess': lastsuccess,
-        'version': version,
-        'agent': agent,
-        'service': service,
-        'blocks': blocks,
-        'sortkey': sortkey,
-    }
+    return Seed(uptime30, lastsuccess, ipstr, net, sortkey, port)
 
 def filtermultiport(ips):
     '''Filter out hosts with more nodes per IP'''
     hist = collections.defaultdict(list)
     for ip in ips:
-        hist[ip['sortkey']].append(ip)
+        hist[ip.sortkey].append(ip)
     return [value[0] for (key,value) in list(hist.items()) if len(value)==1]
 
+class AsnIndex(object):
+    '''Map addresses to ASNs by prefix.
+
+    Prefixes may be nested; the most specific one wins. They are flattened
+    into sorted, disjoint address ranges that are searched with bisect.
+    IPv4 and IPv6 addresses are kept in separate indexes.'''
+    def __init__(self, prefixes=()):
+        self.prefixes = {}
+        for (network, asn) in prefixes:
+            self.add(network, asn)
+        self.build()
+
+    def add(self, network, asn):
+        self.prefixes[ipaddress.ip_network(network, strict=False)] = asn
+
+    def build(self):
+        self.ranges = {4: ([], [], []), 6: ([], [], [])}
+        networks = sorted(self.prefixes, key=lambda n: (n.version, int(n.network_address), n.prefixlen))
+        for version in (4, 6):
+            (starts, ends, asns) = self.ranges[version]
+            def emit(start, end, asn):
+                if start <= end:
+                    starts.append(start)
+                    ends.append(end)
+                    asns.append(asn)
+            # Enclosing prefixes that have not ended yet, outermost first
+            stack = []
+            pos = 0
+            for network in networks:
+                if network.version != version:
+                    continue
+                start = int(network.network_address)
+                end = int(network.broadcast_address)
+                while stack and stack[-1][1] < start:
+                    (_, top_end, top_asn) = stack.pop()
+                    emit(pos, top_end, top_asn)
+                    pos = top_end + 1
+                if stack:
+                    emit(pos, start - 1, stack[-1][2])
+                stack.append((start, end, self.prefixes[network]))
+                pos = start
+            while stack:
+                (_, top_end, top_asn) = stack.pop()
+                emit(pos, top_end, top_asn)
+                pos = top_end + 1
+
+    def lookup(self, ip):
+        '''Return the ASN of an ipaddress address, or None.'''
+        (starts, ends, asns) = self.ranges[ip.version]
+        ipnum = int(ip)
+        i = bisect.bisect_right(starts, ipnum) - 1
+        if i >= 0 and ipnum <= ends[i]:
+            return asns[i]
+        return None
+
+def load_asn_table(filename):
+    '''Load a table of "<prefix> <ASN>" lines, eg from pyasn_util_convert.py.'''
+    prefixes = []
+    with open(filename) as f:
+        for line in f:
+            sline = line.split()
+            if not sline or sline[0].startswith(('#', ';')):
+                continue
+            prefixes.append((sline[0], int(sline[1].upper().lstrip('AS'))))
+    return AsnIndex(prefixes)
+
+def query_asn(ip):
+    '''Look up the origin ASN and announced prefix of an address at Team Cymru.'''
+    if ip.version == 4:
+        name = '.'.join(reversed(str(ip).split('.'))) + '.origin.asn.cymru.com'
+    else:
+        # The first 64 bits are enough to find the prefix
+        name = '.'.join(reversed(ip.exploded.replace(':', '')[:16])) + '.origin6.asn.cymru.com'
+    answer = [x.to_text() for x in dns.resolver.query(name, 'TXT').response.answer][0]
+    # "<ASN> | <prefix> | <country> | <registry> | <date>"
+    fields = answer.split('"')[1].split('|')
+    return (int(fields[0].split(' ')[0]), fields[1].strip())
+
+class AsnResolver(object):
+    '''Resolve ASNs from an offline table, or from DNS with a persistent cache.
+
+    The cache stores the prefix of every answer, so later lookups of any
+    address in the same prefix are answered from the cache.'''
+    def __init__(self, table=None, cache_file=None, cache_ttl=ASN_CACHE_TTL, threads=ASN_RESOLVER_THREADS):
+        self.table = table
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
+        self.threads = threads
+        self.cache_entries = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                now = time.time()
+                for (prefix, asn, expires) in json.load(f):
+                    if expires > now:
+                        self.cache_entries[prefix] = (asn, expires)
+        self.cache = AsnIndex((prefix, asn) for (prefix, (asn, _)) in self.cache_entries.items())
+
+    def lookup(self, ip):
+        if self.table is not None:
+            return self.table.lookup(ip)
+        return self.cache.lookup(ip)
+
+    def resolve(self, ipstrs):
+        '''Return a dict of ASNs by address; unresolvable addresses are left out.'''
+        result = {}
+        pending = []
+        for ipstr in ipstrs:
+            ip = ipaddress.ip_address(ipstr)
+            asn = self.lookup(ip)
+            if asn is not None:
+                result[ipstr] = asn
+            elif self.table is None:
+                pending.append((ipstr, ip))
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(self.threads) as executor:
+                futures = [(ipstr, executor.submit(query_asn, ip)) for (ipstr, ip) in pending]
+            expires = time.time() + self.cache_ttl
+            for (ipstr, future) in futures:
+                try:
+                    (asn, prefix) = future.result()
+                except Exception:
+                    continue
+                result[ipstr] = asn
+                self.cache.add(prefix, asn)
+                self.cache_entries[prefix] = (asn, expires)
+            self.cache.build()
+        return result
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        tmpname = self.cache_file + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump([(prefix, asn, expires) for (prefix, (asn, expires)) in sorted(self.cache_entries.items())], f)
+        os.replace(tmpname, self.cache_file)
+
 # Based on Greg Maxwell's seed_filter.py
-def filterbyasn(ips, max_per_asn, max_total):
+def filterbyasn(ips, max_per_asn, max_total, resolver):
     # Sift out ips by type
-    ips_ipv4 = [ip for ip in ips if ip['net'] == 'ipv4']
-    ips_ipv6 = [ip for ip in ips if ip['net'] == 'ipv6']
-    ips_onion = [ip for ip in ips if ip['net'] == 'onion']
+    ips_ipv46 = [ip for ip in ips if ip.net in ['ipv4', 'ipv6']]
+    ips_onion = [ip for ip in ips if ip.net == 'onion']
 
-    # Filter IPv4 by ASN
+    # Filter IPv4 and IPv6 by ASN, resolving a chunk of addresses at a time
     result = []
     asn_count = {}
-    for ip in ips_ipv4:
+    chunk_size = resolver.threads * 4
+    for chunk_start in range(0, len(ips_ipv46), chunk_size):
         if len(result) == max_total:
             break
-        try:
-            asn = int([x.to_text() for x in dns.resolver.query('.'.join(reversed(ip['ip'].split('.'))) + '.origin.asn.cymru.com', 'TXT').response.answer][0].split('\"')[1].split(' ')[0])
+        chunk = ips_ipv46[chunk_start:chunk_start + chunk_size]
+        asns = resolver.resolve(ip.ip for ip in chunk)
+        for ip in chunk:
+            if len(result) == max_total:
+                break
+            asn = asns.get(ip.ip)
+            if asn is None:
+                sys.stderr.write('ERR: Could not resolve ASN for "' + ip.ip + '"\n')
+                continue
             if asn not in asn_count:
                 asn_count[asn] = 0
             if asn_count[asn] == max_per_asn:
                 continue
             asn_count[asn] += 1
             result.append(ip)
-        except:
-            sys.stderr.write('ERR: Could not resolve ASN for "' + ip['ip'] + '"\n')
-
-    # TODO: filter IPv6 by ASN
 
-    # Add back non-IPv4
-    result.extend(ips_ipv6)
+    # Add back Onions
     result.extend(ips_onion)
     return result
 
 def main():
-    lines = sys.stdin.readlines()
-    ips = [parseline(line) for line in lines]
+    parser = argparse.ArgumentParser(description='Generate a seeds list from a DNS seeder dump on stdin.')
+    parser.add_argument('--asn-table', help='Resolve ASNs offline from a file of "<prefix> <ASN>" lines')
+    parser.add_argument('--asn-cache', help='Cache ASN lookups in this file across runs')
+    parser.add_argument('--asn-cache-ttl', type=int, default=ASN_CACHE_TTL, help='Seconds before cached ASNs are looked up again (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=ASN_RESOLVER_THREADS, help='Number of concurrent ASN lookups (default: %(default)s)')
+    args = parser.parse_args()
+    if args.asn_table is None and dns is None:
+        sys.stderr.write('ERR: dnspython is needed to look up ASNs, install it or pass --asn-table\n')
+        sys.exit(1)
+    table = load_asn_table(args.asn_table) if args.asn_table else None
+    resolver = AsnResolver(table, args.asn_cache, args.asn_cache_ttl, args.threads)
 
-    # Skip entries with valid address.
-    ips = [ip for ip in ips if ip is not None]
-    # Skip entries from suspicious hosts.
-    ips = [ip for ip in ips if ip['ip'] not in SUSPICIOUS_HOSTS]
-    # Enforce minimal number of blocks.
-    ips = [ip for ip in ips if ip['blocks'] >= MIN_BLOCKS]
-    # Require service bit 1.
-    ips = [ip for ip in ips if (ip['service'] & 1) == 1]
-    # Require at least 50% 30-day uptime.
-    ips = [ip for ip in ips if ip['uptime'] > 50]
-    # Require a known and recent user agent.
-    ips = [ip for ip in ips if PATTERN_AGENT.match(ip['agent'])]
+    # Parse and filter the dump in one pass, keeping only the entries that pass.
+    ips = [ip for ip in map(parseline, sys.stdin) if ip is not None]
     # Sort by availability (and use last success as tie breaker)
-    ips.sort(key=lambda x: (x['uptime'], x['lastsuccess'], x['ip']), reverse=True)
+    ips.sort(reverse=True)
     # Filter out hosts with multiple bitcoin ports, these are likely abusive
     ips = filtermultiport(ips)
     # Look up ASNs and limit results, both per ASN and globally.
-    ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS)
+    ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS, resolver)
+    resolver.save()
     # Sort the results by IP address (for deterministic output).
-    ips.sort(key=lambda x: (x['net'], x['sortkey']))
+    ips.sort(key=lambda x: (x.net, x.sortkey))
 
     for ip in ips:
-        if ip['net'] == 'ipv6':
-            print('[%s]:%i' % (ip['ip'], ip['port']))
+        if ip.net == 'ipv6':
+            print('[%s]:%i' % (ip.ip, ip.port))
         else:
-            print('%s:%i' % (ip['ip'], ip['port']))
+            print('%s:%i' % (ip.ip, ip.port))
 
 if __name__ == '__main__':
     main()
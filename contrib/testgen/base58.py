@@ -7,6 +7,7 @@ Bitcoin base58 encoding and decoding.
 Based on https://bitcointalk.org/index.php?topic=1026.0 (public domain)
 '''
 import hashlib
+from binascii import a2b_hex, b2a_hex
 
 # for compatibility with following code...
 class SHA256:
@@ -16,56 +17,63 @@ if str != bytes:
     # Python 3.x
     def ord(c):
         return c
-    def chr(n):
-        return bytes( (n,) )
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 __b58base = len(__b58chars)
 b58chars = __b58chars
 
+# Numbers are converted 10 digits at a time (58**10 < 2**63), and every
+# chunk is converted two digits at a time with these lookup tables, like
+# test/functional/test_framework/address.py does.
+__pairs = [a + b for a in __b58chars for b in __b58chars]
+__pair_values = dict((p, i) for (i, p) in enumerate(__pairs))
+__pair_base = len(__pairs)
+__chunk_digits = 10
+__chunk_base = __b58base ** __chunk_digits
+
 def b58encode(v):
     """ encode v, which is a string of bytes, to base58.
     """
-    long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256**i) * ord(c)
-
-    result = ''
-    while long_value >= __b58base:
-        div, mod = divmod(long_value, __b58base)
-        result = __b58chars[mod] + result
-        long_value = div
-    result = __b58chars[long_value] + result
-
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0': nPad += 1
-        else: break
+    stripped = v.lstrip(b'\0')
+    nPad = len(v) - len(stripped)
+    if not stripped:
+        return __b58chars[0] * nPad
+
+    long_value = int(b2a_hex(stripped), 16)
+    pairs = []
+    while long_value:
+        long_value, chunk = divmod(long_value, __chunk_base)
+        for _ in range(__chunk_digits // 2):
+            chunk, pair = divmod(chunk, __pair_base)
+            pairs.append(__pairs[pair])
+    result = ''.join(reversed(pairs)).lstrip(__b58chars[0])
 
     return (__b58chars[0]*nPad) + result
 
 def b58decode(v, length = None):
     """ decode v into a string of len bytes
     """
+    stripped = v.lstrip(__b58chars[0])
+    nPad = len(v) - len(stripped)
+
+    # Leading 1s are zeros, so pad to a whole number of chunks with them
+    stripped = __b58chars[0] * (-len(stripped) % __chunk_digits) + stripped
     long_value = 0
-    for (i, c) in enumerate(v[::-1]):
-        long_value += __b58chars.find(c) * (__b58base**i)
-
-    result = bytes()
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-
-    nPad = 0
-    for c in v:
-        if c == __b58chars[0]: nPad += 1
-        else: break
-
-    result = chr(0)*nPad + result
+    try:
+        for i in range(0, len(stripped), __chunk_digits):
+            chunk = 0
+            for j in range(i, i + __chunk_digits, 2):
+                chunk = chunk * __pair_base + __pair_values[stripped[j:j+2]]
+            long_value = long_value * __chunk_base + chunk
+    except KeyError: # not a base58 character
+        return None
+
+    result = b'\0' * nPad
+    if long_value:
+        hex_value = '%x' % long_value
+        result += a2b_hex('0' * (len(hex_value) % 2) + hex_value)
     if length is not None and len(result) != length:
         return None
 
@@ -97,10 +105,19 @@ def get_bcaddress_version(strAddress):
     return ord(version)
 
 if __name__ == '__main__':
+    import os
     # Test case (from http://gitorious.org/bitcoin/python-base58.git)
     assert get_bcaddress_version('15VjRaDX9zpbA8LVnbrCAFzrVzN7ixHNsC') is 0
     _ohai = 'o hai'.encode('ascii')
     _tmp = b58encode(_ohai)
     assert _tmp == 'DYB3oMS'
     assert b58decode(_tmp, 5) == _ohai
+    # leading zeros, and the empty string
+    assert b58encode(b'\0\0\x01') == '112'
+    assert b58decode('112') == b'\0\0\x01'
+    assert b58encode(b'') == '' and b58decode('') == b''
+    assert b58decode('0OIl') is None
+    _values = [os.urandom(n) for n in range(40)] + [b'\0' * n + os.urandom(21) for n in range(3)]
+    assert [b58decode(b58encode(x)) for x in _values] == _values
+    assert [b58decode_chk(b58encode_chk(x)) for x in _values] == _values
     print("Tests passed")
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+    Reusable asyncio consumer for bitcoind's ZMQ notifications.
+
+    Unlike the zmq_sub.py example, which schedules one coroutine per message,
+    ZMQConsumer receives messages in batches: it waits for one message and
+    then takes whatever else is already queued in the socket, up to
+    batch_size, without going back to the event loop. Batches are passed to
+    a dispatcher through a bounded queue. When the handlers fall behind, the
+    queue fills up and the receiver stops reading, so messages pile up in
+    the socket until bitcoind's high-water mark drops them. Dropped messages
+    show up as gaps in the per-topic sequence numbers, which are counted and
+    reported to the gap handlers.
+
+    Handlers get a Notification. Its raw bytes are always available, and
+    `block` and `tx` decode rawblock and rawtx bodies with the p2p
+    deserializers in test/functional/test_framework/mininode.py, the first
+    time they are accessed. Blocks are CLazyBlocks, so their transactions
+    are only deserialized when used.
+
+    Example:
+
+        consumer = ZMQConsumer("tcp://127.0.0.1:28332", ["rawblock", "hashtx"])
+        consumer.add_handler("rawblock", lambda n: print(n.sequence, n.hash))
+        asyncio.get_event_loop().run_until_complete(consumer.run())
+
+    Handlers may be plain functions or coroutine functions; coroutines are
+    awaited before the next notification is dispatched. Run this file
+    directly to print a line per notification and the statistics every few
+    seconds.
+"""
+
+import asyncio
+import binascii
+from collections import defaultdict
+import hashlib
+import importlib
+from io import BytesIO
+import os
+import struct
+import sys
+import time
+
+import zmq
+import zmq.asyncio
+
+if not (sys.version_info.major >= 3 and sys.version_info.minor >= 5):
+    print("This library only works with Python 3.5 and greater")
+    exit(1)
+
+TOPICS = ("hashblock", "hashtx", "rawblock", "rawtx")
+
+def test_framework(name):
+    """Import a test_framework module, from the source tree if needed."""
+    try:
+        return importlib.import_module("test_framework." + name)
+    except ImportError:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "test", "functional"))
+        return importlib.import_module("test_framework." + name)
+
+def mininode():
+    return test_framework("mininode")
+
+class Notification():
+    """One ZMQ notification, decoded on demand."""
+    __slots__ = ("topic", "body", "sequence", "received", "missed", "backfilled", "_decoded")
+
+    def __init__(self, topic, body, sequence, received, backfilled=False):
+        self.topic = topic
+        self.body = body
+        self.sequence = sequence
+        self.received = received
+        # Number of messages of this topic lost right before this one
+        self.missed = 0
+        # Recovered from another source instead of received over ZMQ
+        self.backfilled = backfilled
+        self._decoded = None
+
+    @property
+    def hash(self):
+        """The block or transaction hash as a hex string."""
+        if self.topic in ("hashblock", "hashtx"):
+            return binascii.hexlify(self.body).decode("ascii")
+        if self.topic == "rawblock":
+            header_hash = hashlib.sha256(hashlib.sha256(self.body[:80]).digest()).digest()
+            return binascii.hexlify(header_hash[::-1]).decode("ascii")
+        tx = self.tx
+        tx.calc_sha256()
+        return tx.hash
+
+    @property
+    def block(self):
+        """The rawblock body as a mininode CLazyBlock."""
+        if self.topic != "rawblock":
+            raise AttributeError("%s notification has no block" % self.topic)
+        if self._decoded is None:
+            block = mininode().CLazyBlock()
+            block.deserialize(BytesIO(self.body))
+            self._decoded = block
+        return self._decoded
+
+    @property
+    def tx(self):
+        """The rawtx body as a mininode CTransaction."""
+        if self.topic != "rawtx":
+            raise AttributeError("%s notification has no tx" % self.topic)
+        if self._decoded is None:
+            tx = mininode().CTransaction()
+            tx.deserialize(BytesIO(self.body))
+            self._decoded = tx
+        return self._decoded
+
+    def __repr__(self):
+        return "Notification(%s, seq=%s, %d bytes)" % (self.topic, self.sequence, len(self.body))
+
+class TopicStats():
+    __slots__ = ("messages", "bytes", "gaps", "missed", "last_sequence")
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.gaps = 0
+        self.missed = 0
+        self.last_sequence = None
+
+class ZMQConsumer():
+    """Receive, sequence-check and dispatch the notifications of one publisher."""
+
+    def __init__(self, address, topics=TOPICS, batch_size=256, queue_size=64, context=None, rcvhwm=None):
+        self.address = address
+        self.topics = [topic.encode("ascii") if isinstance(topic, str) else topic for topic in topics]
+        self.batch_size = batch_size
+        self.context = context or zmq.asyncio.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        if rcvhwm is not None:
+            self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        for topic in self.topics:
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+        self.socket.connect(address)
+        self.queue = asyncio.Queue(queue_size)
+        self.handlers = defaultdict(list)
+        self.gap_handlers = []
+        self.topic_stats = defaultdict(TopicStats)
+        self.batches = 0
+        self.max_queued = 0
+        self.dispatched = 0
+        self.handler_time = 0.0
+        self.start_time = None
+        self.last_received = None
+        self.running = False
+
+    def add_handler(self, topic, handler):
+        """Call handler(notification) for every notification of topic."""
+        self.handlers[topic].append(handler)
+
+    def add_gap_handler(self, handler):
+        """Call handler(notification) when messages of a topic were lost,
+        before dispatching the notification that came after them.
+        notification.missed is the number of lost messages."""
+        self.gap_handlers.append(handler)
+
+    def _track(self, msg, now):
+        topic = msg[0].decode("ascii")
+        body = msg[1]
+        sequence = None
+        if len(msg) > 2 and len(msg[-1]) == 4:
+            sequence = struct.unpack("<I", msg[-1])[-1]
+        notification = Notification(topic, body, sequence, now)
+        stats = self.topic_stats[topic]
+        stats.messages += 1
+        stats.bytes += len(body)
+        if sequence is not None:
+            if stats.last_sequence is not None:
+                missed = (sequence - stats.last_sequence - 1) & 0xffffffff
+                if missed:
+                    stats.gaps += 1
+                    stats.missed += missed
+                    notification.missed = missed
+            stats.last_sequence = sequence
+        return notification
+
+    async def _receive(self):
+        while self.running:
+            msg = await self.socket.recv_multipart()
+            now = self.last_received = time.time()
+            batch = [self._track(msg, now)]
+            while len(batch) < self.batch_size:
+                try:
+                    msg = self.socket.recv_multipart(zmq.NOBLOCK).result()
+                except zmq.Again:
+                    break
+                batch.append(self._track(msg, now))
+            self.batches += 1
+            # Blocks while the dispatcher is behind, which is the backpressure
+            await self.queue.put(batch)
+            self.max_queued = max(self.max_queued, self.queue.qsize())
+
+    async def _dispatch(self):
+        while True:
+            batch = await self.queue.get()
+            if batch is None:
+                return
+            start = time.time()
+            for notification in batch:
+                if notification.missed:
+                    for handler in self.gap_handlers:
+                        result = handler(notification)
+                        if asyncio.iscoroutine(result):
+                            await result
+                await self.deliver(notification)
+            self.dispatched += len(batch)
+            self.handler_time += time.time() - start
+
+    async def deliver(self, notification):
+        """Run the handlers of notification's topic on it."""
+        for handler in self.handlers.get(notification.topic, ()):
+            result = handler(notification)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def run(self):
+        """Consume notifications until stop() is called."""
+        self.running = True
+        self.start_time = time.time()
+        dispatcher = asyncio.ensure_future(self._dispatch())
+        receiver = asyncio.ensure_future(self._receive())
+        self._receiver = receiver
+        try:
+            await receiver
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Let the dispatcher finish what was received
+            await self.queue.put(None)
+            await dispatcher
+
+    def stop(self):
+        self.running = False
+        if getattr(self, "_receiver", None) is not None:
+            self._receiver.cancel()
+
+    def close(self):
+        self.socket.close(linger=0)
+
+    def stats(self):
+        """Return throughput and gap statistics, overall and per topic."""
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        messages = sum(s.messages for s in self.topic_stats.values())
+        return {
+            "elapsed": elapsed,
+            "messages": messages,
+            "dispatched": self.dispatched,
+            "messages_per_second": messages / elapsed if elapsed else 0.0,
+            "batches": self.batches,
+            "mean_batch": messages / self.batches if self.batches else 0.0,
+            "max_queued_batches": self.max_queued,
+            "handler_seconds": self.handler_time,
+            "topics": {
+                topic: {
+                    "messages": s.messages,
+                    "bytes": s.bytes,
+                    "gaps": s.gaps,
+                    "missed": s.missed,
+                    "last_sequence": s.last_sequence,
+                } for (topic, s) in self.topic_stats.items()
+            },
+        }
+
+    def format_stats(self):
+        stats = self.stats()
+        lines = ["%d messages in %.1fs (%.0f/s), %d batches (mean %.1f), handlers busy %.1fs" % (
+            stats["messages"], stats["elapsed"], stats["messages_per_second"],
+            stats["batches"], stats["mean_batch"], stats["handler_seconds"])]
+        for topic, s in sorted(stats["topics"].items()):
+            lines.append("  %-10s %8d msgs %12d bytes %6d gaps %8d missed" % (topic, s["messages"], s["bytes"], s["gaps"], s["missed"]))
+        return "\n".join(lines)
+
+if __name__ == "__main__":
+    import signal
+    port = 28332
+    consumer = ZMQConsumer("tcp://127.0.0.1:%i" % port)
+
+    def show(notification):
+        print("- %s (%s) - %s" % (notification.topic.upper(), notification.sequence, notification.hash))
+
+    def show_gap(notification):
+        print("- %s: missed %d messages before %d -" % (notification.topic.upper(), notification.missed, notification.sequence))
+
+    for topic in TOPICS:
+        consumer.add_handler(topic, show)
+    consumer.add_gap_handler(show_gap)
+
+    async def report():
+        while True:
+            await asyncio.sleep(10)
+            print(consumer.format_stats())
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, consumer.stop)
+    reporter = asyncio.ensure_future(report())
+    loop.run_until_complete(consumer.run())
+    reporter.cancel()
+    print(consumer.format_stats())
+    consumer.close()
@@ -2,18 +2,31 @@
 """Combine logs from multiple bitcoin nodes as well as the test_framework log.
 
 This streams the combined log output to stdout. Use combine_logs.py > outputfile
-to write to an outputfile."""
+to write to an outputfile.
+
+--since and --until select a time range, as a full or truncated timestamp
+(eg "2017-05-01 13:10"). To read only the part of each log that can contain
+the range, the byte offset of the first event of every second is kept in an
+index file next to each log (<logfile>.idx). The index is built the first time
+it is needed and extended when the log has grown since. Timestamps don't have
+to increase (they go back with setmocktime), events outside the range are
+skipped wherever they are."""
 
 import argparse
 from collections import defaultdict, namedtuple
 import heapq
 import itertools
+import json
 import os
 import re
 import sys
 
 # Matches on the date format at the start of the log event
 TIMESTAMP_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}")
+TIMESTAMP_PATTERN_BYTES = re.compile(TIMESTAMP_PATTERN.pattern.encode('ascii'))
+
+# Index buckets are timestamps truncated to the second
+BUCKET_LENGTH = len("2017-01-01 00:00:00")
 
 LogEvent = namedtuple('LogEvent', ['timestamp', 'source', 'event'])
 
@@ -23,6 +36,10 @@ def main():
     parser = argparse.ArgumentParser(usage='%(prog)s [options] <test temporary directory>', description=__doc__)
     parser.add_argument('-c', '--color', dest='color', action='store_true', help='outputs the combined log with events colored by source (requires posix terminal colors. Use less -r for viewing)')
     parser.add_argument('--html', dest='html', action='store_true', help='outputs the combined log as html. Requires jinja2. pip install jinja2')
+    parser.add_argument('--since', dest='since', help='only output events at or after this timestamp, eg "2017-05-01 13:10:05"')
+    parser.add_argument('--until', dest='until', help='only output events up to this timestamp; a truncated timestamp includes the whole minute, second, etc')
+    parser.add_argument('--source', dest='sources', action='append', help='only output events from this source (test, node0, ...). Can be given multiple times')
+    parser.add_argument('--grep', dest='grep', help='only output events matching this regular expression')
     args, unknown_args = parser.parse_known_args()
 
     if args.color and os.name != 'posix':
@@ -38,11 +55,12 @@ def main():
         print("Unexpected arguments" + str(unknown_args))
         sys.exit(1)
 
-    log_events = read_logs(unknown_args[0])
+    grep = re.compile(args.grep) if args.grep else None
+    log_events = read_logs(unknown_args[0], since=args.since, until=args.until, sources=args.sources, grep=grep)
 
     print_logs(log_events, color=args.color, html=args.html)
 
-def read_logs(tmp_dir):
+def read_logs(tmp_dir, since=None, until=None, sources=None, grep=None):
     """Reads log files.
 
     Delegates to generator function get_log_events() to provide individual log events
@@ -54,26 +72,105 @@ def read_logs(tmp_dir):
         if not os.path.isfile(logfile):
             break
         files.append(("node%d" % i, logfile))
+    if sources:
+        files = [(source, f) for source, f in files if source in sources]
 
-    return heapq.merge(*[get_log_events(source, f) for source, f in files])
+    return heapq.merge(*[get_log_events(source, f, since, until, grep) for source, f in files])
 
-def get_log_events(source, logfile):
+def update_index(logfile):
+    """Return the index of a log file as a sorted list of (second, offset) pairs.
+
+    offset is the position of the first event logged in that second. Only
+    the part of the log that was added since the index was last saved is
+    read."""
+    index_file = logfile + ".idx"
+    size = os.path.getsize(logfile)
+    index = {"end": 0, "buckets": []}
+    try:
+        with open(index_file, 'r') as f:
+            saved = json.load(f)
+        # Logs are only appended to; start over if this one was replaced
+        if saved["end"] <= size:
+            index = saved
+    except (IOError, ValueError, KeyError):
+        pass
+    if index["end"] < size:
+        buckets = index["buckets"]
+        last_bucket = buckets[-1][0] if buckets else None
+        offset = index["end"]
+        with open(logfile, 'rb') as infile:
+            infile.seek(offset)
+            for line in infile:
+                if not line.endswith(b"\n"):
+                    # Leave a partially written line for the next update
+                    break
+                time_match = TIMESTAMP_PATTERN_BYTES.match(line)
+                if time_match:
+                    bucket = time_match.group()[:BUCKET_LENGTH].decode('ascii')
+                    if bucket != last_bucket:
+                        buckets.append([bucket, offset])
+                        last_bucket = bucket
+                offset += len(line)
+        index["end"] = offset
+        try:
+            with open(index_file, 'w') as f:
+                json.dump(index, f)
+        except IOError:
+            # Read-only log directory, the index is only used for this run
+            pass
+    return index["buckets"]
+
+def start_offset(buckets, since):
+    """Return the offset of the first event that could be at or after since, or None if there is none."""
+    for bucket, offset in buckets:
+        if bucket >= since[:BUCKET_LENGTH]:
+            return offset
+    return None
+
+def stop_offset(buckets, until):
+    """Return the offset after which no event can be at or before until, or None to read to the end."""
+    last = -1
+    for i, (bucket, offset) in enumerate(buckets):
+        if bucket[:len(until)] <= until:
+            last = i
+    if last + 1 < len(buckets):
+        return buckets[last + 1][1]
+    return None
+
+def get_log_events(source, logfile, since=None, until=None, grep=None):
     """Generator function that returns individual log events.
 
     Log events may be split over multiple lines. We use the timestamp
-    regex match as the marker for a new log event."""
+    regex match as the marker for a new log event. Only events between
+    since and until, and that match grep if given, are returned."""
     try:
-        with open(logfile, 'r') as infile:
+        with open(logfile, 'rb') as infile:
+            offset = 0
+            stop = None
+            if since or until:
+                buckets = update_index(logfile)
+                if since:
+                    offset = start_offset(buckets, since)
+                    if offset is None:
+                        return
+                if until:
+                    stop = stop_offset(buckets, until)
+            infile.seek(offset)
             event = ''
             timestamp = ''
             for line in infile:
+                if stop is not None and offset >= stop:
+                    # The rest of the log is after the range
+                    break
+                offset += len(line)
+                line = line.decode('utf-8', 'replace')
                 # skip blank lines
                 if line == '\n':
                     continue
                 # if this line has a timestamp, it's the start of a new log event.
                 time_match = TIMESTAMP_PATTERN.match(line)
                 if time_match:
-                    if event:
+                    if event and event_selected(timestamp, event, since, until, grep):
                         yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
                     event = line
                     timestamp = time_match.group()
@@ -81,10 +178,18 @@ def get_log_events(source, logfile):
                 else:
                     event += "\n" + line
             # Flush the final event
-            yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
+            if event and event_selected(timestamp, event, since, until, grep):
+                yield LogEvent(timestamp=timestamp, source=source, event=event.rstrip())
     except FileNotFoundError:
         print("File %s could not be opened. Continuing without it." % logfile, file=sys.stderr)
 
+def event_selected(timestamp, event, since, until, grep):
+    if since and timestamp < since:
+        return False
+    if until and timestamp[:len(until)] > until:
+        return False
+    return grep is None or grep.search(event) is not None
+
 def print_logs(log_events, color=False, html=False):
     """Renders the iterator of log events into text or html."""
     if not html:
@@ -106,9 +211,11 @@ def print_logs(log_events, color=False, html=False):
         except ImportError:
             print("jinja2 not found. Try `pip install jinja2`")
             sys.exit(1)
-        print(jinja2.Environment(loader=jinja2.FileSystemLoader('./'))
-                    .get_template('combined_log_template.html')
-                    .render(title="Combined Logs from testcase", log_events=[event._asdict() for event in log_events]))
+        # Render the page as the events are read, instead of building it in memory
+        template = jinja2.Environment(loader=jinja2.FileSystemLoader('./')).get_template('combined_log_template.html')
+        for chunk in template.generate(title="Combined Logs from testcase", log_events=(event._asdict() for event in log_events)):
+            sys.stdout.write(chunk)
+        sys.stdout.write("\n")
 
 if __name__ == '__main__':
     main()
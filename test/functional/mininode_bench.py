@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Benchmark the mininode data structures.
+
+This does not need a running bitcoind. It builds large in-memory collections
+of the objects that p2p tests keep around (eg the headers in
+BlockStore.headers_map or the transactions behind comptool's request maps)
+and reports the memory used per object. It also times deserializing large
+blocks, with and without deferring transaction decoding (CLazyBlock), after
+checking that both decode the same transactions, including unusual ones.
+
+Run with --count to change the size of the collections."""
+
+import argparse
+import gc
+from io import BytesIO
+import struct
+import time
+import tracemalloc
+
+from test_framework.mininode import (
+    CBlock,
+    CBlockHeader,
+    CLazyBlock,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    ser_compact_size,
+)
+
+def make_header(i):
+    header = CBlockHeader()
+    header.nVersion = 0x20000000
+    header.hashPrevBlock = i
+    header.hashMerkleRoot = i * 0x10001
+    header.nTime = 1296688602 + i
+    header.nBits = 0x207fffff
+    header.nNonce = i
+    header.rehash()
+    return header
+
+def make_tx(i):
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(i, 0), b"\x51", 0xffffffff))
+    tx.vout.append(CTxOut(50 * 100000000, b"\x51"))
+    tx.rehash()
+    return tx
+
+def measure(factory, count):
+    """Return the number of bytes allocated per object when holding count objects in a dict."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = {}
+    for i in range(count):
+        obj = factory(i)
+        objects[obj.sha256] = obj
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+def bench_memory(count):
+    for name, factory in (("header", make_header), ("tx", make_tx)):
+        print("%-8s %8.1f bytes/object (%d objects)" % (name, measure(factory, count), count))
+
+def make_witness_tx(i):
+    tx = make_tx(i)
+    tx.wit.vtxinwit = [CTxInWitness()]
+    tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01" * 72, b"\x02" * 33]
+    tx.rehash()
+    return tx
+
+def raw_tx_without_inputs(flags):
+    """A transaction with no inputs, with the witness marker and the given flags.
+
+    serialize_with_witness() can't produce this, but invalid transactions in
+    tests can. With flags != 0 the outputs still follow the empty vin."""
+    return (struct.pack("<i", 1) + b"\x00" + struct.pack("<B", flags) + ser_compact_size(0) +
+            ser_compact_size(1) + CTxOut(1000, b"\x51").serialize() + struct.pack("<I", 0))
+
+def raw_tx_with_empty_witness(i):
+    """A transaction with the witness marker, but only empty witnesses.
+
+    serialize_with_witness() leaves the marker out for such a transaction."""
+    tx = make_tx(i)
+    tx.wit.vtxinwit = [CTxInWitness()]
+    r = tx.serialize_without_witness()
+    return r[:4] + b"\x00\x01" + r[4:-4] + tx.wit.serialize() + r[-4:]
+
+def decode_blocks(raw_txs):
+    raw = make_header(0).serialize() + ser_compact_size(len(raw_txs)) + b"".join(raw_txs)
+    eager = CBlock()
+    eager.deserialize(BytesIO(raw))
+    lazy = CLazyBlock()
+    lazy.deserialize(BytesIO(raw))
+    assert lazy.tx_count() == len(eager.vtx) == len(raw_txs)
+    return (raw, eager, lazy)
+
+def check_lazy_txs(eager, lazy):
+    for i, tx in enumerate(eager.vtx):
+        tx.rehash()
+        lazy_tx = lazy.get_tx(i)
+        lazy_tx.rehash()
+        assert lazy_tx.hash == tx.hash, "transaction %d differs" % i
+        assert lazy_tx.serialize_with_witness() == tx.serialize_with_witness()
+    # All transactions were handed out, so they are all re-serialized
+    assert lazy.serialize(with_witness=True) == eager.serialize(with_witness=True)
+    assert lazy.serialize() == eager.serialize()
+
+def check_lazy_block():
+    """Check that CLazyBlock finds the same transactions as CBlock."""
+    (raw, eager, lazy) = decode_blocks([make_tx(0).serialize(), make_witness_tx(1).serialize_with_witness(),
+                                        make_witness_tx(2).serialize_with_witness(), make_tx(3).serialize()])
+    # Before any get_tx(), serialize() copies the raw transactions
+    assert lazy.serialize(with_witness=True) == eager.serialize(with_witness=True) == raw
+    assert lazy.serialize() == eager.serialize()
+    check_lazy_txs(eager, lazy)
+
+    # Transactions that CBlock doesn't serialize the way they were received
+    (raw, eager, lazy) = decode_blocks([make_tx(0).serialize(), raw_tx_with_empty_witness(1), raw_tx_without_inputs(1),
+                                        make_witness_tx(2).serialize_with_witness(), raw_tx_without_inputs(0), make_tx(3).serialize()])
+    assert lazy.serialize(with_witness=True) == raw != eager.serialize(with_witness=True)
+    assert lazy.serialize() == eager.serialize()
+    check_lazy_txs(eager, lazy)
+
+def bench_block_decode(txs, rounds=10):
+    block = CBlock(make_header(0))
+    block.vtx = [make_tx(i) for i in range(txs)]
+    raw = block.serialize()
+    for cls in (CBlock, CLazyBlock):
+        start = time.time()
+        for i in range(rounds):
+            decoded = cls()
+            decoded.deserialize(BytesIO(raw))
+            decoded.rehash()
+        elapsed = (time.time() - start) / rounds
+        print("%-10s %8.2f ms/block to get the block hash (%d txs)" % (cls.__name__, elapsed * 1000, txs))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000, help='number of objects in each collection (default: %(default)s)')
+    parser.add_argument('--block-txs', type=int, default=2000, help='number of transactions in each decoded block (default: %(default)s)')
+    args = parser.parse_args()
+
+    check_lazy_block()
+    bench_memory(args.count)
+    bench_block_decode(args.block_txs)
+
+if __name__ == '__main__':
+    main()
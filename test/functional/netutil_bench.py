@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Benchmark looking up bind addresses in the /proc/net socket tables.
+
+This does not need a running bitcoind. It opens some listening sockets in
+this process, and writes tcp and tcp6 tables like the ones in /proc/net with
+those sockets among a large number of others, as on a busy host. It then
+times getting the bind addresses of this process by reading the tables for
+every lookup (as get_bind_addrs does), and with one SocketTable snapshot for
+all lookups, and checks that both find the listening sockets.
+
+Run with --sockets to change the size of the tables, or with --proc-net
+/proc/net to use the real tables of this host."""
+
+import argparse
+import os
+import random
+import socket
+import struct
+import tempfile
+import time
+
+from test_framework.netutil import (
+    STATE_ESTABLISHED,
+    STATE_LISTEN,
+    SocketTable,
+    addr_to_hex,
+    get_socket_inodes,
+    netstat,
+)
+
+LINE = '%4d: %s:%04X %s:%04X %s 00000000:00000000 00:00000000 00000000  1000        0 %d 1 0000000000000000 20 4 30 10 -1\n'
+HEADER = '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+
+def kernel_addr(family, host):
+    """Format an address like the kernel does in /proc/net: 32-bit words in host byte order."""
+    packed = socket.inet_pton(family, host)
+    return ''.join('%08X' % word for word in struct.unpack('=%dI' % (len(packed) // 4), packed))
+
+def write_tables(directory, listening, count):
+    """Write tcp and tcp6 tables with the listening sockets and count random connections."""
+    rows = {'tcp': [], 'tcp6': []}
+    for (family, (host, port), inode) in listening:
+        typ = 'tcp' if family == socket.AF_INET else 'tcp6'
+        rows[typ].append((kernel_addr(family, host), port, kernel_addr(family, '0.0.0.0' if typ == 'tcp' else '::'), 0, STATE_LISTEN, inode))
+    rng = random.Random(0)
+    for i in range(count):
+        typ = rng.choice(['tcp', 'tcp6'])
+        size = 4 if typ == 'tcp' else 16
+        rows[typ].append((''.join('%08X' % rng.getrandbits(32) for _ in range(size // 4)), rng.randrange(65536),
+                          ''.join('%08X' % rng.getrandbits(32) for _ in range(size // 4)), rng.randrange(65536),
+                          STATE_ESTABLISHED, 10**6 + i))
+    for (typ, lines) in rows.items():
+        rng.shuffle(lines)
+        with open(os.path.join(directory, typ), 'w', encoding='utf8') as f:
+            f.write(HEADER)
+            for (n, row) in enumerate(lines):
+                f.write(LINE % ((n,) + row))
+
+def get_bind_addrs_by_reading(pid, proc_net):
+    """Look up the bind addresses by converting the full tables, as was done for every lookup."""
+    inodes = get_socket_inodes(pid)
+    return [conn[1] for conn in netstat('tcp', proc_net) + netstat('tcp6', proc_net)
+            if conn[3] == STATE_LISTEN and conn[4] in inodes]
+
+def timed(func, lookups):
+    start = time.time()
+    for i in range(lookups):
+        result = func()
+    return (result, (time.time() - start) / lookups)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sockets', type=int, default=50000, help='number of other sockets in the tables (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=10, help='number of lookups to time (default: %(default)s)')
+    parser.add_argument('--proc-net', help='use the tables in this directory instead of generated ones')
+    args = parser.parse_args()
+
+    listeners = []
+    for (family, host) in ((socket.AF_INET, '127.0.0.1'), (socket.AF_INET6, '::1')):
+        try:
+            s = socket.socket(family)
+            s.bind((host, 0))
+        except OSError: # no IPv6
+            continue
+        s.listen(1)
+        listeners.append((family, s.getsockname()[:2], os.fstat(s.fileno()).st_ino, s))
+    expected = set((addr_to_hex(host), port) for (_, (host, port), _, _) in listeners)
+
+    with tempfile.TemporaryDirectory(prefix='netutil_bench') as directory:
+        proc_net = args.proc_net
+        if proc_net is None:
+            write_tables(directory, [listener[:3] for listener in listeners], args.sockets)
+            proc_net = directory
+        pid = os.getpid()
+        table = SocketTable(proc_net=proc_net)
+        print("%d sockets in the tables, %d lookups" % (len(table.by_inode), args.lookups))
+
+        (result, seconds) = timed(lambda: get_bind_addrs_by_reading(pid, proc_net), args.lookups)
+        assert set(result) == expected, (result, expected)
+        print("%-36s %8.2f ms/lookup" % ("convert all sockets, every lookup", seconds * 1000))
+
+        (result, seconds) = timed(lambda: SocketTable(proc_net=proc_net).get_bind_addrs(pid), args.lookups)
+        assert set(result) == expected, (result, expected)
+        print("%-36s %8.2f ms/lookup" % ("new SocketTable, every lookup", seconds * 1000))
+
+        start = time.time()
+        result = SocketTable(proc_net=proc_net).get_bind_addrs_by_pid([pid] * args.lookups)
+        seconds = (time.time() - start) / args.lookups
+        assert set(result[pid]) == expected, (result, expected)
+        print("%-36s %8.2f ms/lookup" % ("one SocketTable, all lookups", seconds * 1000))
+
+if __name__ == '__main__':
+    main()
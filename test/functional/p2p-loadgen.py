@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Benchmark a node under p2p load.
+
+This is not run as part of the test suite. It starts a single regtest node,
+opens --peers mininode connections to it and sends a mix of p2p messages at
+the target rate for --duration seconds (see test_framework/loadgen.py). It
+then logs the throughput and the per message type processing latencies.
+
+Example:
+    p2p-loadgen.py --peers=64 --rate=2000 --duration=120 --mix=tx=60,inv=20,getdata=10,headers=5,cmpctblock=5
+"""
+
+from test_framework.loadgen import LoadGenerator, parse_mix
+from test_framework.mininode import NetworkThread
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import p2p_port
+
+class P2PLoadGen(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+        # Whitelist the load peers so that unrequested or unconnecting
+        # messages don't get them banned.
+        self.extra_args = [["-whitelist=127.0.0.1"]]
+
+    def add_options(self, parser):
+        parser.add_option("--peers", dest="peers", default=8, type="int",
+                          help="Number of p2p connections to open (default: %default)")
+        parser.add_option("--duration", dest="duration", default=30, type="float",
+                          help="Number of seconds to generate load for (default: %default)")
+        parser.add_option("--rate", dest="rate", default=500, type="float",
+                          help="Target number of messages per second over all connections, 0 for as fast as possible (default: %default)")
+        parser.add_option("--mix", dest="mix", default="tx=60,inv=20,getdata=10,headers=5,cmpctblock=5",
+                          help="Relative weights of the message types to send (default: %default)")
+        parser.add_option("--ping-every", dest="ping_every", default=1, type="int",
+                          help="Measure the latency of one message in this many (default: %default)")
+        parser.add_option("--utxos", dest="utxos", default=1000, type="int",
+                          help="Number of outputs for tx messages to spend (default: %default)")
+        parser.add_option("--seed", dest="seed", default=None, type="int",
+                          help="Seed for the random message mix")
+
+    def run_test(self):
+        generator = LoadGenerator(self.nodes[0], p2p_port(0), parse_mix(self.options.mix),
+                                  rate=self.options.rate, ping_every=self.options.ping_every,
+                                  seed=self.options.seed)
+        generator.connect(self.options.peers)
+        NetworkThread().start()
+        generator.wait_for_verack()
+
+        self.log.info("Creating %d outputs to spend" % self.options.utxos)
+        generator.make_utxos(self.options.utxos)
+
+        self.log.info("Sending load for %.1fs" % self.options.duration)
+        generator.run(self.options.duration)
+        generator.log_report()
+        generator.disconnect()
+
+if __name__ == '__main__':
+    P2PLoadGen().main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Replay recorded p2p traffic into a fresh node.
+
+This is not run as part of the test suite. Record the traffic of a p2p test
+with --p2pcapture, eg:
+
+    p2p-fullblocktest.py --p2pcapture=/tmp/fullblock.cap
+
+and replay it into a new node, at the original speed or as fast as possible
+(--speed=0):
+
+    p2p-replay.py --capture=/tmp/fullblock.cap --speed=0
+
+The node must start from the same chain as the recorded one, so pass
+--cachedchain when the recorded test did not use a clean chain. Use --srcdir
+to compare different bitcoind builds on the same workload.
+"""
+
+from test_framework.mininode import NetworkThread
+from test_framework.p2pcapture import P2PReplayer
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import p2p_port
+
+class P2PReplay(BitcoinTestFramework):
+
+    def __init__(self):
+        super().__init__()
+        self.num_nodes = 1
+        self.extra_args = [["-whitelist=127.0.0.1"]]
+
+    def add_options(self, parser):
+        parser.add_option("--capture", dest="capture",
+                          help="Capture file to replay")
+        parser.add_option("--speed", dest="speed", default=1.0, type="float",
+                          help="Replay speed relative to the recording, 0 for as fast as possible (default: %default)")
+        parser.add_option("--cachedchain", dest="cachedchain", default=False, action="store_true",
+                          help="Start the node from the cached 200 block chain instead of a clean one")
+
+    def setup_chain(self):
+        self.setup_clean_chain = not self.options.cachedchain
+        super().setup_chain()
+
+    def run_test(self):
+        assert self.options.capture, "--capture is required"
+        replayer = P2PReplayer(self.options.capture, self.nodes[0], p2p_port(0), self.options.speed)
+        replayer.connect()
+        NetworkThread().start()
+        replayer.wait_for_connections()
+
+        self.log.info("Replaying %s over %d connections" % (self.options.capture, len(replayer.connections)))
+        replayer.run()
+
+        self.log.info("Replayed %d messages (%d bytes) in %.3fs" % (sum(replayer.sent_count.values()), sum(replayer.sent_bytes.values()), replayer.elapsed))
+        for command in sorted(replayer.sent_count):
+            self.log.info("  sent %-12s %8d msgs %10d bytes" % (command, replayer.sent_count[command], replayer.sent_bytes[command]))
+        for command, count in sorted(replayer.received_counts().items()):
+            self.log.info("  received %-12s %8d msgs" % (command, count))
+        self.log.info("Node is at height %d with %d transactions in its mempool" % (self.nodes[0].getblockcount(), len(self.nodes[0].getrawmempool())))
+        replayer.disconnect()
+
+if __name__ == '__main__':
+    P2PReplay().main()
@@ -122,7 +122,7 @@ class TestNode(NodeConnCB):
             self.last_blockhash_announced = message.headers[-1].sha256
 
     def on_block(self, conn, message):
-        self.last_message["block"].calc_sha256()
+        self.last_message["block"].block.calc_sha256()
 
     # Test whether the last announcement we received had the
     # right header or the right inv
@@ -219,7 +219,7 @@ class SendHeadersTest(BitcoinTestFramework):
         connections.append(NodeConn('127.0.0.1', p2p_port(0), self.nodes[0], inv_node))
         # Set nServices to 0 for test_node, so no block download will occur outside of
         # direct fetching
-        connections.append(NodeConn('127.0.0.1', p2p_port(0), self.nodes[0], test_node, services=0))
+        connections.append(NodeConn('127.0.0.1', p2p_port(0), self.nodes[0], test_node, services=0, lazy_blocks=True))
         inv_node.add_connection(connections[0])
         test_node.add_connection(connections[1])
 
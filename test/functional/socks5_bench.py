@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test and benchmark the relay mode of the test SOCKS5 proxy.
+
+This does not need a running bitcoind. An echo server in this process stands
+in for the destination. The test checks that the proxy records commands and
+disconnects when not relaying, relays data sent together with the connect
+request, survives a spurious wakeup, and sends error replies for refused and
+unresolvable destinations. It then relays many concurrent streams through
+the echo server, checks every byte that comes back and the proxy's counters,
+and prints the throughput.
+
+Run with --streams and --size to change the load."""
+
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+
+from test_framework.socks5 import (
+    AddressType,
+    Pipe,
+    Reply,
+    Socks5Command,
+    Socks5Configuration,
+    Socks5Server,
+)
+
+def recvall(s, n):
+    data = bytearray()
+    while len(data) < n:
+        d = s.recv(n - len(data))
+        if not d:
+            raise IOError('Unexpected end of stream')
+        data += d
+    return data
+
+def recv_until_eof(s):
+    data = bytearray()
+    while True:
+        d = s.recv(65536)
+        if not d:
+            return data
+        data += d
+
+def connect_request(host, port):
+    return bytearray([0x05, 0x01, 0x00, AddressType.DOMAINNAME, len(host)]) + host + struct.pack('>H', port)
+
+def socks5_connect(proxy, host, port):
+    """Connect to host:port through the proxy. Returns (socket, reply code)."""
+    s = socket.create_connection(proxy)
+    s.sendall(bytearray([0x05, 0x01, 0x00]))
+    assert recvall(s, 2) == bytearray([0x05, 0x00])
+    s.sendall(connect_request(host, port))
+    (ver, rep, rsv, atyp) = recvall(s, 4)
+    recvall(s, 4 + 2 if atyp == AddressType.IPV4 else 16 + 2)
+    return (s, rep)
+
+class EchoServer(threading.Thread):
+    """Send back everything that is received, until the other side shuts down."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.s = socket.socket()
+        self.s.bind(('127.0.0.1', 0))
+        self.s.listen(socket.SOMAXCONN)
+        self.port = self.s.getsockname()[1]
+
+    def echo(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def run(self):
+        while True:
+            (conn, _) = self.s.accept()
+            threading.Thread(target=self.echo, args=(conn,), daemon=True).start()
+
+def unused_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def make_server(port, relay):
+    conf = Socks5Configuration()
+    conf.addr = ('127.0.0.1', port)
+    conf.unauth = True
+    conf.relay = relay
+    serv = Socks5Server(conf)
+    serv.start()
+    return serv
+
+def test_no_relay():
+    serv = make_server(unused_port(), False)
+    (s, rep) = socks5_connect(serv.conf.addr, b'15.61.23.23', 1234)
+    assert rep == Reply.SUCCEEDED
+    assert s.recv(1) == b''
+    s.close()
+    cmd = serv.queue.get(timeout=10)
+    assert isinstance(cmd, Socks5Command) and cmd.addr == b'15.61.23.23' and cmd.port == 1234
+    serv.stop()
+    assert serv.get_counters()['relays'] == 0
+
+def test_errors(serv):
+    (s, rep) = socks5_connect(serv.conf.addr, b'127.0.0.1', unused_port())
+    assert rep == Reply.CONNECTION_REFUSED, rep
+    s.close()
+    (s, rep) = socks5_connect(serv.conf.addr, b'nonexistent.invalid', 1)
+    assert rep == Reply.HOST_UNREACHABLE, rep
+    s.close()
+
+def test_pipelined(serv, echo):
+    """Data sent right after the connect request reaches the destination."""
+    s = socket.create_connection(serv.conf.addr)
+    s.sendall(bytearray([0x05, 0x01, 0x00]) + connect_request(b'127.0.0.1', echo.port) + b'hello')
+    s.shutdown(socket.SHUT_WR)
+    data = recv_until_eof(s)
+    assert data[:2] == bytearray([0x05, 0x00]) and data[3] == Reply.SUCCEEDED and data.endswith(b'hello'), data
+    s.close()
+
+def test_spurious_wakeup():
+    """A read event without data to read must not end the stream."""
+    (src, src_peer) = socket.socketpair()
+    (dst, dst_peer) = socket.socketpair()
+    for sock in (src, dst):
+        sock.setblocking(False)
+    pipe = Pipe(src, dst)
+    assert pipe.fill() == 0 and not pipe.eof
+    src_peer.sendall(b'data')
+    assert pipe.fill() == 4
+    pipe.flush()
+    assert dst_peer.recv(4) == b'data'
+    src_peer.close()
+    assert pipe.fill() == 0 and pipe.eof
+    for sock in (src, src_peer, dst, dst_peer):
+        sock.close()
+
+def test_relay(serv, echo, streams, size):
+    """Relay streams concurrent echo streams of size bytes each."""
+    socks = [socks5_connect(serv.conf.addr, b'127.0.0.1', echo.port)[0] for i in range(streams)]
+    assert serv.get_counters()['active'] == streams
+    errors = []
+    def client(s):
+        try:
+            data = os.urandom(size)
+            sender = threading.Thread(target=lambda: (s.sendall(data), s.shutdown(socket.SHUT_WR)))
+            sender.start()
+            received = recv_until_eof(s)
+            sender.join()
+            assert received == data, 'received %d of %d bytes' % (len(received), size)
+            s.close()
+        except Exception as e:
+            errors.append(e)
+    start = time.time()
+    clients = [threading.Thread(target=client, args=(s,)) for s in socks]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+    assert not errors, errors[:3]
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=200, help='number of concurrent streams (default: %(default)s)')
+    parser.add_argument('--size', type=int, default=200000, help='bytes sent through each stream (default: %(default)s)')
+    args = parser.parse_args()
+
+    echo = EchoServer()
+    echo.start()
+    test_no_relay()
+    test_spurious_wakeup()
+
+    serv = make_server(unused_port(), True)
+    test_errors(serv)
+    test_pipelined(serv, echo)
+    elapsed = test_relay(serv, echo, args.streams, args.size)
+    # Wait for the proxy to see the last shutdowns
+    deadline = time.time() + 10
+    while serv.get_counters()['active'] and time.time() < deadline:
+        time.sleep(0.05)
+    counters = serv.get_counters()
+    serv.stop()
+    print(counters)
+    assert counters['active'] == 0
+    assert counters['relays'] == args.streams + 1
+    assert counters['connect_failures'] == 2
+    assert counters['bytes_up'] == counters['bytes_down'] == args.streams * args.size + len(b'hello')
+    assert counters['peak_active'] >= args.streams
+    print("relayed %d streams of %d bytes both ways in %.2fs (%.1f MB/s)" %
+          (args.streams, args.size, elapsed, 2 * args.streams * args.size / elapsed / 1e6))
+
+    print("all tests passed")
+
+if __name__ == '__main__':
+    main()
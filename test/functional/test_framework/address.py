@@ -5,26 +5,48 @@
 """Encode and decode BASE58, P2PKH and P2SH addresses."""
 
 from .script import hash256, hash160, sha256, CScript, OP_0
-from .util import bytes_to_hex_str, hex_str_to_bytes
+from .util import hex_str_to_bytes
 
 chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
-def byte_to_base58(b, version):
-    result = ''
-    str = bytes_to_hex_str(b)
-    str = bytes_to_hex_str(chr(version).encode('latin-1')) + str
-    checksum = bytes_to_hex_str(hash256(hex_str_to_bytes(str)))
-    str += checksum[:8]
-    value = int('0x'+str,0)
+# Numbers are converted 10 digits at a time (58**10 < 2**63), and every chunk
+# two digits at a time with lookup tables. contrib/testgen/base58.py does the same.
+pairs = [a + b for a in chars for b in chars]
+pair_values = {p: i for (i, p) in enumerate(pairs)}
+CHUNK_DIGITS = 10
+CHUNK_BASE = 58 ** CHUNK_DIGITS
+
+def base58_encode(b):
+    """Encode bytes to base58. Leading zero bytes become leading '1's."""
+    stripped = b.lstrip(b'\0')
+    value = int.from_bytes(stripped, 'big')
+    result = []
     while value > 0:
-        result = chars[value % 58] + result
-        value //= 58
-    while (str[:2] == '00'):
-        result = chars[0] + result
-        str = str[2:]
-    return result
+        value, chunk = divmod(value, CHUNK_BASE)
+        for _ in range(CHUNK_DIGITS // 2):
+            chunk, pair = divmod(chunk, len(pairs))
+            result.append(pairs[pair])
+    return chars[0] * (len(b) - len(stripped)) + ''.join(reversed(result)).lstrip(chars[0])
 
-# TODO: def base58_decode
+def base58_decode(s):
+    """Decode a base58 string to bytes. Raises ValueError on invalid characters."""
+    stripped = s.lstrip(chars[0])
+    # Leading '1's are zeros, so pad to a whole number of chunks with them
+    padded = chars[0] * (-len(stripped) % CHUNK_DIGITS) + stripped
+    value = 0
+    try:
+        for i in range(0, len(padded), CHUNK_DIGITS):
+            chunk = 0
+            for j in range(i, i + CHUNK_DIGITS, 2):
+                chunk = chunk * len(pairs) + pair_values[padded[j:j + 2]]
+            value = value * CHUNK_BASE + chunk
+    except KeyError:
+        raise ValueError('Invalid base58 string %r' % s)
+    return b'\0' * (len(s) - len(stripped)) + value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+def byte_to_base58(b, version):
+    b = bytes([version]) + b
+    return base58_encode(b + hash256(b)[:4])
 
 def keyhash_to_p2pkh(hash, main = False):
     assert (len(hash) == 20)
@@ -77,6 +77,8 @@ class AuthServiceProxy(object):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii # can be toggled on the fly by tests
+        self._request_size = 0
+        self._response_size = 0
         self.__url = urlparse.urlparse(service_url)
         if self.__url.port is None:
             port = 80
@@ -149,7 +151,10 @@ class AuthServiceProxy(object):
                                'method': self._service_name,
                                'params': args or argsn,
                                'id': AuthServiceProxy.__id_count}, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        response = self._request('POST', self.__url.path, postdata.encode('utf-8'))
+        postdata = postdata.encode('utf-8')
+        # Payload sizes of the last call, for the RPC coverage recorder
+        self._request_size = len(postdata)
+        response = self._request('POST', self.__url.path, postdata)
         if response['error'] is not None:
             raise JSONRPCException(response['error'])
         elif 'result' not in response:
@@ -183,7 +188,9 @@ class AuthServiceProxy(object):
             raise JSONRPCException({
                 'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
 
-        responsedata = http_response.read().decode('utf8')
+        responsedata = http_response.read()
+        self._response_size = len(responsedata)
+        responsedata = responsedata.decode('utf8')
         response = json.loads(responsedata, parse_float=decimal.Decimal)
         elapsed = time.time() - req_start_time
         if "error" in response and response["error"] is None:
@@ -5,14 +5,97 @@
 """Utilities for doing coverage analysis on the RPC interface.
 
 Provides a way to track which RPC commands are exercised during
-testing.
+testing, and how long they take.
+
+Calls are recorded in memory, per method: the number of calls and errors,
+the total time spent, a latency histogram and the request and response
+sizes. The statistics of each node are written as JSON to the node's
+coverage file when the test exits, and every FLUSH_INTERVAL seconds so
+that a test which gets killed still leaves most of them behind.
 """
 
+import atexit
+import json
 import os
+import threading
+import time
 
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
+# Seconds between writes of the coverage file while a test is running
+FLUSH_INTERVAL = 30
+
+# Latency bucket i counts the calls that took less than 2**i milliseconds
+# (and at least 2**(i-1) milliseconds for i > 0)
+LATENCY_BUCKETS = 16
+
+
+def latency_bucket(seconds):
+    return min(int(seconds * 1000).bit_length(), LATENCY_BUCKETS - 1)
+
+
+class RPCRecorder(object):
+    """
+    Per-method RPC call statistics of one node, kept in memory and flushed
+    to a coverage file. Calls can be recorded from any thread.
+
+    """
+    def __init__(self, coverage_logfile):
+        self.coverage_logfile = coverage_logfile
+        self.methods = {}
+        self.last_flush = time.time()
+        self.dirty = False
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def record(self, method, seconds, request_size, response_size, error):
+        with self.lock:
+            stats = self.methods.get(method)
+            if stats is None:
+                stats = self.methods[method] = {
+                    "calls": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "request_bytes": 0,
+                    "response_bytes": 0,
+                    "latency_ms_log2": [0] * LATENCY_BUCKETS,
+                }
+            stats["calls"] += 1
+            stats["errors"] += error
+            stats["seconds"] += seconds
+            stats["request_bytes"] += request_size
+            stats["response_bytes"] += response_size
+            stats["latency_ms_log2"][latency_bucket(seconds)] += 1
+            self.dirty = True
+        if time.time() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write the statistics recorded so far to the coverage file."""
+        # Hold the lock while writing, so another thread can't change the
+        # statistics during json.dump or write the file at the same time
+        with self.lock:
+            self.last_flush = time.time()
+            if not self.dirty:
+                return
+            tmpfile = self.coverage_logfile + ".tmp"
+            with open(tmpfile, 'w', encoding='utf8') as f:
+                json.dump(self.methods, f, separators=(',', ':'))
+            os.replace(tmpfile, self.coverage_logfile)
+            self.dirty = False
+
+
+_recorders = {}
+
+
+def get_recorder(coverage_logfile):
+    """Return the recorder that writes to coverage_logfile."""
+    recorder = _recorders.get(coverage_logfile)
+    if recorder is None:
+        recorder = _recorders[coverage_logfile] = RPCRecorder(coverage_logfile)
+    return recorder
+
 
 class AuthServiceProxyWrapper(object):
     """
@@ -24,12 +107,13 @@ class AuthServiceProxyWrapper(object):
         Kwargs:
             auth_service_proxy_instance (AuthServiceProxy): the instance
                 being wrapped.
-            coverage_logfile (str): if specified, write each service_name
-                out to a file when called.
+            coverage_logfile (str): if specified, record the calls and
+                write their statistics to this file.
 
         """
         self.auth_service_proxy_instance = auth_service_proxy_instance
         self.coverage_logfile = coverage_logfile
+        self.recorder = get_recorder(coverage_logfile) if coverage_logfile else None
 
     def __getattr__(self, *args, **kwargs):
         return_val = self.auth_service_proxy_instance.__getattr__(
@@ -39,16 +123,22 @@ class AuthServiceProxyWrapper(object):
 
     def __call__(self, *args, **kwargs):
         """
-        Delegates to AuthServiceProxy, then writes the particular RPC method
-        called to a file.
+        Delegates to AuthServiceProxy, then records the particular RPC
+        method called, with its latency and payload sizes.
 
         """
-        return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
-        rpc_method = self.auth_service_proxy_instance._service_name
-
-        if self.coverage_logfile:
-            with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
-                f.write("%s\n" % rpc_method)
+        if not self.recorder:
+            return self.auth_service_proxy_instance.__call__(*args, **kwargs)
+
+        proxy = self.auth_service_proxy_instance
+        start = time.time()
+        error = True
+        try:
+            return_val = proxy.__call__(*args, **kwargs)
+            error = False
+        finally:
+            self.recorder.record(proxy._service_name, time.time() - start,
+                                 proxy._request_size, proxy._response_size, error)
 
         return return_val
 
@@ -61,11 +151,11 @@ def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
 
-    This file will contain a list of RPC commands covered.
+    This file will contain the statistics of the RPC commands covered.
     """
     pid = str(os.getpid())
     return os.path.join(
-        dirname, "coverage.pid%s.node%s.txt" % (pid, str(n_node)))
+        dirname, "coverage.pid%s.node%s.json" % (pid, str(n_node)))
 
 
 def write_all_rpc_commands(dirname, node):
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Generate p2p load against a bitcoind using mininode connections.
+
+LoadGenerator opens a number of NodeConn connections to a single node and
+sends a weighted mix of tx, inv, getdata, headers and cmpctblock messages at
+a target rate, round-robin over the connections.
+
+Latency is measured by following a message with a ping: the node processes
+the messages from one peer in order, so the time until the matching pong
+arrives is the time the node took to process the message. Latencies are
+collected per message type in LatencyHistograms.
+
+Received blocks, transactions and announcements are only counted (see
+NodeConn's message_filter), so the Python side stays cheap at high rates.
+"""
+
+import bisect
+from collections import defaultdict, deque
+import itertools
+import random
+import time
+
+from .blocktools import create_block, create_coinbase
+from .mininode import *
+from .script import CScript, OP_TRUE
+from .util import assert_equal
+
+logger = logging.getLogger("TestFramework.loadgen")
+
+MESSAGE_TYPES = ("tx", "inv", "getdata", "headers", "cmpctblock")
+
+# Messages that a load peer needs to see; anything else the node sends is
+# counted and dropped unparsed.
+LOAD_PEER_MESSAGES = [b"ping", b"pong", b"getdata", b"getblocktxn"]
+
+def parse_mix(mix):
+    """Parse a message mix like "tx=50,inv=20,getdata=30" into a dict of weights."""
+    weights = {}
+    for item in mix.split(","):
+        command, _, weight = item.partition("=")
+        command = command.strip()
+        if command not in MESSAGE_TYPES:
+            raise ValueError("Unknown message type in mix: '%s'" % command)
+        weights[command] = float(weight) if weight else 1.0
+    return weights
+
+class LatencyHistogram(object):
+    """Histogram of latencies, with one bucket per power of two microseconds."""
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        usecs = max(int(seconds * 1000000), 1)
+        self.buckets[usecs.bit_length() - 1] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Return the upper bound (in seconds) of the bucket holding the p-th percentile."""
+        target = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return (1 << (bucket + 1)) / 1000000.0
+        return 0.0
+
+    def __repr__(self):
+        return "LatencyHistogram(count=%d mean=%.3fms p50<=%.3fms p90<=%.3fms p99<=%.3fms max=%.3fms)" \
+            % (self.count, self.mean() * 1000, self.percentile(50) * 1000,
+               self.percentile(90) * 1000, self.percentile(99) * 1000, self.max * 1000)
+
+class LoadStats(object):
+    """Counters shared by all the connections of a LoadGenerator."""
+
+    def __init__(self):
+        self.sent_count = defaultdict(int)
+        self.sent_bytes = defaultdict(int)
+        self.latency = defaultdict(LatencyHistogram)
+        self.skipped = defaultdict(int)
+        self.start_time = None
+        self.end_time = None
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+class LoadPeer(NodeConnCB):
+    """Callback for a load generating connection.
+
+    Records ping latencies and serves the blocks and transactions that the
+    LoadGenerator announced."""
+
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+        self.pending_pings = {}
+
+    def on_inv(self, conn, message):
+        pass
+
+    def on_pong(self, conn, message):
+        ping = self.pending_pings.pop(message.nonce, None)
+        if ping is not None:
+            command, sent_time = ping
+            self.generator.stats.latency[command].add(time.time() - sent_time)
+
+    def on_getdata(self, conn, message):
+        for inv in message.inv:
+            obj_type = inv.type & ~MSG_WITNESS_FLAG
+            if obj_type == 1 and inv.hash in self.generator.txs:
+                conn.send_message(msg_tx(self.generator.txs[inv.hash]))
+            elif obj_type == 2 and inv.hash in self.generator.blocks:
+                conn.send_message(msg_block(self.generator.blocks[inv.hash]))
+
+    def on_getblocktxn(self, conn, message):
+        request = message.block_txn_request
+        block = self.generator.blocks.get(request.blockhash)
+        if block is None:
+            return
+        response = msg_blocktxn()
+        response.block_transactions.blockhash = request.blockhash
+        response.block_transactions.transactions = [block.vtx[i] for i in request.to_absolute()]
+        conn.send_message(response)
+
+class LoadGenerator(object):
+    """Send a configurable mix of p2p traffic to a node over many connections.
+
+    Usage:
+        generator = LoadGenerator(node, p2p_port(0), {"tx": 3, "getdata": 1}, rate=500)
+        generator.connect(32)
+        NetworkThread().start()
+        generator.wait_for_verack()
+        generator.make_utxos(1000)
+        generator.run(60)
+        generator.log_report()
+
+    Transactions spend anyone-can-spend outputs created by make_utxos() and
+    create new ones, cycling through the pool of outputs. cmpctblock messages
+    announce a new block on top of the generator's tip containing the
+    transactions sent since the last block."""
+
+    FEE = 1000
+    MAX_BLOCK_TXS = 5000
+
+    def __init__(self, node, port, mix, rate=0, ping_every=1, seed=None):
+        self.node = node
+        self.port = port
+        self.mix = mix
+        self.rate = rate
+        self.ping_every = ping_every
+        self.random = random.Random(seed)
+        self.stats = LoadStats()
+        self.peers = []
+        self.connections = []
+        # Keep clear of the nonces used by NodeConnCB.sync_with_ping()
+        self.ping_nonce = 1 << 32
+
+        # Chain and mempool state, shared with the LoadPeers (which run in
+        # the network thread), so only accessed with mininode_lock held.
+        self.utxos = deque()
+        self.txs = {}
+        self.unconfirmed = []
+        self.blocks = {}
+        self.block_hashes = []
+        self.tip = None
+        self.tip_height = 0
+        self.tip_time = 0
+
+        self.generators = {
+            "tx": self.make_tx,
+            "inv": self.make_inv,
+            "getdata": self.make_getdata,
+            "headers": self.make_headers,
+            "cmpctblock": self.make_cmpctblock,
+        }
+
+    def connect(self, num_peers):
+        for i in range(num_peers):
+            peer = LoadPeer(self)
+            conn = NodeConn('127.0.0.1', self.port, self.node, peer, message_filter=LOAD_PEER_MESSAGES)
+            peer.add_connection(conn)
+            self.peers.append(peer)
+            self.connections.append(conn)
+
+    def wait_for_verack(self):
+        for peer in self.peers:
+            peer.wait_for_verack()
+
+    def disconnect(self):
+        for conn in self.connections:
+            conn.disconnect_node()
+
+    def _build_block(self, txs):
+        block = create_block(self.tip, create_coinbase(self.tip_height + 1), max(self.tip_time + 1, int(time.time())))
+        block.nVersion = 4
+        block.vtx.extend(txs)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.solve()
+        self.blocks[block.sha256] = block
+        self.block_hashes.append(block.sha256)
+        self.tip = block.sha256
+        self.tip_height += 1
+        self.tip_time = block.nTime
+        return block
+
+    def _sync_tip(self):
+        tip = self.node.getbestblockhash()
+        header = self.node.getblockheader(tip)
+        with mininode_lock:
+            self.tip = int(tip, 16)
+            self.tip_height = header['height']
+            self.tip_time = header['time']
+
+    def make_utxos(self, count):
+        """Create count anyone-can-spend outputs to be spent by tx messages."""
+        self._sync_tip()
+        with mininode_lock:
+            block = self._build_block([])
+        self.peers[0].send_and_ping(msg_block(block))
+        self.node.generate(100)
+
+        coinbase = block.vtx[0]
+        out_value = (coinbase.vout[0].nValue - self.FEE) // count
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(coinbase.sha256, 0), b""))
+        tx.vout = [CTxOut(out_value, CScript([OP_TRUE])) for i in range(count)]
+        tx.rehash()
+
+        self._sync_tip()
+        with mininode_lock:
+            block = self._build_block([tx])
+        self.peers[0].send_and_ping(msg_block(block))
+        assert_equal(int(self.node.getbestblockhash(), 16), block.sha256)
+        self.utxos.extend((tx.sha256, i, out_value) for i in range(count))
+
+    # Message generators. Each returns the message to send, or None if it
+    # can't be generated right now.
+
+    def make_tx(self):
+        if not self.utxos:
+            return None
+        txid, n, value = self.utxos.popleft()
+        if value <= self.FEE:
+            return None
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(txid, n), b""))
+        tx.vout.append(CTxOut(value - self.FEE, CScript([OP_TRUE])))
+        tx.rehash()
+        self.utxos.append((tx.sha256, 0, value - self.FEE))
+        self.txs[tx.sha256] = tx
+        self.unconfirmed.append(tx)
+        return msg_tx(tx)
+
+    def make_inv(self):
+        return msg_inv([CInv(1, self.random.getrandbits(256))])
+
+    def make_getdata(self):
+        if not self.block_hashes:
+            return None
+        return msg_getdata([CInv(2, self.random.choice(self.block_hashes))])
+
+    def make_headers(self):
+        if self.tip not in self.blocks:
+            return None
+        message = msg_headers()
+        message.headers = [CBlockHeader(self.blocks[self.tip])]
+        return message
+
+    def make_cmpctblock(self):
+        if self.tip is None:
+            return None
+        txs = self.unconfirmed[:self.MAX_BLOCK_TXS]
+        self.unconfirmed = self.unconfirmed[self.MAX_BLOCK_TXS:]
+        for tx in txs:
+            del self.txs[tx.sha256]
+        block = self._build_block(txs)
+        header_and_shortids = HeaderAndShortIDs()
+        header_and_shortids.initialize_from_block(block, nonce=self.random.getrandbits(64))
+        return msg_cmpctblock(header_and_shortids.to_p2p())
+
+    def _send(self, peer, command):
+        with mininode_lock:
+            message = self.generators[command]()
+            if message is None:
+                self.stats.skipped[command] += 1
+                return
+            data = message.serialize()
+            try:
+                peer.connection.send_message(msg_generic(message.command, data))
+            except IOError:
+                # The node disconnected the peer since run() checked it
+                self.stats.skipped[command] += 1
+                return
+            self.stats.sent_count[command] += 1
+            self.stats.sent_bytes[command] += len(data)
+            self.stats.sent_count["total"] += 1
+            if self.stats.sent_count["total"] % self.ping_every == 0:
+                self.ping_nonce += 1
+                peer.pending_pings[self.ping_nonce] = (command, time.time())
+                try:
+                    peer.connection.send_message(msg_ping(self.ping_nonce))
+                except IOError:
+                    del peer.pending_pings[self.ping_nonce]
+
+    def run(self, duration):
+        """Send traffic for duration seconds. A rate of 0 sends as fast as possible."""
+        commands = list(self.mix)
+        cumulative_weights = list(itertools.accumulate(self.mix[c] for c in commands))
+        interval = 1.0 / self.rate if self.rate else 0
+        self.stats.start_time = time.time()
+        next_send = self.stats.start_time
+        end_time = self.stats.start_time + duration
+        i = 0
+        while time.time() < end_time:
+            peer = self.peers[i % len(self.peers)]
+            i += 1
+            if not peer.connected:
+                if not any(p.connected for p in self.peers):
+                    logger.warning("All load peers were disconnected, stopping after %.1fs" % (time.time() - self.stats.start_time))
+                    break
+                continue
+            pick = self.random.random() * cumulative_weights[-1]
+            self._send(peer, commands[bisect.bisect(cumulative_weights, pick)])
+            if interval:
+                next_send += interval
+                delay = next_send - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        # Wait for the node to catch up before taking the measurements
+        for peer in self.peers:
+            if peer.connected:
+                peer.sync_with_ping(timeout=max(60, duration))
+        self.stats.end_time = time.time()
+
+    def received_counts(self):
+        counts = defaultdict(int)
+        for peer, conn in zip(self.peers, self.connections):
+            for command, count in peer.message_count.items():
+                counts[command] += count
+            for command, count in conn.dropped_message_count.items():
+                counts[command] += count
+        return counts
+
+    def report(self):
+        elapsed = self.stats.elapsed()
+        lines = ["%d peers, %.1fs, %d messages sent (%.1f msg/s)"
+                 % (len(self.peers), elapsed, self.stats.sent_count["total"], self.stats.sent_count["total"] / elapsed)]
+        for command in sorted(self.mix):
+            lines.append("  sent %-10s %8d msgs %10d bytes %8.1f msg/s skipped %d latency %s"
+                         % (command, self.stats.sent_count[command], self.stats.sent_bytes[command],
+                            self.stats.sent_count[command] / elapsed, self.stats.skipped[command],
+                            repr(self.stats.latency[command])))
+        for command, count in sorted(self.received_counts().items()):
+            lines.append("  received %-10s %8d msgs" % (command, count))
+        return "\n".join(lines)
+
+    def log_report(self):
+        for line in self.report().split("\n"):
+            logger.info(line)
@@ -216,8 +216,15 @@ def ToHex(obj):
     return bytes_to_hex_str(obj.serialize())
 
 # Objects that map to bitcoind objects, which can be serialized/deserialized
+#
+# The primitive and message classes declare __slots__, since tests can keep
+# hundreds of thousands of them in memory (see mininode_bench.py). Subclasses
+# that don't declare __slots__ themselves get a __dict__ back and can set
+# arbitrary attributes as before.
 
 class CAddress(object):
+    __slots__ = ("nServices", "pchReserved", "ip", "port")
+
     def __init__(self):
         self.nServices = 1
         self.pchReserved = b"\x00" * 10 + b"\xff" * 2
@@ -245,6 +252,8 @@ class CAddress(object):
 MSG_WITNESS_FLAG = 1<<30
 
 class CInv(object):
+    __slots__ = ("type", "hash")
+
     typemap = {
         0: "Error",
         1: "TX",
@@ -274,6 +283,8 @@ class CInv(object):
 
 
 class CBlockLocator(object):
+    __slots__ = ("nVersion", "vHave")
+
     def __init__(self):
         self.nVersion = MY_VERSION
         self.vHave = []
@@ -294,6 +305,8 @@ class CBlockLocator(object):
 
 
 class COutPoint(object):
+    __slots__ = ("hash", "n")
+
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
@@ -313,6 +326,8 @@ class COutPoint(object):
 
 
 class CTxIn(object):
+    __slots__ = ("prevout", "scriptSig", "nSequence")
+
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
             self.prevout = COutPoint()
@@ -341,6 +356,8 @@ class CTxIn(object):
 
 
 class CTxOut(object):
+    __slots__ = ("nValue", "scriptPubKey")
+
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
@@ -362,6 +379,8 @@ class CTxOut(object):
 
 
 class CScriptWitness(object):
+    __slots__ = ("stack",)
+
     def __init__(self):
         # stack is a vector of strings
         self.stack = []
@@ -377,6 +396,8 @@ class CScriptWitness(object):
 
 
 class CTxInWitness(object):
+    __slots__ = ("scriptWitness",)
+
     def __init__(self):
         self.scriptWitness = CScriptWitness()
 
@@ -394,6 +415,8 @@ class CTxInWitness(object):
 
 
 class CTxWitness(object):
+    __slots__ = ("vtxinwit",)
+
     def __init__(self):
         self.vtxinwit = []
 
@@ -422,6 +445,8 @@ class CTxWitness(object):
 
 
 class CTransaction(object):
+    __slots__ = ("nVersion", "vin", "vout", "wit", "nLockTime", "sha256", "hash")
+
     def __init__(self, tx=None):
         if tx is None:
             self.nVersion = 1
@@ -525,6 +550,8 @@ class CTransaction(object):
 
 
 class CBlockHeader(object):
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits", "nNonce", "sha256", "hash")
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -593,6 +620,8 @@ class CBlockHeader(object):
 
 
 class CBlock(CBlockHeader):
+    __slots__ = ("vtx",)
+
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
@@ -664,6 +693,142 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+# Helpers for walking serialized transactions without deserializing them.
+# Each takes a buffer and an offset, and returns the offset just past the
+# skipped item.
+def _read_compact_size(buf, pos):
+    nit = buf[pos]
+    if nit == 253:
+        return struct.unpack_from("<H", buf, pos + 1)[0], pos + 3
+    elif nit == 254:
+        return struct.unpack_from("<I", buf, pos + 1)[0], pos + 5
+    elif nit == 255:
+        return struct.unpack_from("<Q", buf, pos + 1)[0], pos + 9
+    return nit, pos + 1
+
+def _skip_string(buf, pos):
+    nit, pos = _read_compact_size(buf, pos)
+    return pos + nit
+
+def _skip_tx(buf, pos):
+    """Skip a transaction. Returns (new offset, whether it has witness data).
+
+    This must mirror CTransaction.deserialize()."""
+    pos += 4
+    vin_len, pos = _read_compact_size(buf, pos)
+    flags = 0
+    if vin_len == 0:
+        flags = buf[pos]
+        pos += 1
+        if flags != 0:
+            vin_len, pos = _read_compact_size(buf, pos)
+    if flags != 0 or vin_len != 0:
+        for i in range(vin_len):
+            pos = _skip_string(buf, pos + 36) + 4
+        vout_len, pos = _read_compact_size(buf, pos)
+        for i in range(vout_len):
+            pos = _skip_string(buf, pos + 8)
+    if flags != 0:
+        for i in range(vin_len):
+            stack_len, pos = _read_compact_size(buf, pos)
+            for j in range(stack_len):
+                pos = _skip_string(buf, pos)
+    return pos + 4, flags != 0
+
+
+class CLazyBlock(CBlock):
+    """A CBlock that only deserializes its transactions on demand.
+
+    deserialize() parses the header and keeps the rest of the stream as raw
+    bytes. The transaction boundaries are indexed the first time they are
+    needed, and get_tx() only deserializes the requested transaction.
+    Accessing vtx deserializes all of them and turns this into a regular
+    CBlock.
+
+    serialize() reuses the original bytes for every transaction that was
+    never handed out, so relaying an unmodified block doesn't re-serialize
+    it. Those transactions keep their original encoding: one with the witness
+    marker but only empty witnesses keeps the marker, where
+    CBlock.serialize(with_witness=True) leaves it out."""
+    __slots__ = ("_raw", "_offsets", "_txs", "_vtx")
+
+    def __init__(self, header=None):
+        super(CLazyBlock, self).__init__(header)
+
+    def deserialize(self, f):
+        CBlockHeader.deserialize(self, f)
+        self._raw = f.read()
+        self._offsets = None
+        self._txs = {}
+        self._vtx = None
+
+    def _get_vtx(self):
+        if self._raw is not None:
+            self._vtx = [self.get_tx(i) for i in range(self.tx_count())]
+            self._raw = None
+        return self._vtx
+
+    def _set_vtx(self, vtx):
+        self._raw = None
+        self._vtx = vtx
+
+    vtx = property(_get_vtx, _set_vtx)
+
+    def _index(self):
+        if self._offsets is None:
+            count, pos = _read_compact_size(self._raw, 0)
+            offsets = []
+            for i in range(count):
+                end, has_witness = _skip_tx(self._raw, pos)
+                offsets.append((pos, end, has_witness))
+                pos = end
+            self._offsets = offsets
+        return self._offsets
+
+    def tx_count(self):
+        if self._raw is None:
+            return len(self._vtx)
+        return _read_compact_size(self._raw, 0)[0]
+
+    def _deserialize_tx(self, i):
+        start, end, _ = self._index()[i]
+        tx = CTransaction()
+        tx.deserialize(BytesIO(self._raw[start:end]))
+        return tx
+
+    def get_tx(self, i):
+        if self._raw is None:
+            return self._vtx[i]
+        if i not in self._txs:
+            self._txs[i] = self._deserialize_tx(i)
+        return self._txs[i]
+
+    def serialize(self, with_witness=False):
+        if self._raw is None:
+            return super(CLazyBlock, self).serialize(with_witness)
+        r = CBlockHeader.serialize(self)
+        if with_witness and not self._txs:
+            return r + self._raw
+        offsets = self._index()
+        r += ser_compact_size(len(offsets))
+        for i, (start, end, has_witness) in enumerate(offsets):
+            if i in self._txs:
+                tx = self._txs[i]
+                r += tx.serialize_with_witness() if with_witness else tx.serialize_without_witness()
+            elif has_witness and not with_witness:
+                r += self._deserialize_tx(i).serialize_without_witness()
+            else:
+                r += self._raw[start:end]
+        return r
+
+    def __repr__(self):
+        if self._raw is None:
+            return super(CLazyBlock, self).__repr__()
+        return "CLazyBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=<%i transactions>)" \
+            % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+               time.ctime(self.nTime), self.nBits, self.nNonce, self.tx_count())
+
+
 class CUnsignedAlert(object):
     def __init__(self):
         self.nVersion = 1
@@ -740,6 +905,8 @@ class CAlert(object):
 
 
 class PrefilledTransaction(object):
+    __slots__ = ("index", "tx")
+
     def __init__(self, index=0, tx = None):
         self.index = index
         self.tx = tx
@@ -766,6 +933,8 @@ class PrefilledTransaction(object):
 
 # This is what we send on the wire, in a cmpctblock message.
 class P2PHeaderAndShortIDs(object):
+    __slots__ = ("header", "nonce", "shortids_length", "shortids", "prefilled_txn_length", "prefilled_txn")
+
     def __init__(self):
         self.header = CBlockHeader()
         self.nonce = 0
@@ -806,6 +975,8 @@ class P2PHeaderAndShortIDs(object):
 # P2P version of the above that will use witness serialization (for compact
 # block version 2)
 class P2PHeaderAndShortWitnessIDs(P2PHeaderAndShortIDs):
+    __slots__ = ()
+
     def serialize(self):
         return super(P2PHeaderAndShortWitnessIDs, self).serialize(with_witness=True)
 
@@ -818,6 +989,8 @@ def calculate_shortid(k0, k1, tx_hash):
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs(object):
+    __slots__ = ("header", "nonce", "shortids", "prefilled_txn", "use_witness")
+
     def __init__(self, p2pheaders_and_shortids = None):
         self.header = CBlockHeader()
         self.nonce = 0
@@ -879,6 +1052,7 @@ class HeaderAndShortIDs(object):
 
 
 class BlockTransactionsRequest(object):
+    __slots__ = ("blockhash", "indexes")
 
     def __init__(self, blockhash=0, indexes = None):
         self.blockhash = blockhash
@@ -919,6 +1093,7 @@ class BlockTransactionsRequest(object):
 
 
 class BlockTransactions(object):
+    __slots__ = ("blockhash", "transactions")
 
     def __init__(self, blockhash=0, transactions = None):
         self.blockhash = blockhash
@@ -944,6 +1119,7 @@ class BlockTransactions(object):
 # Objects that correspond to messages on the wire
 class msg_version(object):
     command = b"version"
+    __slots__ = ("nVersion", "nServices", "nTime", "addrTo", "addrFrom", "nNonce", "strSubVer", "nStartingHeight", "nRelay")
 
     def __init__(self):
         self.nVersion = MY_VERSION
@@ -1012,6 +1188,7 @@ class msg_version(object):
 
 class msg_verack(object):
     command = b"verack"
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -1028,6 +1205,7 @@ class msg_verack(object):
 
 class msg_addr(object):
     command = b"addr"
+    __slots__ = ("addrs",)
 
     def __init__(self):
         self.addrs = []
@@ -1044,6 +1222,7 @@ class msg_addr(object):
 
 class msg_alert(object):
     command = b"alert"
+    __slots__ = ("alert",)
 
     def __init__(self):
         self.alert = CAlert()
@@ -1063,6 +1242,7 @@ class msg_alert(object):
 
 class msg_inv(object):
     command = b"inv"
+    __slots__ = ("inv",)
 
     def __init__(self, inv=None):
         if inv is None:
@@ -1082,6 +1262,7 @@ class msg_inv(object):
 
 class msg_getdata(object):
     command = b"getdata"
+    __slots__ = ("inv",)
 
     def __init__(self, inv=None):
         self.inv = inv if inv != None else []
@@ -1098,6 +1279,7 @@ class msg_getdata(object):
 
 class msg_getblocks(object):
     command = b"getblocks"
+    __slots__ = ("locator", "hashstop")
 
     def __init__(self):
         self.locator = CBlockLocator()
@@ -1121,6 +1303,7 @@ class msg_getblocks(object):
 
 class msg_tx(object):
     command = b"tx"
+    __slots__ = ("tx",)
 
     def __init__(self, tx=CTransaction()):
         self.tx = tx
@@ -1135,6 +1318,7 @@ class msg_tx(object):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
 class msg_witness_tx(msg_tx):
+    __slots__ = ()
 
     def serialize(self):
         return self.tx.serialize_with_witness()
@@ -1142,6 +1326,7 @@ class msg_witness_tx(msg_tx):
 
 class msg_block(object):
     command = b"block"
+    __slots__ = ("block",)
 
     def __init__(self, block=None):
         if block is None:
@@ -1161,6 +1346,8 @@ class msg_block(object):
 # for cases where a user needs tighter control over what is sent over the wire
 # note that the user must supply the name of the command, and the data
 class msg_generic(object):
+    __slots__ = ("command", "data")
+
     def __init__(self, command, data=None):
         self.command = command
         self.data = data
@@ -1172,13 +1359,22 @@ class msg_generic(object):
         return "msg_generic()"
 
 class msg_witness_block(msg_block):
+    __slots__ = ()
 
     def serialize(self):
         r = self.block.serialize(with_witness=True)
         return r
 
+# msg_block whose block is only deserialized on demand (see CLazyBlock)
+class msg_lazy_block(msg_block):
+    __slots__ = ()
+
+    def __init__(self, block=None):
+        super(msg_lazy_block, self).__init__(CLazyBlock() if block is None else block)
+
 class msg_getaddr(object):
     command = b"getaddr"
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -1195,6 +1391,7 @@ class msg_getaddr(object):
 
 class msg_ping_prebip31(object):
     command = b"ping"
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -1211,6 +1408,7 @@ class msg_ping_prebip31(object):
 
 class msg_ping(object):
     command = b"ping"
+    __slots__ = ("nonce",)
 
     def __init__(self, nonce=0):
         self.nonce = nonce
@@ -1229,6 +1427,7 @@ class msg_ping(object):
 
 class msg_pong(object):
     command = b"pong"
+    __slots__ = ("nonce",)
 
     def __init__(self, nonce=0):
         self.nonce = nonce
@@ -1247,6 +1446,7 @@ class msg_pong(object):
 
 class msg_mempool(object):
     command = b"mempool"
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -1262,6 +1462,7 @@ class msg_mempool(object):
 
 class msg_sendheaders(object):
     command = b"sendheaders"
+    __slots__ = ()
 
     def __init__(self):
         pass
@@ -1282,6 +1483,7 @@ class msg_sendheaders(object):
 # hash_stop (hash of last desired block header, 0 to get as many as possible)
 class msg_getheaders(object):
     command = b"getheaders"
+    __slots__ = ("locator", "hashstop")
 
     def __init__(self):
         self.locator = CBlockLocator()
@@ -1307,6 +1509,7 @@ class msg_getheaders(object):
 # <count> <vector of block headers>
 class msg_headers(object):
     command = b"headers"
+    __slots__ = ("headers",)
 
     def __init__(self):
         self.headers = []
@@ -1328,6 +1531,7 @@ class msg_headers(object):
 class msg_reject(object):
     command = b"reject"
     REJECT_MALFORMED = 1
+    __slots__ = ("message", "code", "reason", "data")
 
     def __init__(self):
         self.message = b""
@@ -1375,6 +1579,7 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf')):
 
 class msg_feefilter(object):
     command = b"feefilter"
+    __slots__ = ("feerate",)
 
     def __init__(self, feerate=0):
         self.feerate = feerate
@@ -1392,6 +1597,7 @@ class msg_feefilter(object):
 
 class msg_sendcmpct(object):
     command = b"sendcmpct"
+    __slots__ = ("announce", "version")
 
     def __init__(self):
         self.announce = False
@@ -1412,6 +1618,7 @@ class msg_sendcmpct(object):
 
 class msg_cmpctblock(object):
     command = b"cmpctblock"
+    __slots__ = ("header_and_shortids",)
 
     def __init__(self, header_and_shortids = None):
         self.header_and_shortids = header_and_shortids
@@ -1430,6 +1637,7 @@ class msg_cmpctblock(object):
 
 class msg_getblocktxn(object):
     command = b"getblocktxn"
+    __slots__ = ("block_txn_request",)
 
     def __init__(self):
         self.block_txn_request = None
@@ -1448,6 +1656,7 @@ class msg_getblocktxn(object):
 
 class msg_blocktxn(object):
     command = b"blocktxn"
+    __slots__ = ("block_transactions",)
 
     def __init__(self):
         self.block_transactions = BlockTransactions()
@@ -1464,6 +1673,8 @@ class msg_blocktxn(object):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
 
 class msg_witness_blocktxn(msg_blocktxn):
+    __slots__ = ()
+
     def serialize(self):
         r = b""
         r += self.block_transactions.serialize(with_witness=True)
@@ -1670,9 +1881,21 @@ class NodeConn(asyncore.dispatcher):
         "testnet3": b"\x0b\x11\x09\x07",  # testnet3
         "regtest": b"\xfa\xbf\xb5\xda",   # regtest
     }
-
-    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True):
+    # Messages that are delivered whatever the message filter is, so that the
+    # version handshake can always complete, and pings are answered so that
+    # the node doesn't disconnect us with a ping timeout.
+    UNFILTERED_COMMANDS = frozenset([b"version", b"verack", b"ping"])
+    # If set to a P2PCapture (see p2pcapture.py), all traffic is recorded to it.
+    # Set on the class to record every connection.
+    capture = None
+
+    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True, lazy_blocks=False, message_filter=None, capture=None):
         asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+        if lazy_blocks:
+            # Only deserialize the transactions of received blocks when
+            # the callback asks for them.
+            self.messagemap = dict(self.messagemap)
+            self.messagemap[b"block"] = msg_lazy_block
         self.dstaddr = dstaddr
         self.dstport = dstport
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1686,6 +1909,17 @@ class NodeConn(asyncore.dispatcher):
         self.cb = callback
         self.disconnect = False
         self.nServices = 0
+        self.message_filter = None
+        # Number of messages of each type that were dropped by the message
+        # filter without being deserialized
+        self.dropped_message_count = defaultdict(int)
+        self.dropped_message_bytes = defaultdict(int)
+        if message_filter is not None:
+            self.set_message_filter(message_filter)
+        if capture is not None:
+            self.capture = capture
+        if self.capture is not None:
+            self.capture.add_connection(self)
 
         if send_version:
             # stuff version msg into sendbuf
@@ -1772,6 +2006,8 @@ class NodeConn(asyncore.dispatcher):
                     checksum = None
                     if len(self.recvbuf) < 4 + 12 + 4 + msglen:
                         return
+                    if self.capture is not None:
+                        self.capture.record(self, "receive", self.recvbuf[:4+12+4+msglen])
                     msg = self.recvbuf[4+12+4:4+12+4+msglen]
                     self.recvbuf = self.recvbuf[4+12+4+msglen:]
                 else:
@@ -1782,13 +2018,20 @@ class NodeConn(asyncore.dispatcher):
                     checksum = self.recvbuf[4+12+4:4+12+4+4]
                     if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
                         return
+                    if self.capture is not None:
+                        self.capture.record(self, "receive", self.recvbuf[:4+12+4+4+msglen])
                     msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                    th = sha256(msg)
-                    h = sha256(th)
-                    if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
+                    # Don't bother checking the payload of messages we drop
+                    if self.wants_message(command):
+                        th = sha256(msg)
+                        h = sha256(th)
+                        if checksum != h[:4]:
+                            raise ValueError("got bad checksum " + repr(self.recvbuf))
                     self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command in self.messagemap:
+                if not self.wants_message(command):
+                    self.dropped_message_count[command.decode('ascii')] += 1
+                    self.dropped_message_bytes[command.decode('ascii')] += msglen
+                elif command in self.messagemap:
                     f = BytesIO(msg)
                     t = self.messagemap[command]()
                     t.deserialize(f)
@@ -1798,6 +2041,21 @@ class NodeConn(asyncore.dispatcher):
         except Exception as e:
             logger.exception('got_data:', repr(e))
 
+    def set_message_filter(self, commands):
+        """Only deliver messages of the given types (eg [b"inv", b"block"]).
+
+        Other messages are counted in dropped_message_count and skipped
+        without being deserialized or passed to the callback. version, verack
+        and ping are always delivered. Pass None to deliver everything."""
+        with mininode_lock:
+            if commands is None:
+                self.message_filter = None
+            else:
+                self.message_filter = frozenset(commands) | self.UNFILTERED_COMMANDS
+
+    def wants_message(self, command):
+        return self.message_filter is None or command in self.message_filter
+
     def send_message(self, message, pushbuf=False):
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
@@ -1813,8 +2071,19 @@ class NodeConn(asyncore.dispatcher):
             h = sha256(th)
             tmsg += h[:4]
         tmsg += data
+        self._send_frame(tmsg)
+
+    def send_raw_message(self, frame):
+        """Send a message that is already serialized and framed (eg read from a P2PCapture)."""
+        if self.state != "connected":
+            raise IOError('Not connected')
+        self._send_frame(frame)
+
+    def _send_frame(self, frame):
         with mininode_lock:
-            self.sendbuf += tmsg
+            if self.capture is not None:
+                self.capture.record(self, "send", frame)
+            self.sendbuf += frame
             self.last_sent = time.time()
 
     def got_message(self, message):
@@ -1827,6 +2096,10 @@ class NodeConn(asyncore.dispatcher):
         self.cb.deliver(self, message)
 
     def _log_message(self, direction, msg):
+        # repr() of large messages is expensive, so only build the log line
+        # if it is going to be written
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
@@ -27,6 +27,8 @@ STATE_LAST_ACK = '09'
 STATE_LISTEN = '0A'
 STATE_CLOSING = '0B'
 
+PROC_NET = '/proc/net'
+
 def get_socket_inodes(pid):
     '''
     Get list of socket inodes for process pid.
@@ -34,56 +36,92 @@ def get_socket_inodes(pid):
     base = '/proc/%i/fd' % pid
     inodes = []
     for item in os.listdir(base):
-        target = os.readlink(os.path.join(base, item))
+        try:
+            target = os.readlink(os.path.join(base, item))
+        except FileNotFoundError: # closed in the meantime
+            continue
         if target.startswith('socket:'):
             inodes.append(int(target[8:-1]))
     return inodes
 
-def _remove_empty(array):
-    return [x for x in array if x !='']
-
 def _convert_ip_port(array):
     host,port = array.split(':')
     # convert host from mangled-per-four-bytes form as used by kernel
     host = unhexlify(host)
-    host_out = ''
-    for x in range(0, len(host) // 4):
-        (val,) = struct.unpack('=I', host[x*4:(x+1)*4])
-        host_out += '%08x' % val
+    words = struct.unpack('=%dI' % (len(host) // 4), host)
+    host_out = ''.join('%08x' % val for val in words)
 
     return host_out,int(port,16)
 
-def netstat(typ='tcp'):
+def _read_table(typ, proc_net=PROC_NET):
+    '''
+    Return the lines of /proc/net/<typ>, split up to the inode field (the 10th).
+    '''
+    with open(os.path.join(proc_net, typ),'r',encoding='utf8') as f:
+        content = f.read().splitlines()
+    return [line.split(None, 10) for line in content[1:]]
+
+def _convert_line(line_array):
+    tcp_id = line_array[0]
+    l_addr = _convert_ip_port(line_array[1])
+    r_addr = _convert_ip_port(line_array[2])
+    state = line_array[3]
+    inode = int(line_array[9])                      # Need the inode to match with process pid.
+    return [tcp_id, l_addr, r_addr, state, inode]
+
+def netstat(typ='tcp', proc_net=PROC_NET):
     '''
     Function to return a list with status of tcp connections at linux systems
     To get pid of all network process running on system, you must run this script
     as superuser
     '''
-    with open('/proc/net/'+typ,'r',encoding='utf8') as f:
-        content = f.readlines()
-        content.pop(0)
-    result = []
-    for line in content:
-        line_array = _remove_empty(line.split(' '))     # Split lines and remove empty spaces.
-        tcp_id = line_array[0]
-        l_addr = _convert_ip_port(line_array[1])
-        r_addr = _convert_ip_port(line_array[2])
-        state = line_array[3]
-        inode = int(line_array[9])                      # Need the inode to match with process pid.
-        nline = [tcp_id, l_addr, r_addr, state, inode]
-        result.append(nline)
-    return result
+    return [_convert_line(line_array) for line_array in _read_table(typ, proc_net)]
+
+class SocketTable(object):
+    '''
+    Snapshot of the tcp and tcp6 sockets of the system, indexed by inode.
+
+    The tables are read once, and addresses are only converted for the sockets
+    that are looked up, so one snapshot can answer for many processes cheaply.
+    Sockets that are opened or closed later are not seen; take a new snapshot.
+    '''
+    def __init__(self, types=('tcp', 'tcp6'), proc_net=PROC_NET):
+        self.by_inode = {}
+        for typ in types:
+            for line_array in _read_table(typ, proc_net):
+                inode = int(line_array[9])
+                if inode: # sockets without an owner, e.g. in TIME_WAIT, have inode 0
+                    self.by_inode[inode] = line_array
+
+    def get(self, inode):
+        '''
+        Return the socket with this inode in the format of netstat, or None.
+        '''
+        line_array = self.by_inode.get(inode)
+        return _convert_line(line_array) if line_array is not None else None
+
+    def get_bind_addrs(self, pid):
+        '''
+        Get bind addresses as (host,port) tuples for process pid.
+        '''
+        bind_addrs = []
+        for inode in get_socket_inodes(pid):
+            line_array = self.by_inode.get(inode)
+            if line_array is not None and line_array[3] == STATE_LISTEN:
+                bind_addrs.append(_convert_ip_port(line_array[1]))
+        return bind_addrs
+
+    def get_bind_addrs_by_pid(self, pids):
+        '''
+        Get the bind addresses of many processes, as a dict of pid to list of (host,port) tuples.
+        '''
+        return {pid: self.get_bind_addrs(pid) for pid in pids}
 
 def get_bind_addrs(pid):
     '''
     Get bind addresses as (host,port) tuples for process pid.
     '''
-    inodes = get_socket_inodes(pid)
-    bind_addrs = []
-    for conn in netstat('tcp') + netstat('tcp6'):
-        if conn[3] == STATE_LISTEN and conn[4] in inodes:
-            bind_addrs.append(conn[1])
-    return bind_addrs
+    return SocketTable().get_bind_addrs(pid)
 
 # from: http://code.activestate.com/recipes/439093/
 def all_interfaces():
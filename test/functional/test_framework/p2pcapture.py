@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Record and replay raw p2p traffic.
+
+P2PCapture records every framed message that a NodeConn sends or receives,
+with a timestamp and the id of the connection. Set NodeConn.capture (or pass
+capture= to NodeConn) to record all connections, or run any test with
+--p2pcapture=<file>.
+
+P2PReplayer feeds the messages that were sent in a capture back into a node,
+one new connection per recorded connection, either with the original timing
+(optionally scaled) or as fast as possible. The node's answers are counted
+but not compared against the recording. Recorded pongs are skipped and pings
+are answered live instead, so the connections survive long replays.
+
+A capture file starts with CAPTURE_MAGIC, followed by one record per event:
+
+    <double timestamp> <uint32 connection id> <uint8 event> <uint32 length> <data>
+
+where event is one of CONNECT (data is "<address>:<port>"), SEND or RECEIVE
+(data is the complete message as it appeared on the wire)."""
+
+from collections import defaultdict, namedtuple
+import struct
+import threading
+import time
+import weakref
+
+from .mininode import (
+    MY_VERSION,
+    NodeConn,
+    NodeConnCB,
+    mininode_lock,
+    wait_until,
+)
+
+CAPTURE_MAGIC = b"P2PCAP\x00\x01"
+
+CONNECT = 0
+SEND = 1
+RECEIVE = 2
+
+RECORD_HEADER = struct.Struct("<dIBI")
+
+CaptureRecord = namedtuple('CaptureRecord', ['timestamp', 'conn_id', 'event', 'data'])
+
+def frame_command(frame):
+    """Return the command of a framed p2p message."""
+    return frame[4:4+12].split(b"\x00", 1)[0]
+
+class P2PCapture(object):
+    """Write the traffic of NodeConns to a capture file.
+
+    record() is called from both the test thread and the network thread, so
+    writes are serialized with a lock."""
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.lock = threading.Lock()
+        self.next_id = 0
+        # Ids of the connections in this capture
+        self.conn_ids = weakref.WeakKeyDictionary()
+
+    def add_connection(self, conn):
+        """Register a connection and return its id in the capture."""
+        with self.lock:
+            if conn in self.conn_ids:
+                return self.conn_ids[conn]
+            conn_id = self.next_id
+            self.next_id += 1
+            self.conn_ids[conn] = conn_id
+        self._write(conn_id, CONNECT, ("%s:%d" % (conn.dstaddr, conn.dstport)).encode("ascii"))
+        return conn_id
+
+    def record(self, conn, direction, frame):
+        # The capture may have been set after the connection was created
+        conn_id = self.conn_ids.get(conn)
+        if conn_id is None:
+            conn_id = self.add_connection(conn)
+        self._write(conn_id, SEND if direction == "send" else RECEIVE, frame)
+
+    def _write(self, conn_id, event, data):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(RECORD_HEADER.pack(time.time(), conn_id, event, len(data)))
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def read_capture(filename):
+    """Iterate over the CaptureRecords of a capture file."""
+    with open(filename, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a p2p capture file" % filename)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # A capture that was not closed cleanly may end in a partial record
+                return
+            timestamp, conn_id, event, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(timestamp, conn_id, event, data)
+
+class ReplayNode(NodeConnCB):
+    """Callback for a replayed connection.
+
+    The recorded traffic already contains our verack, so don't send another
+    one, and don't request anything the node announces."""
+
+    def __init__(self):
+        super().__init__()
+        # Keep clear of the ping nonces in the recorded traffic
+        self.ping_counter = 1 << 32
+
+    def on_version(self, conn, message):
+        conn.ver_send = min(MY_VERSION, message.nVersion)
+        conn.nServices = message.nServices
+
+    def on_inv(self, conn, message):
+        pass
+
+class P2PReplayer(object):
+    """Replay the sent messages of a capture file into a node.
+
+    speed scales the recorded timing (2.0 replays twice as fast); a speed of 0
+    sends every message as soon as possible."""
+
+    def __init__(self, filename, node, port, speed=1.0):
+        self.filename = filename
+        self.node = node
+        self.port = port
+        self.speed = speed
+        self.peers = {}
+        self.connections = {}
+        self.sent_count = defaultdict(int)
+        self.sent_bytes = defaultdict(int)
+        self.elapsed = 0
+
+    def connect(self):
+        """Open one connection per connection in the capture.
+
+        This must be called before starting the NetworkThread."""
+        for record in read_capture(self.filename):
+            if record.event == CONNECT:
+                peer = ReplayNode()
+                conn = NodeConn('127.0.0.1', self.port, self.node, peer, send_version=False, message_filter=[b"ping", b"pong"])
+                peer.add_connection(conn)
+                self.peers[record.conn_id] = peer
+                self.connections[record.conn_id] = conn
+
+    def wait_for_connections(self, timeout=60):
+        for conn in self.connections.values():
+            assert wait_until(lambda: conn.state == "connected", timeout=timeout)
+
+    def run(self):
+        start_time = time.time()
+        first_timestamp = None
+        for record in read_capture(self.filename):
+            if record.event != SEND:
+                continue
+            command = frame_command(record.data)
+            if command == b"pong":
+                continue
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            if self.speed:
+                delay = start_time + (record.timestamp - first_timestamp) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            conn = self.connections[record.conn_id]
+            if conn.state != "connected":
+                continue
+            conn.send_raw_message(record.data)
+            self.sent_count[command.decode('ascii')] += 1
+            self.sent_bytes[command.decode('ascii')] += len(record.data)
+        # Wait until the node has processed everything we sent
+        for peer in self.peers.values():
+            if peer.connected and peer.message_count["verack"]:
+                peer.sync_with_ping(timeout=600)
+        self.elapsed = time.time() - start_time
+
+    def received_counts(self):
+        counts = defaultdict(int)
+        with mininode_lock:
+            for conn_id, conn in self.connections.items():
+                for command, count in self.peers[conn_id].message_count.items():
+                    counts[command] += count
+                for command, count in conn.dropped_message_count.items():
+                    counts[command] += count
+        return counts
+
+    def disconnect(self):
+        for conn in self.connections.values():
+            conn.disconnect_node()
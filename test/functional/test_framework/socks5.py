@@ -2,10 +2,22 @@
 # Copyright (c) 2015-2016 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""Dummy Socks5 server for testing."""
+"""Socks5 server for testing.
 
-import socket, threading, queue
+All connections are served by one thread with a selector. By default the
+server only records the commands it receives and then disconnects. With
+Socks5Configuration.relay set, it connects to the requested destination and
+relays the traffic both ways, so that many concurrent streams can be run
+through it. Socks5Server.get_counters() reports what it did.
+"""
+
+import collections
+import errno
 import logging
+import queue
+import selectors
+import socket
+import threading
 
 logger = logging.getLogger("TestFramework.socks5")
 
@@ -18,17 +30,33 @@ class AddressType:
     DOMAINNAME = 0x03
     IPV6 = 0x04
 
+class Reply:
+    SUCCEEDED = 0x00
+    GENERAL_FAILURE = 0x01
+    HOST_UNREACHABLE = 0x04
+    CONNECTION_REFUSED = 0x05
+
+BUFSIZE = 65536 # Size of the relay buffer, per direction of a stream
+
 ### Utility functions
-def recvall(s, n):
-    """Receive n bytes from a socket, or fail."""
-    rv = bytearray()
-    while n > 0:
-        d = s.recv(n)
-        if not d:
-            raise IOError('Unexpected end of stream')
-        rv.extend(d)
-        n -= len(d)
-    return rv
+def reply_packet(rep, sockaddr=None):
+    """Build a connect reply, with the bound address if there is one."""
+    if sockaddr is None:
+        return bytearray([0x05, rep, 0x00, AddressType.IPV4, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+    if ':' in sockaddr[0]:
+        addr = bytearray([AddressType.IPV6]) + socket.inet_pton(socket.AF_INET6, sockaddr[0])
+    else:
+        addr = bytearray([AddressType.IPV4]) + socket.inet_pton(socket.AF_INET, sockaddr[0])
+    return bytearray([0x05, rep, 0x00]) + addr + bytearray([sockaddr[1] >> 8, sockaddr[1] & 0xff])
+
+def resolve(cmd):
+    """Return (family, sockaddr) to connect to for a command. Names are resolved blocking."""
+    if cmd.atyp == AddressType.IPV4:
+        return (socket.AF_INET, (socket.inet_ntop(socket.AF_INET, bytes(cmd.addr)), cmd.port))
+    if cmd.atyp == AddressType.IPV6:
+        return (socket.AF_INET6, (socket.inet_ntop(socket.AF_INET6, bytes(cmd.addr)), cmd.port))
+    (family, _, _, _, sockaddr) = socket.getaddrinfo(bytes(cmd.addr).decode(), cmd.port, 0, socket.SOCK_STREAM)[0]
+    return (family, sockaddr)
 
 ### Implementation classes
 class Socks5Configuration(object):
@@ -38,6 +66,7 @@ class Socks5Configuration(object):
         self.af = socket.AF_INET # Bind address family
         self.unauth = False  # Support unauthenticated
         self.auth = False  # Support authentication
+        self.relay = False  # Connect to the destination and relay data, instead of disconnecting after the command
 
 class Socks5Command(object):
     """Information about an incoming socks5 command."""
@@ -51,76 +80,253 @@ class Socks5Command(object):
     def __repr__(self):
         return 'Socks5Command(%s,%s,%s,%s,%s,%s)' % (self.cmd, self.atyp, self.addr, self.port, self.username, self.password)
 
+class Pipe(object):
+    """
+    One direction of a relayed stream.
+
+    Data is received into a fixed buffer and sent from a view on it, so it is
+    not copied. The source is only read from when the buffer is empty, which
+    also stops a fast sender from outrunning a slow receiver.
+    """
+    def __init__(self, src, dst, data=b''):
+        self.src = src
+        self.dst = dst
+        self.buf = memoryview(bytearray(max(BUFSIZE, len(data))))
+        self.buf[:len(data)] = data
+        self.start = 0
+        self.end = len(data)
+        self.eof = False # The source has been shut down
+        self.shut = False # The shutdown has been passed on to the destination
+
+    def pending(self):
+        return self.start < self.end
+
+    def done(self):
+        return self.shut
+
+    def fill(self):
+        """Receive from the source. Returns the number of bytes received."""
+        try:
+            n = self.src.recv_into(self.buf)
+        except BlockingIOError: # spurious wakeup, nothing to read after all
+            return 0
+        if n == 0:
+            self.eof = True
+        self.start = 0
+        self.end = n
+        return n
+
+    def flush(self):
+        """Send as much as possible to the destination, and pass on the shutdown after the last data."""
+        try:
+            while self.pending():
+                self.start += self.dst.send(self.buf[self.start:self.end])
+        except BlockingIOError:
+            pass
+        if self.eof and not self.pending() and not self.shut:
+            self.dst.shutdown(socket.SHUT_WR)
+            self.shut = True
+
 class Socks5Connection(object):
     def __init__(self, serv, conn, peer):
         self.serv = serv
         self.conn = conn
         self.peer = peer
+        self.remote = None # Socket to the destination, when relaying
+        self.pipes = None # (client to destination, destination to client), when relaying
+        self.callbacks = None # Event callbacks of both sockets, when relaying
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.close_after_send = False
+        self.request = self.handle()
+        self.wanted = next(self.request)
+        conn.setblocking(False)
+        serv.watch(conn, selectors.EVENT_READ, self.on_client)
+
+    def send(self, data):
+        """Queue data for the client during the handshake."""
+        self.outbuf += data
+        self.serv.watch(self.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, self.on_client)
 
     def handle(self):
-        """Handle socks5 request according to RFC192."""
+        """
+        Handle socks5 request according to RFC1928.
+        This is a generator: it yields how many bytes it needs next, and is sent them.
+        """
+        # Verify socks version
+        ver = (yield 1)[0]
+        if ver != 0x05:
+            raise IOError('Invalid socks version %i' % ver)
+        # Choose authentication method
+        nmethods = (yield 1)[0]
+        methods = bytearray((yield nmethods))
+        method = None
+        if 0x02 in methods and self.serv.conf.auth:
+            method = 0x02 # username/password
+        elif 0x00 in methods and self.serv.conf.unauth:
+            method = 0x00 # unauthenticated
+        if method is None:
+            raise IOError('No supported authentication method was offered')
+        # Send response
+        self.send(bytearray([0x05, method]))
+        # Read authentication (optional)
+        username = None
+        password = None
+        if method == 0x02:
+            ver = (yield 1)[0]
+            if ver != 0x01:
+                raise IOError('Invalid auth packet version %i' % ver)
+            ulen = (yield 1)[0]
+            username = str((yield ulen))
+            plen = (yield 1)[0]
+            password = str((yield plen))
+            # Send authentication response
+            self.send(bytearray([0x01, 0x00]))
+
+        # Read connect request
+        (ver,cmd,rsv,atyp) = (yield 4)
+        if ver != 0x05:
+            raise IOError('Invalid socks version %i in connect request' % ver)
+        if cmd != Command.CONNECT:
+            raise IOError('Unhandled command %i in connect request' % cmd)
+
+        if atyp == AddressType.IPV4:
+            addr = (yield 4)
+        elif atyp == AddressType.DOMAINNAME:
+            n = (yield 1)[0]
+            addr = (yield n)
+        elif atyp == AddressType.IPV6:
+            addr = (yield 16)
+        else:
+            raise IOError('Unknown address type %i' % atyp)
+        port_hi,port_lo = (yield 2)
+        port = (port_hi << 8) | port_lo
+
+        cmdin = Socks5Command(cmd, atyp, addr, port, username, password)
+        self.serv.count('commands')
+        self.serv.queue.put(cmdin)
+        logger.info('Proxy: %s', cmdin)
+        if self.serv.conf.relay:
+            self.connect(cmdin)
+        else:
+            # Send dummy response, and disconnect
+            self.send(reply_packet(Reply.SUCCEEDED))
+            self.close_after_send = True
+
+    def on_client(self, mask):
+        """Handle an event on the client socket during the handshake."""
         try:
-            # Verify socks version
-            ver = recvall(self.conn, 1)[0]
-            if ver != 0x05:
-                raise IOError('Invalid socks version %i' % ver)
-            # Choose authentication method
-            nmethods = recvall(self.conn, 1)[0]
-            methods = bytearray(recvall(self.conn, nmethods))
-            method = None
-            if 0x02 in methods and self.serv.conf.auth:
-                method = 0x02 # username/password
-            elif 0x00 in methods and self.serv.conf.unauth:
-                method = 0x00 # unauthenticated
-            if method is None:
-                raise IOError('No supported authentication method was offered')
-            # Send response
-            self.conn.sendall(bytearray([0x05, method]))
-            # Read authentication (optional)
-            username = None
-            password = None
-            if method == 0x02:
-                ver = recvall(self.conn, 1)[0]
-                if ver != 0x01:
-                    raise IOError('Invalid auth packet version %i' % ver)
-                ulen = recvall(self.conn, 1)[0]
-                username = str(recvall(self.conn, ulen))
-                plen = recvall(self.conn, 1)[0]
-                password = str(recvall(self.conn, plen))
-                # Send authentication response
-                self.conn.sendall(bytearray([0x01, 0x00]))
-
-            # Read connect request
-            (ver,cmd,rsv,atyp) = recvall(self.conn, 4)
-            if ver != 0x05:
-                raise IOError('Invalid socks version %i in connect request' % ver)
-            if cmd != Command.CONNECT:
-                raise IOError('Unhandled command %i in connect request' % cmd)
-
-            if atyp == AddressType.IPV4:
-                addr = recvall(self.conn, 4)
-            elif atyp == AddressType.DOMAINNAME:
-                n = recvall(self.conn, 1)[0]
-                addr = recvall(self.conn, n)
-            elif atyp == AddressType.IPV6:
-                addr = recvall(self.conn, 16)
-            else:
-                raise IOError('Unknown address type %i' % atyp)
-            port_hi,port_lo = recvall(self.conn, 2)
-            port = (port_hi << 8) | port_lo
-
-            # Send dummy response
-            self.conn.sendall(bytearray([0x05, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]))
-
-            cmdin = Socks5Command(cmd, atyp, addr, port, username, password)
-            self.serv.queue.put(cmdin)
-            logger.info('Proxy: %s', cmdin)
-            # Fall through to disconnect
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = self.conn.recv(BUFSIZE)
+                except BlockingIOError: # spurious wakeup, nothing to read after all
+                    data = b''
+                else:
+                    if not data:
+                        raise IOError('Unexpected end of stream')
+                self.inbuf += data
+                while self.request is not None and len(self.inbuf) >= self.wanted:
+                    data = self.inbuf[:self.wanted]
+                    del self.inbuf[:self.wanted]
+                    try:
+                        self.wanted = self.request.send(data)
+                    except StopIteration:
+                        self.request = None
+            if self.outbuf:
+                try:
+                    n = self.conn.send(self.outbuf)
+                    del self.outbuf[:n]
+                except BlockingIOError:
+                    pass
+            if not self.outbuf:
+                if self.close_after_send:
+                    self.close()
+                elif self.remote is None:
+                    self.serv.watch(self.conn, selectors.EVENT_READ if self.request else 0, self.on_client)
         except Exception as e:
             logger.exception("socks5 request handling failed.")
+            self.serv.count('errors')
             self.serv.queue.put(e)
-        finally:
-            self.conn.close()
+            self.close()
+
+    def connect(self, cmd):
+        """Start connecting to the destination of a command."""
+        try:
+            (family, sockaddr) = resolve(cmd)
+        except (socket.gaierror, UnicodeError, ValueError):
+            self.fail(Reply.HOST_UNREACHABLE)
+            return
+        self.remote = socket.socket(family, socket.SOCK_STREAM)
+        self.remote.setblocking(False)
+        err = self.remote.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(Reply.CONNECTION_REFUSED if err == errno.ECONNREFUSED else Reply.GENERAL_FAILURE)
+            return
+        # Don't read from the client until the relay starts
+        self.serv.watch(self.conn, 0, self.on_client)
+        self.serv.watch(self.remote, selectors.EVENT_WRITE, self.on_connected)
+
+    def fail(self, rep):
+        self.serv.count('connect_failures')
+        if self.remote is not None:
+            self.serv.watch(self.remote, 0, None)
+            self.remote.close()
+            self.remote = None
+        self.send(reply_packet(rep))
+        self.close_after_send = True
+
+    def on_connected(self, mask):
+        err = self.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.fail(Reply.CONNECTION_REFUSED if err == errno.ECONNREFUSED else Reply.GENERAL_FAILURE)
+            return
+        self.serv.count('relays')
+        self.serv.count('bytes_up', len(self.inbuf))
+        # The reply goes to the client ahead of the data from the destination,
+        # and anything the client already sent goes to the destination.
+        reply = self.outbuf + reply_packet(Reply.SUCCEEDED, self.remote.getsockname())
+        self.pipes = (Pipe(self.conn, self.remote, bytes(self.inbuf)), Pipe(self.remote, self.conn, bytes(reply)))
+        self.inbuf = self.outbuf = None
+        self.callbacks = {
+            self.conn: lambda mask: self.on_relay(self.conn, mask),
+            self.remote: lambda mask: self.on_relay(self.remote, mask),
+        }
+        self.on_relay(self.conn, 0)
+
+    def on_relay(self, sock, mask):
+        """Handle an event on either socket of a relayed stream."""
+        try:
+            for (pipe, counter) in zip(self.pipes, ('bytes_up', 'bytes_down')):
+                if pipe.src is sock and mask & selectors.EVENT_READ:
+                    self.serv.count(counter, pipe.fill())
+                pipe.flush()
+        except OSError as e:
+            logger.debug('Proxy: relay for %s closed: %s', self.peer, e)
+            self.close()
+            return
+        if all(pipe.done() for pipe in self.pipes):
+            self.close()
+            return
+        # Read when the buffer is free, write when it is not
+        events = {self.conn: 0, self.remote: 0}
+        for pipe in self.pipes:
+            if pipe.pending():
+                events[pipe.dst] |= selectors.EVENT_WRITE
+            elif not pipe.eof:
+                events[pipe.src] |= selectors.EVENT_READ
+        for (s, ev) in events.items():
+            self.serv.watch(s, ev, self.callbacks[s])
+
+    def close(self):
+        if self.conn is None:
+            return
+        for s in (self.conn, self.remote):
+            if s is not None:
+                self.serv.watch(s, 0, None)
+                s.close()
+        self.conn = self.remote = None
+        self.serv.connections.discard(self)
+        self.serv.count('active', -1)
 
 class Socks5Server(object):
     def __init__(self, conf):
@@ -128,20 +334,65 @@ class Socks5Server(object):
         self.s = socket.socket(conf.af)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind(conf.addr)
-        self.s.listen(5)
+        self.s.listen(socket.SOMAXCONN)
+        self.s.setblocking(False)
         self.running = False
         self.thread = None
         self.queue = queue.Queue() # report connections and exceptions to client
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        # All keys exist from the start, so that other threads can copy the counters safely
+        self.counters = collections.Counter(dict.fromkeys(
+            ['accepted', 'active', 'peak_active', 'commands', 'errors', 'relays', 'connect_failures', 'bytes_up', 'bytes_down'], 0))
+        (self.wakeup_r, self.wakeup_w) = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.watch(self.s, selectors.EVENT_READ, self.accept)
+        self.watch(self.wakeup_r, selectors.EVENT_READ, lambda mask: self.wakeup_r.recv(64))
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def get_counters(self):
+        """Return a copy of the counters: connections accepted and active (and the
+        most active at once), commands received, handshake errors, relayed
+        streams, failed connections to destinations, and bytes relayed."""
+        return dict(self.counters)
+
+    def watch(self, sock, events, callback):
+        """Set the events to wait for on a socket, and the callback for them. 0 stops watching it."""
+        try:
+            key = self.selector.get_key(sock)
+        except KeyError:
+            key = None
+        if not events:
+            if key is not None:
+                self.selector.unregister(sock)
+        elif key is None:
+            self.selector.register(sock, events, callback)
+        elif key.events != events or key.data != callback:
+            self.selector.modify(sock, events, callback)
+
+    def accept(self, mask):
+        while True:
+            try:
+                (sockconn, peer) = self.s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.count('accepted')
+            self.count('active')
+            self.counters['peak_active'] = max(self.counters['peak_active'], self.counters['active'])
+            self.connections.add(Socks5Connection(self, sockconn, peer))
 
     def run(self):
         while self.running:
-            (sockconn, peer) = self.s.accept()
-            if self.running:
-                conn = Socks5Connection(self, sockconn, peer)
-                thread = threading.Thread(None, conn.handle)
-                thread.daemon = True
-                thread.start()
-    
+            for (key, mask) in self.selector.select():
+                # An earlier callback may have closed this socket, or changed what it waits for
+                current = self.selector.get_map().get(key.fileobj) if key.fileobj.fileno() >= 0 else None
+                if current is not None and mask & current.events:
+                    current.data(mask & current.events)
+        for conn in list(self.connections):
+            conn.close()
+
     def start(self):
         assert(not self.running)
         self.running = True
@@ -151,9 +402,9 @@ class Socks5Server(object):
 
     def stop(self):
         self.running = False
-        # connect to self to end run loop
-        s = socket.socket(self.conf.af)
-        s.connect(self.conf.addr)
-        s.close()
+        # wake up the run loop to end it
+        self.wakeup_w.send(b'\0')
         self.thread.join()
-
+        self.selector.close()
+        for sock in (self.wakeup_r, self.wakeup_w, self.s):
+            sock.close()
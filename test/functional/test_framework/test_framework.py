@@ -41,6 +41,8 @@ from .util import (
     wait_for_bitcoind_start,
 )
 from .authproxy import JSONRPCException
+from .mininode import NodeConn
+from .p2pcapture import P2PCapture
 
 class TestStatus(Enum):
     PASSED = 1
@@ -125,12 +127,17 @@ class BitcoinTestFramework(object):
                           help="Write tested RPC commands into this directory")
         parser.add_option("--configfile", dest="configfile",
                           help="Location of the test framework config file")
+        parser.add_option("--p2pcapture", dest="p2pcapture",
+                          help="Record the traffic of all mininode connections to this file (see p2p-replay.py)")
         self.add_options(parser)
         (self.options, self.args) = parser.parse_args()
 
         if self.options.coveragedir:
             enable_coverage(self.options.coveragedir)
 
+        if self.options.p2pcapture:
+            NodeConn.capture = P2PCapture(self.options.p2pcapture)
+
         PortSeed.n = self.options.port_seed
 
         os.environ['PATH'] = self.options.srcdir+":"+self.options.srcdir+"/qt:"+os.environ['PATH']
@@ -165,6 +172,9 @@ class BitcoinTestFramework(object):
         except KeyboardInterrupt as e:
             self.log.warning("Exiting after keyboard interrupt")
 
+        if NodeConn.capture is not None:
+            NodeConn.capture.close()
+
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
             if self.nodes:
@@ -17,6 +17,7 @@ For a description of arguments recognized by test scripts, see
 import argparse
 import configparser
 import datetime
+import json
 import os
 import time
 import shutil
@@ -152,6 +153,11 @@ NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
     "combine_logs.py",
     "create_cache.py",
+    "mininode_bench.py",
+    "netutil_bench.py",
+    "socks5_bench.py",
+    "p2p-loadgen.py",
+    "p2p-replay.py",
     "test_runner.py",
 ]
 
@@ -450,11 +456,13 @@ class RPCCoverage(object):
 
     Coverage calculation works by having each test script subprocess write
     coverage files into a particular directory. These files contain the RPC
-    commands invoked during testing, as well as a complete listing of RPC
-    commands per `bitcoin-cli help` (`rpc_interface.txt`).
+    commands invoked during testing, with their call counts, latencies and
+    payload sizes, as well as a complete listing of RPC commands per
+    `bitcoin-cli help` (`rpc_interface.txt`).
 
     After all tests complete, the commands run are combined and diff'd against
-    the complete list to calculate uncovered RPC commands.
+    the complete list to calculate uncovered RPC commands, and their
+    statistics are summed up into a profile of the RPC calls of the suite.
 
     See also: test/functional/test_framework/coverage.py
 
@@ -465,10 +473,12 @@ class RPCCoverage(object):
 
     def report_rpc_coverage(self):
         """
-        Print out RPC commands that were unexercised by tests.
+        Print out RPC commands that were unexercised by tests, and the
+        RPC commands that took the most time.
 
         """
-        uncovered = self._get_uncovered_rpc_commands()
+        rpc_stats = self._get_rpc_stats()
+        uncovered = self._get_uncovered_rpc_commands(rpc_stats)
 
         if uncovered:
             print("Uncovered RPC commands:")
@@ -476,22 +486,81 @@ class RPCCoverage(object):
         else:
             print("All RPC commands covered.")
 
+        self.report_rpc_profile(rpc_stats)
+
+    def report_rpc_profile(self, rpc_stats, limit=20):
+        """
+        Print the RPC commands the tests spent the most time in.
+
+        """
+        if not rpc_stats:
+            return
+        total_calls = sum(s["calls"] for s in rpc_stats.values())
+        total_seconds = sum(s["seconds"] for s in rpc_stats.values())
+        print("RPC profile: %d calls, %.1f s (top %d by time):" % (total_calls, total_seconds, min(limit, len(rpc_stats))))
+        print("  %-28s %8s %7s %9s %9s %9s %11s %11s" % ("method", "calls", "errors", "total s", "mean ms", "p90 ms", "req B/call", "resp B/call"))
+        by_time = sorted(rpc_stats.items(), key=lambda item: item[1]["seconds"], reverse=True)
+        for method, s in by_time[:limit]:
+            print("  %-28s %8d %7d %9.2f %9.2f %9s %11d %11d" % (
+                method, s["calls"], s["errors"], s["seconds"], s["seconds"] * 1000 / s["calls"],
+                "<%d" % self._latency_percentile(s["latency_ms_log2"], 0.9),
+                s["request_bytes"] // s["calls"], s["response_bytes"] // s["calls"]))
+        print()
+
     def cleanup(self):
         return shutil.rmtree(self.dir)
 
-    def _get_uncovered_rpc_commands(self):
+    @staticmethod
+    def _latency_percentile(histogram, fraction):
+        """
+        Return the upper bound in ms of the histogram bucket that holds
+        the given fraction of the calls.
+
+        """
+        target = sum(histogram) * fraction
+        count = 0
+        for i, n in enumerate(histogram):
+            count += n
+            if count >= target:
+                return 2 ** i
+        return 2 ** (len(histogram) - 1)
+
+    def _get_rpc_stats(self):
+        """
+        Return the statistics of all coverage files, summed by RPC command.
+
+        """
+        # This is shared from `test/functional/test-framework/coverage.py`
+        coverage_file_prefix = 'coverage.'
+        coverage_file_suffix = '.json'
+
+        rpc_stats = {}
+        for root, dirs, files in os.walk(self.dir):
+            for filename in files:
+                if not (filename.startswith(coverage_file_prefix) and filename.endswith(coverage_file_suffix)):
+                    continue
+                with open(os.path.join(root, filename), 'r', encoding='utf8') as f:
+                    file_stats = json.load(f)
+                for method, s in file_stats.items():
+                    total = rpc_stats.get(method)
+                    if total is None:
+                        rpc_stats[method] = s
+                        continue
+                    for key in ("calls", "errors", "seconds", "request_bytes", "response_bytes"):
+                        total[key] += s[key]
+                    total["latency_ms_log2"] = [a + b for (a, b) in zip(total["latency_ms_log2"], s["latency_ms_log2"])]
+        return rpc_stats
+
+    def _get_uncovered_rpc_commands(self, rpc_stats):
         """
         Return a set of currently untested RPC commands.
 
         """
         # This is shared from `test/functional/test-framework/coverage.py`
         reference_filename = 'rpc_interface.txt'
-        coverage_file_prefix = 'coverage.'
 
         coverage_ref_filename = os.path.join(self.dir, reference_filename)
-        coverage_filenames = set()
         all_cmds = set()
-        covered_cmds = set()
 
         if not os.path.isfile(coverage_ref_filename):
             raise RuntimeError("No coverage reference found")
@@ -499,17 +568,10 @@ class RPCCoverage(object):
         with open(coverage_ref_filename, 'r') as f:
             all_cmds.update([i.strip() for i in f.readlines()])
 
-        for root, dirs, files in os.walk(self.dir):
-            for filename in files:
-                if filename.startswith(coverage_file_prefix):
-                    coverage_filenames.add(os.path.join(root, filename))
-
-        for filename in coverage_filenames:
-            with open(filename, 'r') as f:
-                covered_cmds.update([i.strip() for i in f.readlines()])
+        # Only calls that succeeded count as covered
+        covered_cmds = set(method for (method, s) in rpc_stats.items() if s["calls"] > s["errors"])
 
         return all_cmds - covered_cmds
 
-
 if __name__ == '__main__':
     main()
@@ -7,28 +7,41 @@
 
 Runs automatically during `make check`.
 
-Can also be run manually."""
+Can also be run manually. Test cases are run in parallel and reported in
+order. Use --repeat and --timing to measure how long each case takes."""
 
 import argparse
 import binascii
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 import difflib
+import functools
 import json
 import logging
 import os
 import pprint
 import subprocess
 import sys
+import time
 
-def main():
-    config = configparser.ConfigParser()
-    config.read_file(open(os.path.dirname(__file__) + "/../config.ini"))
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, not %s' % value)
+    return n
 
+def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=4, help='how many test cases to run in parallel (default=4)')
+    parser.add_argument('--repeat', type=positive_int, default=1, help='run every test case this many times')
+    parser.add_argument('--timing', action='store_true', help='print how long every test case took')
     args = parser.parse_args()
     verbose = args.verbose
 
+    config = configparser.ConfigParser()
+    config.read_file(open(os.path.dirname(__file__) + "/../config.ini"))
+
     if verbose:
         level = logging.DEBUG
     else:
@@ -37,23 +50,33 @@ def main():
     # Add the format/level to the logger
     logging.basicConfig(format=formatter, level=level)
 
-    bctester(config["environment"]["SRCDIR"] + "/test/util/data", "bitcoin-util-test.json", config["environment"])
+    bctester(config["environment"]["SRCDIR"] + "/test/util/data", "bitcoin-util-test.json", config["environment"],
+             jobs=args.jobs, repeat=args.repeat, timing=args.timing)
 
-def bctester(testDir, input_basename, buildenv):
+def bctester(testDir, input_basename, buildenv, jobs=1, repeat=1, timing=False):
     """ Loads and parses the input file, runs all tests and reports results"""
     input_filename = testDir + "/" + input_basename
     raw_data = open(input_filename).read()
     input_data = json.loads(raw_data)
 
     failed_testcases = []
-
-    for testObj in input_data:
-        try:
-            bctest(testDir, testObj, buildenv)
-            logging.info("PASSED: " + testObj["description"])
-        except:
-            logging.info("FAILED: " + testObj["description"])
-            failed_testcases.append(testObj["description"])
+    case_times = []
+
+    time0 = time.time()
+    # The test cases spend their time waiting for bitcoin-tx, so threads
+    # are enough to run them in parallel. map() returns the results in order.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(lambda testObj: bctest_repeat(testDir, testObj, buildenv, repeat), input_data)
+        for testObj, (passed, durations) in zip(input_data, results):
+            if passed:
+                logging.info("PASSED: " + testObj["description"])
+            else:
+                logging.info("FAILED: " + testObj["description"])
+                failed_testcases.append(testObj["description"])
+            case_times.append((testObj["description"], durations))
+
+    if timing:
+        print_timing(case_times, time.time() - time0)
 
     if failed_testcases:
         error_message = "FAILED_TESTCASES:\n"
@@ -63,6 +86,40 @@ def bctester(testDir, input_basename, buildenv):
     else:
         sys.exit(0)
 
+def bctest_repeat(testDir, testObj, buildenv, repeat):
+    """Runs a single test repeat times.
+
+    Returns whether all runs passed, and the duration of every run."""
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        try:
+            bctest(testDir, testObj, buildenv)
+        except:
+            return False, durations
+        finally:
+            durations.append(time.time() - start)
+    return True, durations
+
+def print_timing(case_times, elapsed):
+    """Prints the fastest, median and slowest run of every test, slowest first."""
+    print("%9s %9s %9s  %s" % ("min ms", "median ms", "max ms", "test case"))
+    for description, durations in sorted(case_times, key=lambda case: -sorted(case[1])[len(case[1]) // 2]):
+        durations = sorted(durations)
+        print("%9.1f %9.1f %9.1f  %s" % (durations[0] * 1000, durations[len(durations) // 2] * 1000, durations[-1] * 1000, description))
+    runs = sum(len(durations) for _, durations in case_times)
+    print("%d runs of %d test cases in %.2f s" % (runs, len(case_times), elapsed))
+
+@functools.lru_cache(maxsize=None)
+def read_data_file(filename):
+    """Returns the contents of a data file, read once per run."""
+    return open(filename).read()
+
+@functools.lru_cache(maxsize=None)
+def parse_expected_output(filename, fmt):
+    """Returns the parsed contents of an expected output file, parsed once per run."""
+    return parse_output(read_data_file(filename), fmt)
+
 def bctest(testDir, testObj, buildenv):
     """Runs a single test, comparing output and RC to expected output and RC.
 
@@ -79,7 +136,7 @@ def bctest(testDir, testObj, buildenv):
     inputData = None
     if "input" in testObj:
         filename = testDir + "/" + testObj['input']
-        inputData = open(filename).read()
+        inputData = read_data_file(filename)
         stdinCfg = subprocess.PIPE
 
     # Read the expected output data (if there is any)
@@ -89,7 +146,7 @@ def bctest(testDir, testObj, buildenv):
         outputFn = testObj['output_cmp']
         outputType = os.path.splitext(outputFn)[1][1:]  # output type from file extension (determines how to compare)
         try:
-            outputData = open(testDir + "/" + outputFn).read()
+            outputData = read_data_file(testDir + "/" + outputFn)
         except:
             logging.error("Output file " + outputFn + " can not be opened")
             raise
@@ -114,7 +171,7 @@ def bctest(testDir, testObj, buildenv):
             logging.error('Error parsing command output as %s: %s' % (outputType, e))
             raise
         try:
-            b_parsed = parse_output(outputData, outputType)
+            b_parsed = parse_expected_output(testDir + "/" + outputFn, outputType)
         except Exception as e:
             logging.error('Error parsing expected output %s as %s: %s' % (outputFn, outputType, e))
             raise